@@ -0,0 +1,76 @@
+"""
+Benchmark host network operations: rtnetlink vs. `ip` subprocesses.
+
+Usage:
+    python benchmarks/bench_netlink.py [--iterations 200]
+
+Adding interfaces to a bridge is only benchmarked as root (it creates a temporary bridge and veth
+pair, named `llbench*`).
+"""
+
+import argparse
+import json
+import subprocess as sp
+
+from bench_clone import _measure
+
+from liblab import netlink
+
+_BRIDGE = "llbench0"
+_VETH = "llbench1"
+_VETH_PEER = "llbench2"
+
+
+def _create_links() -> bool:
+    """Create the bridge and veth pair, returns False if that's not possible (e.g. not root)."""
+    commands = [
+        ["ip", "link", "add", _BRIDGE, "type", "bridge"],
+        ["ip", "link", "add", _VETH, "type", "veth", "peer", "name", _VETH_PEER],
+    ]
+    for args in commands:
+        if sp.call(args, stderr=sp.DEVNULL) != 0:
+            _delete_links()
+            return False
+    return True
+
+
+def _delete_links():
+    for device in (_VETH, _BRIDGE):
+        sp.call(["ip", "link", "del", device], stderr=sp.DEVNULL)
+
+
+def run(iterations=200) -> dict:
+    results = {}
+    operations = {
+        "routes": netlink.routes,
+        "link_is_up": lambda: netlink.link_is_up("lo"),
+    }
+
+    has_links = _create_links()
+    if has_links:
+        operations["set_master"] = lambda: netlink.set_master(_VETH, _BRIDGE)
+        operations["set_link_up"] = lambda: netlink.set_link_up(_VETH)
+
+    prev_native = netlink._NATIVE
+    try:
+        for name, func in operations.items():
+            for native, backend in ((True, "netlink"), (False, "ip")):
+                netlink._NATIVE = native
+                results[f"{name}_{backend}"] = _measure(func, iterations)
+    finally:
+        netlink._NATIVE = prev_native
+        if has_links:
+            _delete_links()
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--iterations", type=int, default=200)
+    args = parser.parse_args()
+    print(json.dumps(run(args.iterations), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,297 @@
+"""
+Benchmark provisioning and teardown throughput, and the hot paths around them.
+
+Usage:
+    python benchmarks/run.py [--hypervisor-uri test:///default] [--iterations 20]
+        [--only vm,fleet,...] [--output results.json] [--compare baseline.json]
+
+Runs against libvirt's test driver by default (machines are created with the "test" domain
+type), so the results measure liblab rather than QEMU. The results are JSON (`mean_ms` and friends
+per measurement). Pass `--compare` with the results of
+another version to print the ratio of every measurement, the exit status is 1 if any of them
+regressed by more than `--threshold`.
+
+liblab must be importable, so run it after `poetry install` (e.g. with `poetry run`).
+"""
+
+import argparse
+import ipaddress
+import json
+import platform
+import random
+import subprocess as sp
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import bench_clone
+from bench_clone import _measure, _summarize
+
+import liblab.keyboard
+import liblab.subnets
+import liblab.vm
+from liblab import (
+    VM,
+    DHCPLease,
+    DHCPLeaseTable,
+    Disk,
+    SubnetAllocator,
+    System,
+    TypingProfile,
+    VNet,
+)
+from liblab.disks import _BaseDisk, _write_qcow2
+
+
+class _Context:
+    """What the benchmarks share: the hypervisor, a base image, and scratch space."""
+
+    def __init__(self, hypervisor_uri: str, iterations: int, workdir: Path):
+        self.hypervisor_uri = hypervisor_uri
+        self.iterations = iterations
+        self.workdir = workdir
+        self.image = workdir / "base.qcow2"
+        _write_qcow2(self.image, 10 * 1024**3)
+        self.subnets = SubnetAllocator(state_path=workdir / "subnets.json")
+
+    def components(self) -> list:
+        domain_type = "test" if self.hypervisor_uri.startswith("test:") else "kvm"
+        return [System(domain_type=domain_type), Disk(self.image)]
+
+
+def bench_vm(ctx: _Context) -> dict:
+    create, destroy = [], []
+    for _ in range(ctx.iterations):
+        start = time.perf_counter()
+        machine = VM(ctx.components(), ctx.hypervisor_uri)
+        create.append(time.perf_counter() - start)
+        start = time.perf_counter()
+        machine.destroy()
+        destroy.append(time.perf_counter() - start)
+    return {"vm.create": _summarize(create), "vm.destroy": _summarize(destroy)}
+
+
+def bench_vnet(ctx: _Context) -> dict:
+    create, destroy = [], []
+    for _ in range(ctx.iterations):
+        start = time.perf_counter()
+        net = VNet(hypervisor_uri=ctx.hypervisor_uri, subnets=ctx.subnets)
+        create.append(time.perf_counter() - start)
+        start = time.perf_counter()
+        net.destroy()
+        destroy.append(time.perf_counter() - start)
+    return {"vnet.create": _summarize(create), "vnet.destroy": _summarize(destroy)}
+
+
+def bench_fleet(ctx: _Context) -> dict:
+    results = {}
+    for count in (1, 10, 100):
+        start = time.perf_counter()
+        machines = VM.create_many([ctx.components() for _ in range(count)], ctx.hypervisor_uri)
+        created = time.perf_counter()
+        for machine in machines:
+            machine.destroy()
+        destroyed = time.perf_counter()
+
+        results[f"fleet.create.{count}"] = {
+            **_summarize([created - start]),
+            "machines_per_second": count / (created - start),
+        }
+        results[f"fleet.destroy.{count}"] = {
+            **_summarize([destroyed - created]),
+            "machines_per_second": count / (destroyed - created),
+        }
+    return results
+
+
+def bench_linked_clone(ctx: _Context) -> dict:
+    clone_results = bench_clone.run(ctx.iterations, ctx.workdir)
+    return {f"linked_clone.{name}": result for name, result in clone_results.items()}
+
+
+def bench_xml(ctx: _Context) -> dict:
+    machine = VM(ctx.components(), ctx.hypervisor_uri)
+    try:
+
+        def build_template():
+            liblab.vm._domain_templates.clear()
+            machine._template()
+
+        return {
+            # A new `VM.spec`: build the template, and render it
+            "xml.build": _measure(lambda: (build_template(), machine._to_xml()), ctx.iterations),
+            # A known `VM.spec`: only render the cached template
+            "xml.render": _measure(machine._to_xml, ctx.iterations * 100),
+        }
+    finally:
+        machine.destroy()
+
+
+def bench_subnets(ctx: _Context) -> dict:
+    results = {}
+    prev_routes = liblab.subnets.netlink.routes
+    try:
+        for count in (10, 1000, 100_000):
+            # Random /24 - /32 routes in 10.0.0.0/8, like a large routing table
+            routes = []
+            for _ in range(count):
+                prefix_len = random.randint(24, 32)
+                address = random.getrandbits(24 - (32 - prefix_len)) << (32 - prefix_len)
+                routes.append(ipaddress.IPv4Network((0x0A000000 | address, prefix_len)))
+            liblab.subnets.netlink.routes = lambda: routes
+
+            def allocate_and_release():
+                ctx.subnets.release(ctx.subnets.allocate())
+
+            results[f"subnets.allocate.{count}_routes"] = _measure(
+                allocate_and_release, ctx.iterations
+            )
+    finally:
+        liblab.subnets.netlink.routes = prev_routes
+    return results
+
+
+def bench_leases(ctx: _Context) -> dict:
+    macs = [
+        f"52:54:00:{i >> 16 & 0xff:02x}:{i >> 8 & 0xff:02x}:{i & 0xff:02x}" for i in range(10_000)
+    ]
+    leases = [
+        DHCPLease(
+            iface="lln_bench",
+            expiry_time=0,
+            type=0,
+            mac_addr=mac,
+            ip_addr=f"10.{i >> 16 & 0xff}.{i >> 8 & 0xff}.{i & 0xff}",
+            prefix=8,
+            hostname=f"host{i}",
+            client_id=None,
+            iaid=None,
+        )
+        for i, mac in enumerate(macs)
+    ]
+    table = DHCPLeaseTable(leases)
+    lookups = random.choices(macs, k=1000)
+    return {
+        "leases.index.10000": _measure(lambda: DHCPLeaseTable(leases), ctx.iterations),
+        "leases.lookup.1000": _measure(
+            lambda: [table.ips_of(mac) for mac in lookups], ctx.iterations
+        ),
+    }
+
+
+def bench_type(ctx: _Context) -> dict:
+    class KeySink:
+        """Accepts keystrokes instantly, so only liblab's pacing is measured."""
+
+        def sendKey(self, codeset, holdtime, keycodes, nkeycodes, flags):
+            pass
+
+    text = "echo hello world && ls -la /tmp | grep liblab\n"
+    durations = []
+    for _ in range(max(1, ctx.iterations // 10)):
+        stats = liblab.keyboard.send_text(KeySink(), text, TypingProfile())
+        durations.append(stats.seconds)
+    result = _summarize(durations)
+    result["chars_per_second"] = len(text) / (sum(durations) / len(durations))
+
+    liblab.keyboard.compile_text.cache_clear()
+    compile_result = _measure(
+        lambda: (liblab.keyboard.compile_text.cache_clear(), liblab.keyboard.compile_text(text)),
+        ctx.iterations * 100,
+    )
+    return {"type.send_text": result, "type.compile_text": compile_result}
+
+
+BENCHMARKS = {
+    "vm": bench_vm,
+    "vnet": bench_vnet,
+    "fleet": bench_fleet,
+    "linked_clone": bench_linked_clone,
+    "xml": bench_xml,
+    "subnets": bench_subnets,
+    "leases": bench_leases,
+    "type": bench_type,
+}
+
+
+def run(hypervisor_uri="test:///default", iterations=20, only: list[str] | None = None) -> dict:
+    results = {}
+    prev_clones_dir = _BaseDisk._LINKED_CLONES_DIR
+
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        try:
+            _BaseDisk._LINKED_CLONES_DIR = tmp / "clones"
+            ctx = _Context(hypervisor_uri, iterations, tmp)
+            for name, bench in BENCHMARKS.items():
+                if only is None or name in only:
+                    print(f"Running {name}...", file=sys.stderr)
+                    results.update(bench(ctx))
+        finally:
+            _BaseDisk._LINKED_CLONES_DIR = prev_clones_dir
+
+    return {
+        "meta": {
+            "timestamp": time.time(),
+            "commit": _git_commit(),
+            "python": platform.python_version(),
+            "hypervisor_uri": hypervisor_uri,
+            "iterations": iterations,
+        },
+        "results": results,
+    }
+
+
+def compare(baseline: dict, current: dict, threshold: float) -> bool:
+    """Print the ratio of every measurement to the baseline, returns False if any regressed."""
+    ok = True
+    print(f"{'measurement':<40} {'baseline ms':>12} {'current ms':>12} {'ratio':>7}")
+    for name, result in current["results"].items():
+        base = baseline["results"].get(name)
+        if base is None:
+            continue
+        ratio = result["mean_ms"] / base["mean_ms"] if base["mean_ms"] else float("inf")
+        regressed = ratio > 1 + threshold
+        ok = ok and not regressed
+        print(
+            f"{name:<40} {base['mean_ms']:>12.3f} {result['mean_ms']:>12.3f} {ratio:>6.2f}x"
+            f"{'  REGRESSED' if regressed else ''}"
+        )
+    return ok
+
+
+def _git_commit() -> str | None:
+    try:
+        return sp.check_output(
+            ["git", "rev-parse", "HEAD"], cwd=Path(__file__).parent, text=True, stderr=sp.DEVNULL
+        ).strip()
+    except (OSError, sp.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--hypervisor-uri", default="test:///default")
+    parser.add_argument("--iterations", type=int, default=20)
+    parser.add_argument("--only", help=f"Comma separated benchmarks: {','.join(BENCHMARKS)}")
+    parser.add_argument("--output", help="Write the results to this JSON file")
+    parser.add_argument("--compare", help="Compare with the results of another version")
+    parser.add_argument("--threshold", type=float, default=0.2, help="Allowed slowdown (0.2=20%%)")
+    args = parser.parse_args()
+
+    only = args.only.split(",") if args.only else None
+    results = run(args.hypervisor_uri, args.iterations, only)
+    if args.output:
+        Path(args.output).write_text(json.dumps(results, indent=2))
+    else:
+        print(json.dumps(results, indent=2))
+
+    if args.compare:
+        baseline = json.loads(Path(args.compare).read_text())
+        if not compare(baseline, results, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
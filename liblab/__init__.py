@@ -1,5 +1,15 @@
 """VM and SDN framework for system tests."""
 
+from liblab.connections import *
+from liblab.console import *
 from liblab.disks import *
+from liblab.images import *
 from liblab.interfaces import *
+from liblab.keyboard import *
+from liblab.ocr import *
+from liblab.overlay import *
+from liblab.pool import *
+from liblab.screen import *
+from liblab.subnets import *
+from liblab.telemetry import *
 from liblab.vm import *
@@ -0,0 +1,176 @@
+"""asyncio front-end for `VM` and `VNet`"""
+
+import asyncio
+from typing import Callable, Generator
+
+from typing_extensions import Self
+
+from liblab import trace
+from liblab.subnets import SubnetAllocator
+from liblab.vm import VM, Device, DHCPLease, VNet
+
+
+async def _run_blocking(func, *args, **kwargs):
+    """
+    Run a blocking function (e.g. a libvirt call) in the event loop's executor.
+
+    Runs in a copy of the task's context, so its spans are children of the task's current span.
+    """
+    return await asyncio.to_thread(func, *args, **kwargs)
+
+
+async def _run_steps(steps: Generator, async_steps: dict[Callable, Callable] | None = None):
+    """
+    Run the blocking steps of a generator like `VM._create_steps` without blocking the event loop.
+
+    Steps are run in the executor, unless they have an async version in `async_steps`.
+    """
+    async_steps = async_steps or {}
+    send, value = steps.send, None
+    while True:
+        try:
+            step = send(value)
+        except StopIteration:
+            return
+        try:
+            if isinstance(step, (int, float)):
+                value = await asyncio.sleep(step)
+            elif step in async_steps:
+                value = await async_steps[step]()
+            else:
+                value = await _run_blocking(step)
+            send = steps.send
+        except BaseException as e:
+            send, value = steps.throw, e
+
+
+class AsyncVM:
+    """
+    A `VM` that is created, queried and destroyed without blocking the event loop.
+
+    Devices are created concurrently (linked clones use `asyncio.create_subprocess_exec`), and
+    libvirt calls are offloaded to the event loop's executor.
+
+    Example:
+        Create many machines from one event loop:
+
+            machines = await asyncio.gather(
+                *(AsyncVM.create([Disk('example.qcow2')]) for _ in range(100))
+            )
+            print(await machines[0].xml_desc())
+            await asyncio.gather(*(machine.destroy() for machine in machines))
+
+        The underlying `VM` is available for everything else:
+
+            SerialPort.of(machine.vm).pty
+    """
+
+    def __init__(self, vm: VM):
+        self.vm = vm
+
+    @classmethod
+    async def create(cls, components: list, hypervisor_uri="qemu:///system") -> Self:
+        """Create a machine, see `VM` for the arguments."""
+        machine = cls(VM(components, hypervisor_uri, create=False))
+        await machine._create()
+        return machine
+
+    @property
+    def name(self) -> str | None:
+        return self.vm.name
+
+    async def _create(self):
+        """Create the machine, and initialize all devices. Async version of `VM._create`."""
+        vm = self.vm
+        await _run_steps(vm._create_steps(), {vm._create_devices: self._create_devices})
+
+    async def _create_devices(self):
+        """Create the devices concurrently. Async version of `VM._create_devices`."""
+        vm = self.vm
+
+        async def create(device: Device):
+            with trace.span("device.create", device=type(device).__name__):
+                await device.create_async(vm._libvirt, vm.name, vm.components)
+
+        # Every device is done (created or failed) before any is rolled back
+        devices = Device.all_of(vm)
+        results = await asyncio.gather(
+            *(create(device) for device in devices), return_exceptions=True
+        )
+        errors = [result for result in results if isinstance(result, BaseException)]
+        if errors:
+            # Destroy the created (and partially created) devices off the event loop. The rollback
+            # of `VM._create_steps` destroys them again, which is a no-op once they're destroyed
+            await asyncio.gather(
+                *(_run_blocking(vm._destroy_device, device) for device in devices),
+                return_exceptions=True,
+            )
+            raise errors[0]
+
+    async def destroy(self):
+        """Destroy the machine and all devices."""
+        await _run_blocking(self.vm.destroy)
+
+    async def xml_desc(self) -> str:
+        """Get the live domain XML of the machine."""
+        return await _run_blocking(self.vm._dom.XMLDesc)
+
+    def __getitem__(self, key):
+        return self.vm[key]
+
+
+class AsyncVNet:
+    """
+    A `VNet` that is created, queried and destroyed without blocking the event loop.
+
+    Example:
+        Pass the underlying `VNet` to interfaces:
+
+            net = await AsyncVNet.create()
+            machine = await AsyncVM.create([Disk('example.qcow2'), Interface(net.vnet)])
+            print(await net.dhcp_leases())
+    """
+
+    def __init__(self, vnet: VNet):
+        self.vnet = vnet
+
+    @classmethod
+    async def create(
+        cls,
+        internet=False,
+        netboot_root=None,
+        netboot_file="pxelinux.0",
+        hypervisor_uri="qemu:///system",
+        lease_ttl=0.0,
+        subnets: SubnetAllocator | None = None,
+    ) -> Self:
+        """Create a network, see `VNet` for the arguments."""
+        net = cls(
+            VNet(
+                internet,
+                netboot_root,
+                netboot_file,
+                hypervisor_uri,
+                lease_ttl,
+                subnets,
+                create=False,
+            )
+        )
+        await net._create()
+        return net
+
+    @property
+    def name(self) -> str | None:
+        return self.vnet.name
+
+    async def _create(self):
+        """Create the network. Async version of `VNet._create`."""
+        await _run_steps(self.vnet._create_steps())
+
+    async def dhcp_leases(self) -> list[DHCPLease]:
+        """Get the DHCP leases on the network, see `VNet.dhcp_leases`."""
+        return await _run_blocking(lambda: self.vnet.dhcp_leases)
+
+    async def destroy(self):
+        """Destroy the network."""
+        await _run_blocking(self.vnet.destroy)
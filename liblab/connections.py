@@ -0,0 +1,130 @@
+"""Connections to hypervisors"""
+
+import contextlib
+import threading
+
+import libvirt
+
+_pools: dict[str, "ConnectionPool"] = {}
+_pools_lock = threading.Lock()
+
+_event_loop_started = False
+_event_loop_lock = threading.Lock()
+
+
+class ConnectionPool:
+    """
+    A pool of connections to one hypervisor, shared by all threads.
+
+    libvirt connections are thread-safe, but all calls on a connection go through its socket. The
+    pool hands out its `size` read-write connections round-robin, and its `read_only_size`
+    read-only connections (`openReadOnly`) for queries like DHCP leases and domain XML lookups, so
+    queries don't wait behind machines being created.
+
+    Connections send keepalives (through libvirt's event loop, which runs in a daemon thread), and
+    a dead connection (e.g. after libvirtd was restarted) is reopened when it's handed out next.
+    Objects looked up through a connection (domains, networks) stop working if it dies, so `VM`s
+    and `VNet`s look theirs up again (by UUID) on a live connection once theirs died.
+
+    Args:
+        uri: The hypervisor to connect to
+        size: How many read-write connections to open
+        read_only_size: How many read-only connections to open (0 to use read-write ones)
+        keepalive_interval: Seconds between keepalives (None to disable keepalives)
+        keepalive_count: How many keepalives may go unanswered before a connection is dead
+
+    Example:
+        Use more connections to a busy hypervisor, before creating machines on it:
+
+            connection_pool('qemu:///system', size=4, read_only_size=4)
+            machines = VM.create_many([[Disk('example.qcow2')] for _ in range(40)])
+    """
+
+    def __init__(
+        self,
+        uri: str,
+        size: int = 1,
+        read_only_size: int = 2,
+        keepalive_interval: int | None = 5,
+        keepalive_count: int = 3,
+    ):
+        assert size > 0, "A connection pool needs at least one read-write connection"
+        assert read_only_size >= 0, f"Invalid read-only pool size: {read_only_size}"
+        self.uri = uri
+        self._keepalive_interval = keepalive_interval
+        self._keepalive_count = keepalive_count
+
+        self._lock = threading.Lock()
+        # Connections (None until opened) and the index of the next one, by read-only-ness
+        self._connections: dict[bool, list[libvirt.virConnect | None]] = {
+            False: [None] * size,
+            True: [None] * read_only_size,
+        }
+        self._next = {False: 0, True: 0}
+
+    def get(self, read_only=False) -> libvirt.virConnect:
+        """Get a live connection, opening (or reopening) it if needed."""
+        if not self._connections[True]:
+            read_only = False
+
+        with self._lock:
+            connections = self._connections[read_only]
+            idx = self._next[read_only]
+            self._next[read_only] = (idx + 1) % len(connections)
+
+            conn = connections[idx]
+            if conn is None or not conn.isAlive():
+                if conn is not None:
+                    with contextlib.suppress(libvirt.libvirtError):
+                        conn.close()
+                conn = connections[idx] = self._open(read_only)
+            return conn
+
+    def close(self):
+        """Close all the connections of the pool (they're reopened on next use)."""
+        with self._lock:
+            for connections in self._connections.values():
+                for idx, conn in enumerate(connections):
+                    if conn is not None:
+                        with contextlib.suppress(libvirt.libvirtError):
+                            conn.close()
+                        connections[idx] = None
+
+    def _open(self, read_only: bool) -> libvirt.virConnect:
+        if self._keepalive_interval is not None:
+            _start_event_loop()
+
+        conn = libvirt.openReadOnly(self.uri) if read_only else libvirt.open(self.uri)
+        if self._keepalive_interval is not None:
+            # Only remote connections (including qemu:///system) support keepalives
+            with contextlib.suppress(libvirt.libvirtError):
+                conn.setKeepAlive(self._keepalive_interval, self._keepalive_count)
+        return conn
+
+
+def connection_pool(uri: str, **kwargs) -> ConnectionPool:
+    """
+    Get the shared `ConnectionPool` of a hypervisor, created with the given arguments on first use.
+    """
+    with _pools_lock:
+        if uri not in _pools:
+            _pools[uri] = ConnectionPool(uri, **kwargs)
+        else:
+            assert not kwargs, f"The connection pool of {uri} was already created"
+        return _pools[uri]
+
+
+def _start_event_loop():
+    """Run libvirt's default event loop in a daemon thread (needed for keepalives), once."""
+    global _event_loop_started
+    with _event_loop_lock:
+        if _event_loop_started:
+            return
+        libvirt.virEventRegisterDefaultImpl()
+        threading.Thread(target=_run_event_loop, name="libvirt-events", daemon=True).start()
+        _event_loop_started = True
+
+
+def _run_event_loop():
+    while True:
+        libvirt.virEventRunDefaultImpl()
@@ -0,0 +1,531 @@
+"""Interactive serial sessions"""
+
+import asyncio
+import contextlib
+import errno
+import gzip
+import os
+import queue
+import re
+import select
+import selectors
+import threading
+import time
+import tty
+from os import PathLike
+from pathlib import Path
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+class SerialSession:
+    """
+    A non-blocking, expect-style session on a serial port's PTY.
+
+    Output is kept in a bounded buffer, and `expect` only scans the output that arrived since it
+    last scanned for the same pattern (plus `window` bytes before it, for matches that span reads),
+    so it stays cheap however much the guest prints. Many sessions can be driven from one thread,
+    with `expect_all` / `run_all` or with asyncio (`expect_async`).
+
+    Args:
+        path: The PTY to open (see `SerialPort.session`)
+        prompt: Regex of the shell prompt, used by `run`
+        buffer_size: How many bytes of output to keep around
+        window: How many already scanned bytes to scan again, the longest match spanning reads
+        newline: What `send_line` ends lines with
+
+    Example:
+        Log in and run commands:
+
+            session = SerialPort.of(vm).session(prompt=rb'# $')
+            session.expect(rb'login: ', timeout=60)
+            session.send_line('root')
+            session.expect(session.prompt, timeout=10)
+
+            print(session.run('uname -a', timeout=10))
+
+        Run a command on many machines at once:
+
+            sessions = [SerialPort.of(vm).session(prompt=rb'# $') for vm in machines]
+            outputs = run_all({session: 'hostname' for session in sessions}, timeout=10)
+    """
+
+    _READ_SIZE = 64 * 1024
+
+    def __init__(
+        self,
+        path: str,
+        prompt: str | bytes | re.Pattern | None = None,
+        buffer_size: int = 1024 * 1024,
+        window: int = 4096,
+        newline: bytes = b"\r",
+    ):
+        self.path = path
+        self.prompt = None if prompt is None else _compile(prompt)
+        # The output between the end of the previous match and the start of the last match
+        self.before = b""
+
+        self._buffer_size = buffer_size
+        self._window = window
+        self._newline = newline
+        self._buffer = bytearray()
+        # Stream offsets of the start of the buffer, and of the end of the last match
+        self._buffer_start = 0
+        self._cursor = 0
+        # (pattern, stream offset) scanned up to by the last search
+        self._scanned: tuple[re.Pattern, int] | None = None
+        self._eof = False
+
+        self._fd = None
+        self._selector = selectors.DefaultSelector()
+        self._fd = os.open(path, os.O_RDWR | os.O_NOCTTY | os.O_NONBLOCK)
+        tty.setraw(self._fd)
+        self._selector.register(self._fd, selectors.EVENT_READ)
+
+    def fileno(self) -> int:
+        return self._fd
+
+    def send(self, data: str | bytes):
+        """Write data to the port."""
+        if isinstance(data, str):
+            data = data.encode()
+        view = memoryview(data)
+        while view:
+            try:
+                view = view[os.write(self._fd, view) :]
+            except BlockingIOError:
+                select.select([], [self._fd], [])
+
+    def send_line(self, line: str | bytes):
+        """Write a line to the port."""
+        if isinstance(line, str):
+            line = line.encode()
+        self.send(line + self._newline)
+
+    def expect(self, pattern: str | bytes | re.Pattern, timeout: float | None = None) -> re.Match:
+        """
+        Wait for output matching a regex, after the end of the previous match.
+
+        The match's offsets are relative to the scanned output, use its groups and `before`.
+
+        Raises:
+            TimeoutError: If nothing matched within `timeout` seconds
+            EOFError: If the port was closed (e.g. the machine was destroyed)
+        """
+        pattern = _compile(pattern)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            self._drain()
+            if (match := self._search(pattern)) is not None:
+                return match
+            if self._eof:
+                raise EOFError(f"{self.path} was closed")
+
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                raise TimeoutError(f"{pattern.pattern!r} didn't show up on {self.path}")
+            self._selector.select(remaining)
+
+    async def expect_async(
+        self, pattern: str | bytes | re.Pattern, timeout: float | None = None
+    ) -> re.Match:
+        """Like `expect`, but waits in the running event loop."""
+        pattern = _compile(pattern)
+        loop = asyncio.get_running_loop()
+        readable = asyncio.Event()
+        loop.add_reader(self._fd, readable.set)
+        try:
+            async with asyncio.timeout(timeout):
+                while True:
+                    self._drain()
+                    if (match := self._search(pattern)) is not None:
+                        return match
+                    if self._eof:
+                        raise EOFError(f"{self.path} was closed")
+                    readable.clear()
+                    await readable.wait()
+        finally:
+            loop.remove_reader(self._fd)
+
+    def run(self, command: str, timeout: float | None = None) -> str:
+        """Run a shell command, returns its output (without the echoed command and the prompt)."""
+        assert self.prompt is not None, "The session needs a prompt to run commands"
+        self.send_line(command)
+        self.expect(self.prompt, timeout)
+        return _command_output(command, self.before)
+
+    @property
+    def output(self) -> bytes:
+        """The buffered output (up to the last `buffer_size` bytes or more)."""
+        self._drain()
+        return bytes(self._buffer)
+
+    def close(self):
+        self._selector.close()
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def __del__(self):
+        self.close()
+
+    def _drain(self):
+        """Read everything that's available without blocking."""
+        while not self._eof:
+            try:
+                data = os.read(self._fd, SerialSession._READ_SIZE)
+            except BlockingIOError:
+                return
+            except OSError as e:
+                # The PTY returns EIO once QEMU closes its side
+                if e.errno != errno.EIO:
+                    raise
+                data = b""
+            if not data:
+                self._eof = True
+                return
+
+            self._buffer += data
+            # Trim in bulk, so trimming is amortized over many reads
+            if len(self._buffer) > 2 * self._buffer_size:
+                trim = len(self._buffer) - self._buffer_size
+                del self._buffer[:trim]
+                self._buffer_start += trim
+
+    def _search(self, pattern: re.Pattern) -> re.Match | None:
+        """Search the output that wasn't scanned for this pattern yet, consuming the match."""
+        end = self._buffer_start + len(self._buffer)
+        start = max(self._cursor, self._buffer_start)
+        if self._scanned is not None and self._scanned[0] is pattern:
+            start = max(start, self._scanned[1] - self._window)
+        self._scanned = (pattern, end)
+
+        data = bytes(self._buffer[start - self._buffer_start :])
+        match = pattern.search(data)
+        if match is None:
+            return None
+
+        before_start = max(self._cursor, self._buffer_start) - self._buffer_start
+        self.before = bytes(self._buffer[before_start : start - self._buffer_start])
+        self.before += data[: match.start()]
+        self._cursor = start + match.end()
+        self._scanned = None
+        return match
+
+
+def expect_all(
+    patterns: dict[SerialSession, str | bytes | re.Pattern], timeout: float | None = None
+) -> dict[SerialSession, re.Match]:
+    """
+    Wait for output matching a regex on each of the given sessions, from one thread.
+
+    Raises:
+        TimeoutError: If some session didn't match within `timeout` seconds
+        EOFError: If some session was closed
+    """
+    pending = {session: _compile(pattern) for session, pattern in patterns.items()}
+    matches = {}
+    deadline = None if timeout is None else time.monotonic() + timeout
+    with selectors.DefaultSelector() as selector:
+        for session in pending:
+            selector.register(session.fileno(), selectors.EVENT_READ, session)
+
+        ready = list(pending)
+        while True:
+            for session in ready:
+                session._drain()
+                if (match := session._search(pending[session])) is not None:
+                    matches[session] = match
+                    selector.unregister(session.fileno())
+                    del pending[session]
+                elif session._eof:
+                    raise EOFError(f"{session.path} was closed")
+            if not pending:
+                return matches
+
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                raise TimeoutError(f"No match on {', '.join(s.path for s in pending)}")
+            ready = [key.data for key, _ in selector.select(remaining)]
+
+
+def run_all(
+    commands: dict[SerialSession, str], timeout: float | None = None
+) -> dict[SerialSession, str]:
+    """Run a shell command on each of the given sessions at once, returns their outputs."""
+    for session, command in commands.items():
+        assert session.prompt is not None, "The sessions need a prompt to run commands"
+        session.send_line(command)
+    expect_all({session: session.prompt for session in commands}, timeout)
+    return {
+        session: _command_output(command, session.before) for session, command in commands.items()
+    }
+
+
+class SerialLogCollector:
+    """
+    Archives the serial output of many machines, from one thread.
+
+    Every `SerialPort` of the added machines is tailed through a single epoll selector, and its
+    output is written line by line, with a timestamp (seconds since the port was added), to a
+    compressed log per port. Memory use per port is bounded by the compressor and `max_line`.
+
+    Subscribers get the same lines as the logs, so tests can assert on output that's also being
+    archived. A port can only have one reader, so don't open a `SerialSession` on a collected port.
+
+    Args:
+        log_dir: Where to write the logs, named `<machine name>-<port index>.log.gz` (or `.zst`)
+        compression: "gzip", "zstd" (requires the `zstandard` package) or None
+        flush_interval: Seconds between flushes of the logs to disk
+        max_line: Split lines longer than this many bytes
+
+    Example:
+        Archive the console of every machine, and wait for one to boot:
+
+            collector = SerialLogCollector('/tmp/logs')
+            for vm in machines:
+                collector.add(vm)
+
+            lines = collector.subscribe(machines[0])
+            for timestamp, line in iter(lines.get, None):  # None once the machine is gone
+                if b'login:' in line:
+                    break
+
+            collector.close()
+    """
+
+    _READ_SIZE = 64 * 1024
+
+    def __init__(
+        self,
+        log_dir: str | PathLike,
+        compression: str | None = "gzip",
+        flush_interval: float = 5.0,
+        max_line: int = 64 * 1024,
+    ):
+        assert compression in ("gzip", "zstd", None), f"Unknown compression: {compression}"
+        if compression == "zstd":
+            assert zstandard is not None, "zstd compression requires the zstandard package"
+
+        self.log_dir = Path(log_dir)
+        self.log_dir.mkdir(parents=True, exist_ok=True)
+        self._compression = compression
+        self._flush_interval = flush_interval
+        self._max_line = max_line
+
+        self._lock = threading.Lock()
+        self._tails: dict[tuple[str, int], _LogTail] = {}
+        # Tails to start / stop tailing, handled by the collector thread
+        self._added: list[_LogTail] = []
+        self._removed: list[_LogTail] = []
+        self._closed = False
+
+        self._selector = selectors.DefaultSelector()
+        self._wakeup_r, self._wakeup_w = os.pipe2(os.O_NONBLOCK | os.O_CLOEXEC)
+        self._selector.register(self._wakeup_r, selectors.EVENT_READ)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def add(self, vm) -> list[Path]:
+        """Start collecting the serial ports of a machine, returns the paths of their logs."""
+        from liblab.interfaces import SerialPort
+
+        suffix = {"gzip": ".log.gz", "zstd": ".log.zst", None: ".log"}[self._compression]
+        paths = []
+        with self._lock:
+            assert not self._closed, "The collector is closed"
+            for port in SerialPort.all_of(vm):
+                key = (vm.name, port.idx_in_machine)
+                assert key not in self._tails, f"{vm.name} is already collected"
+                path = self.log_dir / f"{vm.name}-{port.idx_in_machine}{suffix}"
+                tail = _LogTail(port.pty, path, self._compression, self._max_line)
+                self._tails[key] = tail
+                self._added.append(tail)
+                paths.append(path)
+        os.write(self._wakeup_w, b"\0")
+        return paths
+
+    def remove(self, vm):
+        """Stop collecting the serial ports of a machine (collection stops when it's destroyed)."""
+        with self._lock:
+            for key in [key for key in self._tails if key[0] == vm.name]:
+                self._removed.append(self._tails.pop(key))
+        os.write(self._wakeup_w, b"\0")
+
+    def subscribe(self, vm, port_idx: int = 0, maxsize: int = 10000) -> queue.Queue:
+        """
+        Get the lines of a machine's serial port from now on, as `(timestamp, line)` tuples.
+
+        The queue gets `None` once the port is closed or removed. If the subscriber falls behind
+        by more than `maxsize` lines, the oldest lines are dropped (from the queue, not the log).
+        """
+        lines = queue.Queue(maxsize)
+        with self._lock:
+            tail = self._tails[(vm.name, port_idx)]
+            tail.subscribers = [*tail.subscribers, lines]
+        return lines
+
+    def unsubscribe(self, vm, lines: queue.Queue, port_idx: int = 0):
+        with self._lock:
+            tail = self._tails.get((vm.name, port_idx))
+            if tail is not None:
+                tail.subscribers = [q for q in tail.subscribers if q is not lines]
+
+    def close(self):
+        """Stop collecting, and finish writing all the logs."""
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+        os.write(self._wakeup_w, b"\0")
+        self._thread.join()
+        self._selector.close()
+        os.close(self._wakeup_r)
+        os.close(self._wakeup_w)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def _run(self):
+        last_flush = time.monotonic()
+        while True:
+            for key, _ in self._selector.select(self._flush_interval):
+                if key.fd == self._wakeup_r:
+                    while True:
+                        try:
+                            os.read(self._wakeup_r, 4096)
+                        except BlockingIOError:
+                            break
+                elif not key.data.read():
+                    # The machine is gone
+                    self._selector.unregister(key.fd)
+                    key.data.close()
+                    with self._lock:
+                        self._tails = {k: t for k, t in self._tails.items() if t is not key.data}
+
+            with self._lock:
+                added, self._added = self._added, []
+                removed, self._removed = self._removed, []
+                closed = self._closed
+                if closed:
+                    removed += self._tails.values()
+                    self._tails = {}
+            for tail in added:
+                self._selector.register(tail.fd, selectors.EVENT_READ, tail)
+            for tail in removed:
+                if tail.fd is not None:
+                    self._selector.unregister(tail.fd)
+                    tail.read()
+                    tail.close()
+            if closed:
+                return
+
+            if time.monotonic() - last_flush >= self._flush_interval:
+                last_flush = time.monotonic()
+                for key in list(self._selector.get_map().values()):
+                    if key.data is not None:
+                        key.data.flush()
+
+
+class _LogTail:
+    """The state of one port tailed by a `SerialLogCollector`."""
+
+    def __init__(self, pty_path: str, log_path: Path, compression: str | None, max_line: int):
+        self.subscribers: list[queue.Queue] = []
+        self._max_line = max_line
+        self._start = time.monotonic()
+        self._partial = b""
+        self._partial_time = 0.0
+
+        self.fd = os.open(pty_path, os.O_RDWR | os.O_NOCTTY | os.O_NONBLOCK)
+        tty.setraw(self.fd)
+        if compression == "gzip":
+            self._log = gzip.open(log_path, "wb")
+        elif compression == "zstd":
+            self._log = zstandard.ZstdCompressor().stream_writer(open(log_path, "wb"))
+        else:
+            self._log = open(log_path, "wb")
+
+    def read(self) -> bool:
+        """Read and log everything that's available, returns False once the port is closed."""
+        while True:
+            try:
+                data = os.read(self.fd, SerialLogCollector._READ_SIZE)
+            except BlockingIOError:
+                return True
+            except OSError as e:
+                # The PTY returns EIO once QEMU closes its side
+                if e.errno != errno.EIO:
+                    raise
+                data = b""
+            if not data:
+                return False
+
+            now = time.monotonic() - self._start
+            if not self._partial:
+                self._partial_time = now
+            *lines, rest = (self._partial + data).split(b"\n")
+            for i, line in enumerate(lines):
+                self._emit(self._partial_time if i == 0 else now, line.rstrip(b"\r"))
+            if lines:
+                self._partial_time = now
+            while len(rest) > self._max_line:
+                self._emit(self._partial_time, rest[: self._max_line])
+                rest = rest[self._max_line :]
+            self._partial = rest
+
+    def flush(self):
+        self._log.flush()
+
+    def close(self):
+        if self._partial:
+            self._emit(self._partial_time, self._partial)
+            self._partial = b""
+        for lines in self.subscribers:
+            _put_dropping_oldest(lines, None)
+        self._log.close()
+        os.close(self.fd)
+        self.fd = None
+
+    def _emit(self, timestamp: float, line: bytes):
+        self._log.write(b"[%12.6f] %s\n" % (timestamp, line))
+        for lines in self.subscribers:
+            _put_dropping_oldest(lines, (timestamp, line))
+
+
+def _compile(pattern: str | bytes | re.Pattern) -> re.Pattern:
+    if isinstance(pattern, re.Pattern):
+        return pattern
+    if isinstance(pattern, str):
+        pattern = pattern.encode()
+    return re.compile(pattern)
+
+
+def _command_output(command: str, before: bytes) -> str:
+    """The output of a command, without the echoed command line."""
+    output = before.decode(errors="replace").replace("\r\n", "\n")
+    if output.startswith(command):
+        output = output[len(command) :].lstrip("\r\n")
+    return output
+
+
+def _put_dropping_oldest(q: queue.Queue, item):
+    while True:
+        try:
+            q.put_nowait(item)
+            return
+        except queue.Full:
+            with contextlib.suppress(queue.Empty):
+                q.get_nowait()
@@ -1,12 +1,41 @@
 """Storage and images"""
 
+import asyncio
+import ctypes
+import dataclasses
+import fcntl
+import hashlib
+import json
+import math
+import mmap
 import os.path
+import re
 import shutil
 import string
+import struct
 import subprocess as sp
+import threading
+import time
+import xml.etree.ElementTree as ET
 from pathlib import Path
 
-from liblab.vm import Device
+from liblab import trace
+from liblab.vm import Device, _placeholder
+
+
+@dataclasses.dataclass
+class PrewarmReport:
+    """The result of `prewarm_image`."""
+
+    image_path: Path
+    # Size of the ranges that should be in the page cache
+    bytes_total: int
+    # How many of those bytes weren't in the page cache before (None if unknown)
+    bytes_cold: int | None
+    # Seconds spent reading the cold ranges (0 if the image was already warm)
+    duration_s: float
+    # Were the ranges taken from a boot trace (see `record_boot_trace`) or the whole image?
+    from_boot_trace: bool
 
 
 class _BaseDisk(Device):
@@ -17,24 +46,90 @@ class _BaseDisk(Device):
 
     If `expand_disk` is specified, the disk will be expanded to the specified size. Only supported
     for linked clones. The size is a string with an optional specifier (K/M/G/T) at the end.
+
+    Linked clones are created by writing the QCow2 overlay directly (no `qemu-img` process), and
+    fall back to `qemu-img` if that fails. Set `_BaseDisk._NATIVE_CLONES = False` to always use
+    `qemu-img`.
+
+    If `prewarm` is set, the base image is read into the page cache before the linked clone is
+    created (see `prewarm_image`), so many clones booting at once don't thrash the disk reading the
+    same clusters. The result is available in `prewarm_report`.
     """
 
     _LINKED_CLONES_DIR = Path("/tmp/liblab_disks")
+    _NATIVE_CLONES = True
     _BUS = None
 
-    def __init__(self, image_path, linked_clone=True, expand_disk: str | None = None, ident=None):
-        assert image_path.endswith(".qcow2"), "Images must be QCow2"
+    def __init__(
+        self,
+        image_path,
+        linked_clone=True,
+        expand_disk: str | None = None,
+        prewarm=False,
+        ident=None,
+    ):
+        assert os.fspath(image_path).endswith(".qcow2"), "Images must be QCow2"
         super().__init__(ident=ident)
         self.image_path: Path = Path(os.path.abspath(image_path))
         self._linked_clone = linked_clone
         self._expand_disk = expand_disk
+        self._prewarm = prewarm
+        self.prewarm_report: PrewarmReport | None = None
         self.idx_in_machine = None
         self.live_image_path: Path | None = None
 
+        # Images the live image is (indirectly) backed by, owned by this disk (see `VM.fork`)
+        self._backing_layers: list[Path] = []
+
     @staticmethod
     def _create_linked_clone(
         image_path: Path, clone_name: str, expand_disk: str | None = None
     ) -> Path:
+        with trace.span("disk.linked_clone", image=image_path.name):
+            clone_path, args = _BaseDisk._linked_clone_args(image_path, clone_name, expand_disk)
+            if not _BaseDisk._create_native_linked_clone(image_path, clone_path, expand_disk):
+                with trace.span("disk.qemu_img"):
+                    sp.check_call(args)
+
+        return clone_path
+
+    @staticmethod
+    async def _create_linked_clone_async(
+        image_path: Path, clone_name: str, expand_disk: str | None = None
+    ) -> Path:
+        clone_path, args = _BaseDisk._linked_clone_args(image_path, clone_name, expand_disk)
+        created = await asyncio.get_running_loop().run_in_executor(
+            None, _BaseDisk._create_native_linked_clone, image_path, clone_path, expand_disk
+        )
+        if not created:
+            proc = await asyncio.create_subprocess_exec(*args)
+            if await proc.wait() != 0:
+                raise sp.CalledProcessError(proc.returncode, args)
+
+        return clone_path
+
+    @staticmethod
+    def _create_native_linked_clone(
+        image_path: Path, clone_path: Path, expand_disk: str | None = None
+    ) -> bool:
+        """Write a QCow2 overlay of `image_path`, returns False if `qemu-img` should be used."""
+        if not _BaseDisk._NATIVE_CLONES:
+            return False
+
+        try:
+            size = _parse_size(expand_disk) if expand_disk is not None else None
+            _write_qcow2(clone_path, size, backing_path=image_path)
+        except (OSError, ValueError):
+            clone_path.unlink(missing_ok=True)
+            return False
+
+        return True
+
+    @staticmethod
+    def _linked_clone_args(
+        image_path: Path, clone_name: str, expand_disk: str | None = None
+    ) -> tuple[Path, list[str]]:
+        """Prepare for creating a linked clone, returns its path and the `qemu-img` command."""
         assert image_path.is_file(), f"Disk image not found: {image_path}"
         clone_path = _BaseDisk._LINKED_CLONES_DIR / clone_name
         assert (
@@ -55,9 +150,8 @@ class _BaseDisk(Device):
         ]
         if expand_disk is not None:
             args.append(expand_disk)
-        sp.check_call(args)
 
-        return clone_path
+        return clone_path, args
 
     def __str__(self):
         if self._linked_clone:
@@ -69,8 +163,10 @@ class _BaseDisk(Device):
             return f"{type(self).__name__}({str(self.image_path)!r})"
 
     def create(self, hypervisor, machine_name, components):
-        self.idx_in_machine = Disk.all_of(components).index(self)
+        self.idx_in_machine = _BaseDisk.all_of(components).index(self)
         if self._linked_clone:
+            if self._prewarm:
+                self.prewarm_report = prewarm_image(self.image_path)
             self.live_image_path = Disk._create_linked_clone(
                 self.image_path,
                 clone_name=f"{machine_name}-disk{self.idx_in_machine}.qcow2",
@@ -79,20 +175,49 @@ class _BaseDisk(Device):
         else:
             self.live_image_path = self.image_path
 
+    async def create_async(self, hypervisor, machine_name, components):
+        self.idx_in_machine = _BaseDisk.all_of(components).index(self)
+        if self._linked_clone:
+            if self._prewarm:
+                self.prewarm_report = await asyncio.get_running_loop().run_in_executor(
+                    None, prewarm_image, self.image_path
+                )
+            self.live_image_path = await Disk._create_linked_clone_async(
+                self.image_path,
+                clone_name=f"{machine_name}-disk{self.idx_in_machine}.qcow2",
+                expand_disk=self._expand_disk,
+            )
+        else:
+            self.live_image_path = self.image_path
+
     def destroy(self):
         if self._linked_clone and self.live_image_path and self.live_image_path.exists():
             self.live_image_path.unlink()
+        for layer in self._backing_layers:
+            layer.unlink(missing_ok=True)
+        self._backing_layers = []
+
+    def record_boot_trace(self) -> Path:
+        """Record which parts of the base image are hot, see `record_boot_trace`."""
+        return record_boot_trace(self.image_path)
+
+    def _spec(self) -> tuple:
+        image_path = str(self.image_path)
+        return (type(self).__qualname__, image_path, self._linked_clone, self._expand_disk)
 
-    def _to_xml(self):
+    def _template_values(self) -> dict[str, str]:
         assert self.live_image_path, "Please call `Disk.create` first"
-        return f"""
-        <disk type='file' device='disk'>
-            <driver name='qemu' type='qcow2'/>
-            <source file='{self.live_image_path}'/>
-            <target dev='sd{string.ascii_lowercase[self.idx_in_machine]}' bus='{self._BUS}'/>
-            <boot order="{self.idx_in_machine + 1}"/>
-        </disk>
-        """
+        return {f"disk{self.idx_in_machine}": str(self.live_image_path)}
+
+    def _to_element(self):
+        assert self.idx_in_machine < len(string.ascii_lowercase), "Too many disks"
+        disk = ET.Element("disk", type="file", device="disk")
+        ET.SubElement(disk, "driver", name="qemu", type="qcow2")
+        ET.SubElement(disk, "source", file=_placeholder(f"disk{self.idx_in_machine}"))
+        dev = f"sd{string.ascii_lowercase[self.idx_in_machine]}"
+        ET.SubElement(disk, "target", dev=dev, bus=self._BUS)
+        ET.SubElement(disk, "boot", order=str(self.idx_in_machine + 1))
+        return disk
 
 
 class VirtioDisk(_BaseDisk):
@@ -153,7 +278,8 @@ class NVRAMImage(Device):
             not clone_path.exists()
         ), f"Linked clone name conflict: {clone_path} (when creating clone of: {image_path})"
         NVRAMImage._LINKED_CLONES_DIR.mkdir(parents=True, exist_ok=True)
-        shutil.copy(image_path, clone_path)
+        with trace.span("nvram.linked_clone", image=image_path.name):
+            _reflink_or_copy(image_path, clone_path)
 
         return clone_path
 
@@ -178,8 +304,282 @@ class NVRAMImage(Device):
         if self._linked_clone and self.live_image_path and self.live_image_path.exists():
             self.live_image_path.unlink()
 
-    def _to_xml(self):
-        return ""
+    def _spec(self) -> tuple:
+        return ("NVRAMImage", str(self.image_path), self._linked_clone)
+
+    def _template_values(self) -> dict[str, str]:
+        # Referenced by `System`
+        return {"nvram": str(self.live_image_path)}
+
+    def _to_element(self):
+        return None
 
 
 Disk = VirtioDisk
+
+
+def prewarm_image(image_path: Path, min_resident=0.9) -> PrewarmReport:
+    """
+    Read the boot-critical parts of an image into the page cache.
+
+    The ranges to read come from the image's boot trace (see `record_boot_trace`), or the whole
+    image if it has none. Ranges are prefetched with `posix_fadvise(WILLNEED)` and then read, so
+    the image is warm when this returns.
+
+    This is done once per image per host: if at least `min_resident` of the ranges are already in
+    the page cache (checked with `mincore`), nothing is read. Concurrent calls for the same image
+    wait for the first one instead of reading it again.
+
+    Example:
+        Warm an image before booting a fleet of linked clones of it:
+
+            print(prewarm_image(Path('example.qcow2')))
+            machines = VM.create_many([[Disk('example.qcow2')] for _ in range(30)])
+    """
+    image_path = Path(os.path.abspath(image_path))
+    with _prewarm_lock(image_path):
+        size = image_path.stat().st_size
+        ranges = _load_boot_trace(image_path)
+        from_boot_trace = ranges is not None
+        if ranges is None:
+            ranges = [(0, size)]
+        bytes_total = sum(length for _, length in ranges)
+
+        bytes_cold = None
+        resident = _resident_pages(image_path)
+        if resident is not None:
+            cold_pages = 0
+            for offset, length in ranges:
+                pages = resident[offset // mmap.PAGESIZE : -(-(offset + length) // mmap.PAGESIZE)]
+                cold_pages += pages.count(0)
+            bytes_cold = min(bytes_total, cold_pages * mmap.PAGESIZE)
+            if bytes_cold <= (1 - min_resident) * bytes_total:
+                return PrewarmReport(image_path, bytes_total, bytes_cold, 0.0, from_boot_trace)
+
+        start = time.perf_counter()
+        fd = os.open(image_path, os.O_RDONLY)
+        try:
+            for offset, length in ranges:
+                os.posix_fadvise(fd, offset, length, os.POSIX_FADV_WILLNEED)
+
+            buf = bytearray(_PREWARM_CHUNK_SIZE)
+            for offset, length in ranges:
+                end = offset + length
+                while offset < end:
+                    read = os.preadv(fd, [memoryview(buf)[: end - offset]], offset)
+                    if read == 0:
+                        break
+                    offset += read
+        finally:
+            os.close(fd)
+
+        return PrewarmReport(
+            image_path, bytes_total, bytes_cold, time.perf_counter() - start, from_boot_trace
+        )
+
+
+def record_boot_trace(image_path: Path) -> Path:
+    """
+    Record the parts of an image that are in the page cache, as the hot ranges for `prewarm_image`.
+
+    Call this after booting a machine from the image with a cold page cache (e.g. after
+    `echo 1 > /proc/sys/vm/drop_caches`), so the trace contains what the boot read.
+
+    Returns:
+        The path of the recorded trace
+    """
+    image_path = Path(os.path.abspath(image_path))
+    resident = _resident_pages(image_path)
+    assert resident is not None, "mincore() is not available, can't record a boot trace"
+
+    ranges = []
+    for run in re.finditer(b"\x01+", resident):
+        offset = run.start() * mmap.PAGESIZE
+        end = run.end() * mmap.PAGESIZE
+        if ranges and offset - sum(ranges[-1]) <= _BOOT_TRACE_MERGE_GAP:
+            ranges[-1][1] = end - ranges[-1][0]
+        else:
+            ranges.append([offset, end - offset])
+
+    trace_path = _boot_trace_path(image_path)
+    trace_path.parent.mkdir(parents=True, exist_ok=True)
+    trace_path.write_text(json.dumps({"image_path": str(image_path), "ranges": ranges}))
+    return trace_path
+
+
+_PREWARM_CHUNK_SIZE = 1024 * 1024
+_BOOT_TRACE_MERGE_GAP = 64 * 1024
+_RESIDENT_BIT = bytes(b & 1 for b in range(256))
+_prewarm_locks: dict[Path, threading.Lock] = {}
+_prewarm_locks_lock = threading.Lock()
+
+
+def _prewarm_lock(image_path: Path) -> threading.Lock:
+    with _prewarm_locks_lock:
+        return _prewarm_locks.setdefault(image_path, threading.Lock())
+
+
+def _boot_trace_path(image_path: Path) -> Path:
+    """Boot traces are keyed on the image's identity, so they're dropped when it changes."""
+    stat = image_path.stat()
+    key = f"{image_path}:{stat.st_dev}:{stat.st_ino}:{stat.st_size}:{stat.st_mtime_ns}"
+    name = hashlib.sha256(key.encode()).hexdigest()[:32]
+    return _BaseDisk._LINKED_CLONES_DIR / "boot_traces" / f"{name}.json"
+
+
+def _load_boot_trace(image_path: Path) -> list[tuple[int, int]] | None:
+    try:
+        trace = json.loads(_boot_trace_path(image_path).read_text())
+    except FileNotFoundError:
+        return None
+    return [(offset, length) for offset, length in trace["ranges"]]
+
+
+def _resident_pages(path: Path) -> bytes | None:
+    """Get the page cache residency of a file, one byte per page (None if unavailable)."""
+    size = path.stat().st_size
+    if size == 0:
+        return b""
+
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        libc.mmap.restype = ctypes.c_void_p
+        libc.mmap.argtypes = [
+            ctypes.c_void_p,
+            ctypes.c_size_t,
+            ctypes.c_int,
+            ctypes.c_int,
+            ctypes.c_int,
+            ctypes.c_long,
+        ]
+        libc.munmap.argtypes = [ctypes.c_void_p, ctypes.c_size_t]
+        libc.mincore.argtypes = [ctypes.c_void_p, ctypes.c_size_t, ctypes.c_void_p]
+    except (OSError, AttributeError):
+        return None
+
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        addr = libc.mmap(None, size, mmap.PROT_READ, mmap.MAP_SHARED, fd, 0)
+        if addr in (None, ctypes.c_void_p(-1).value):
+            return None
+        try:
+            vec = (ctypes.c_ubyte * -(-size // mmap.PAGESIZE))()
+            if libc.mincore(addr, size, vec) != 0:
+                return None
+            return bytes(vec).translate(_RESIDENT_BIT)
+        finally:
+            libc.munmap(addr, size)
+    finally:
+        os.close(fd)
+
+
+_QCOW2_MAGIC = b"QFI\xfb"
+_QCOW2_HEADER = struct.Struct(">4sIQIIQIIQQIIQQQQII")
+_QCOW2_CLUSTER_BITS = 16
+_QCOW2_EXT_BACKING_FORMAT = 0xE2792ACA
+_FICLONE = 0x40049409
+
+
+def _parse_size(size: str) -> int:
+    """Parse a `qemu-img` style size (e.g. '512', '10G', '1.5T') into bytes."""
+    match = re.fullmatch(r"(\d+(?:\.\d+)?)([bkmgtpe]?)", size.strip(), re.IGNORECASE)
+    if not match:
+        raise ValueError(f"Invalid size: {size!r}")
+    number, suffix = match.groups()
+    size_bytes = float(number) * 1024 ** "bkmgtpe".index(suffix.lower() or "b")
+    if not size_bytes.is_integer() or size_bytes % 512:
+        raise ValueError(f"Size must be a whole number of 512 byte sectors: {size!r}")
+    return int(size_bytes)
+
+
+def _qcow2_virtual_size(path: Path) -> int:
+    """Read the virtual disk size from a QCow2 header."""
+    with open(path, "rb") as f:
+        header = f.read(_QCOW2_HEADER.size)
+    if not header.startswith(_QCOW2_MAGIC):
+        raise ValueError(f"Not a QCow2 image: {path}")
+    return struct.unpack_from(">Q", header, 24)[0]
+
+
+def _qcow2_backing_file(path: Path) -> str | None:
+    """Read the backing file name from a QCow2 header, if it has one."""
+    with open(path, "rb") as f:
+        header = f.read(_QCOW2_HEADER.size)
+        if not header.startswith(_QCOW2_MAGIC):
+            raise ValueError(f"Not a QCow2 image: {path}")
+        offset, size = struct.unpack_from(">QI", header, 8)
+        if not offset:
+            return None
+        f.seek(offset)
+        return f.read(size).decode()
+
+
+def _write_qcow2(path: Path, size: int | None, backing_path: Path | None = None):
+    """
+    Create an empty QCow2 (v3) image, optionally backed by another QCow2 image.
+
+    The size defaults to the size of the backing image. The layout matches `qemu-img create`:
+    the header (with a backing format extension and the backing file name), a refcount table,
+    a single refcount block and the L1 table, each in its own cluster.
+    """
+    if size is None:
+        assert backing_path is not None, "Size is required for images without a backing file"
+        size = _qcow2_virtual_size(backing_path)
+
+    cluster_size = 1 << _QCOW2_CLUSTER_BITS
+    l1_size = math.ceil(size / (cluster_size * (cluster_size // 8)))
+    l1_clusters = max(1, math.ceil(l1_size * 8 / cluster_size))
+    refcount_table_offset = cluster_size
+    refcount_block_offset = 2 * cluster_size
+    l1_table_offset = 3 * cluster_size
+    total_clusters = 3 + l1_clusters
+
+    extensions = b""
+    backing_file = b""
+    if backing_path is not None:
+        extensions += struct.pack(">II", _QCOW2_EXT_BACKING_FORMAT, len(b"qcow2"))
+        extensions += b"qcow2".ljust(8, b"\0")
+        backing_file = str(backing_path).encode()
+        if len(backing_file) > 1023:
+            raise ValueError(f"Backing file path too long: {backing_path}")
+    extensions += struct.pack(">II", 0, 0)  # End of header extensions
+    backing_file_offset = _QCOW2_HEADER.size + len(extensions) if backing_file else 0
+
+    header = _QCOW2_HEADER.pack(
+        _QCOW2_MAGIC,
+        3,  # version
+        backing_file_offset,
+        len(backing_file),
+        _QCOW2_CLUSTER_BITS,
+        size,
+        0,  # crypt_method
+        l1_size,
+        l1_table_offset,
+        refcount_table_offset,
+        1,  # refcount_table_clusters
+        0,  # nb_snapshots
+        0,  # snapshots_offset
+        0,  # incompatible_features
+        0,  # compatible_features
+        0,  # autoclear_features
+        4,  # refcount_order (16 bit refcounts)
+        _QCOW2_HEADER.size,
+    )
+
+    with open(path, "xb") as f:
+        f.write(header + extensions + backing_file)
+        f.seek(refcount_table_offset)
+        f.write(struct.pack(">Q", refcount_block_offset))
+        f.seek(refcount_block_offset)
+        f.write(struct.pack(f">{total_clusters}H", *([1] * total_clusters)))
+        f.truncate(total_clusters * cluster_size)
+
+
+def _reflink_or_copy(src: Path, dst: Path):
+    """Copy a file, sharing its extents (FICLONE) if the filesystem supports it."""
+    try:
+        with open(src, "rb") as src_file, open(dst, "wb") as dst_file:
+            fcntl.ioctl(dst_file.fileno(), _FICLONE, src_file.fileno())
+        shutil.copymode(src, dst)
+    except OSError:
+        shutil.copy(src, dst)
@@ -0,0 +1,216 @@
+"""Content-addressed store of base images"""
+
+import contextlib
+import fcntl
+import hashlib
+import json
+import os
+import subprocess as sp
+import time
+from pathlib import Path
+
+from liblab.disks import _BaseDisk, _qcow2_backing_file, _reflink_or_copy
+
+
+class ImageStore:
+    """
+    A content-addressed store of base images, shared by all linked clones on the host.
+
+    Images are stored by the SHA-256 of their content, so the same golden image copied to
+    different directories is stored (and cached by the kernel) once. Images are hashed without
+    holding the store's lock, and the hash of every added path is cached until the file changes
+    (or its stored images are evicted). An image is in use while any linked clone in
+    `_BaseDisk._LINKED_CLONES_DIR` is backed by it, and unused images are evicted
+    least-recently-used first whenever the store grows beyond its budget. Images returned by `add`
+    aren't evicted for `_PIN_SECONDS` (by any process), so there's time to create linked clones of
+    them.
+
+    Images can optionally be converted when they're added, to a compressed QCow2 or one with a
+    different cluster size. Images with a backing file must be converted (which flattens them).
+
+    Args:
+        root: Directory of the store (default: /tmp/liblab_images, next to the linked clones)
+        budget_bytes: Evict unused images while the store is larger than this (default: unlimited)
+
+    Example:
+        Create machines from the store instead of the original image:
+
+            store = ImageStore(budget_bytes=50 * 1024**3)
+            machine = VM([Disk(store.add('example.qcow2'))])
+
+        Store a compressed copy with large clusters:
+
+            Disk(store.add('example.qcow2', compress=True, cluster_size=2 * 1024**2))
+    """
+
+    _DEFAULT_ROOT = Path("/tmp/liblab_images")
+    _HASH_CHUNK_SIZE = 1024 * 1024
+    # How long images returned by `add` are safe from eviction
+    _PIN_SECONDS = 10 * 60
+
+    def __init__(self, root: Path | None = None, budget_bytes: int | None = None):
+        self.root = Path(root or ImageStore._DEFAULT_ROOT)
+        self._budget_bytes = budget_bytes
+        self._index_path = self.root / "index.json"
+        self.root.mkdir(parents=True, exist_ok=True)
+
+    def add(self, image_path, compress=False, cluster_size: int | None = None) -> Path:
+        """
+        Add an image to the store (unless it's already there), returns the stored image's path.
+
+        Args:
+            image_path: The QCow2 image to add
+            compress: Store a compressed QCow2 of the image
+            cluster_size: Store a QCow2 with the given cluster size
+        """
+        image_path = Path(os.path.abspath(image_path))
+        convert = compress or cluster_size is not None
+        assert convert or not _qcow2_backing_file(
+            image_path
+        ), f"Images with a backing file must be converted when stored: {image_path}"
+
+        stat = image_path.stat()
+        key = f"{stat.st_dev}:{stat.st_ino}:{stat.st_size}:{stat.st_mtime_ns}"
+        with self._locked_index() as index:
+            entry = index["hashes"].get(str(image_path))
+        if entry is not None and entry["key"] == key:
+            digest = entry["sha256"]
+        else:
+            # Outside the lock, hashing a large image takes a while
+            digest = self._digest(image_path)
+
+        name = digest
+        if compress:
+            name += "-compressed"
+        if cluster_size is not None:
+            name += f"-cluster{cluster_size}"
+        stored_path = self.root / f"{name}.qcow2"
+
+        with self._locked_index() as index:
+            index["hashes"][str(image_path)] = {"key": key, "sha256": digest}
+            stored = stored_path.exists()
+            if stored:
+                # Pin it before releasing the lock, another process might evict it otherwise
+                self._touch(index, stored_path, image_path)
+
+        if not stored:
+            tmp_path = self.root / f".{name}.{os.getpid()}.tmp"
+            try:
+                if convert:
+                    args = ["qemu-img", "convert", "-O", "qcow2"]
+                    if compress:
+                        args.append("-c")
+                    if cluster_size is not None:
+                        args += ["-o", f"cluster_size={cluster_size}"]
+                    sp.check_call(args + [str(image_path), str(tmp_path)])
+                else:
+                    _reflink_or_copy(image_path, tmp_path)
+                tmp_path.chmod(0o444)
+                tmp_path.replace(stored_path)
+            finally:
+                tmp_path.unlink(missing_ok=True)
+
+            with self._locked_index() as index:
+                self._touch(index, stored_path, image_path)
+        self.evict(keep=stored_path)
+
+        return stored_path
+
+    def references(self) -> dict[Path, int]:
+        """Count the linked clones (directly or indirectly) backed by each stored image."""
+        refs = {path: 0 for path in self.images()}
+        for clone_path in _BaseDisk._LINKED_CLONES_DIR.glob("*.qcow2"):
+            # Follow the backing chain, clones may be backed by other clones (see `VM.fork`)
+            path = clone_path
+            for _ in range(16):
+                try:
+                    backing_file = _qcow2_backing_file(path)
+                except (OSError, ValueError):
+                    break
+                if backing_file is None:
+                    break
+                path = Path(backing_file)
+                if path in refs:
+                    refs[path] += 1
+                    break
+        return refs
+
+    def images(self) -> list[Path]:
+        """List the stored images."""
+        return sorted(self.root.glob("*.qcow2"))
+
+    def size(self) -> int:
+        """The total size of the stored images, in bytes."""
+        return sum(path.stat().st_blocks * 512 for path in self.images())
+
+    def evict(self, keep: Path | None = None) -> list[Path]:
+        """Delete unused images, least recently used first, until the store is within budget."""
+        if self._budget_bytes is None:
+            return []
+
+        evicted = []
+        with self._locked_index() as index:
+            total = self.size()
+            if total <= self._budget_bytes:
+                return []
+
+            def last_used(path: Path) -> float:
+                # Images that were just stored might not be in the index yet
+                entry = index["images"].get(path.name)
+                return entry["last_used"] if entry else path.stat().st_mtime
+
+            pinned_since = time.time() - ImageStore._PIN_SECONDS
+            refs = self.references()
+            unused = [
+                path
+                for path, count in refs.items()
+                if count == 0 and path != keep and last_used(path) < pinned_since
+            ]
+            unused.sort(key=last_used)
+            for path in unused:
+                if total <= self._budget_bytes:
+                    break
+                total -= path.stat().st_blocks * 512
+                path.unlink()
+                index["images"].pop(path.name, None)
+                evicted.append(path)
+
+            if evicted:
+                # Forget the hashes of images that are no longer stored (by any variant)
+                digests = {path.stem.split("-")[0] for path in self.images()}
+                index["hashes"] = {
+                    source: entry
+                    for source, entry in index["hashes"].items()
+                    if entry["sha256"] in digests
+                }
+
+        return evicted
+
+    def _touch(self, index: dict, stored_path: Path, image_path: Path):
+        """Record that a stored image was just used, which also pins it (see `_PIN_SECONDS`)."""
+        index["images"][stored_path.name] = {"source": str(image_path), "last_used": time.time()}
+
+    @staticmethod
+    def _digest(image_path: Path) -> str:
+        """The SHA-256 of an image's content."""
+        sha256 = hashlib.sha256()
+        with open(image_path, "rb") as f:
+            while chunk := f.read(ImageStore._HASH_CHUNK_SIZE):
+                sha256.update(chunk)
+        return sha256.hexdigest()
+
+    @contextlib.contextmanager
+    def _locked_index(self):
+        """Lock the store (between processes too) and load its index, saving it on exit."""
+        with open(self.root / ".lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                index = json.loads(self._index_path.read_text())
+            except FileNotFoundError:
+                index = {"images": {}, "hashes": {}}
+
+            yield index
+
+            tmp_path = self._index_path.with_suffix(".tmp")
+            tmp_path.write_text(json.dumps(index))
+            tmp_path.replace(self._index_path)
@@ -1,8 +1,10 @@
 """Network and Serial interfaces"""
 
 import subprocess
+import time
 import xml.etree.ElementTree as ET
 
+from liblab.console import SerialSession
 from liblab.vm import Device, VNet
 
 
@@ -50,6 +52,9 @@ class SerialPort(Device):
         self.idx_in_machine = None
         self.path = None
 
+        # (domain xml, pty path) of the last resolution
+        self._pty = None
+
     @property
     def pty(self):
         """
@@ -64,11 +69,13 @@ class SerialPort(Device):
 
                 print(port.read(500).decode())
         """
-        dom = self._hypervisor.lookupByName(self._machine_name)
-        tree = ET.fromstring(dom.XMLDesc())
-        return tree.find(
-            f"./devices/serial/target[@port='{self.idx_in_machine}']/../source"
-        ).attrib["path"]
+        tree = self._domain_xml()
+        if self._pty is None or self._pty[0] is not tree:
+            path = tree.find(
+                f"./devices/serial/target[@port='{self.idx_in_machine}']/../source"
+            ).attrib["path"]
+            self._pty = (tree, path)
+        return self._pty[1]
 
     def create(self, hypervisor, machine_name, components):
         super().create(hypervisor, machine_name, components)
@@ -78,14 +85,18 @@ class SerialPort(Device):
     def console(self):
         subprocess.call(["picocom", self.pty])
 
-    def _to_xml(self):
-        return f"""
-        <serial type='pty'>
-            <target type='isa-serial' port='{self.idx_in_machine}'>
-                <model name='isa-serial'/>
-            </target>
-        </serial>
-        """
+    def session(self, **kwargs) -> SerialSession:
+        """Open an expect-style `SerialSession` on the port, see it for the arguments."""
+        return SerialSession(self.pty, **kwargs)
+
+    def _spec(self) -> tuple:
+        return ("SerialPort",)
+
+    def _to_element(self):
+        serial = ET.Element("serial", type="pty")
+        target = ET.SubElement(serial, "target", type="isa-serial", port=str(self.idx_in_machine))
+        ET.SubElement(target, "model", name="isa-serial")
+        return serial
 
 
 class _BaseInterface(Device):
@@ -98,47 +109,45 @@ class _BaseInterface(Device):
     _MODEL = None
 
     def __init__(self, net: VNet, ident=None, netboot=False):
-        assert type(net) is VNet, "`net` must be a VNet"
+        assert isinstance(net, VNet), "`net` must be a VNet"
         super().__init__(ident=ident)
         self.net: VNet = net
         self._netboot = netboot
 
-    def _to_xml(self):
-        return f"""
-        <interface type="network">
-            <source network="{self.net.name}"/>
-            <model type="{self._MODEL}"/>
-            {'<boot order="1"/>' if self._netboot else ''}
-        </interface>
-        """
+        # (domain xml, mac address) of the last resolution
+        self._mac_addr = None
+
+    def _spec(self) -> tuple:
+        return (type(self).__qualname__, self.net.name, self._netboot)
+
+    def _to_element(self):
+        interface = ET.Element("interface", type="network")
+        ET.SubElement(interface, "source", network=self.net.name)
+        ET.SubElement(interface, "model", type=self._MODEL)
+        if self._netboot:
+            ET.SubElement(interface, "boot", order="1")
+        return interface
 
     @property
     def mac_addr(self) -> str:
         """
-        The path to the PTY associated with this serial port.
+        The MAC address of the interface.
 
         Example:
-            Send some data to the port:
-
-                vm = VM([..., SerialPort()])
-                port = open(SerialPort.of(vm).pty, 'wb+', buffering=0)
-                port.write(b'ls -l /\\r\\n')
-
-                print(port.read(500).decode())
+            vm = VM([..., Interface(net)])
+            print(Interface.of(vm).mac_addr)  # => '52:54:00:12:34:56'
         """
-        dom = self._hypervisor.lookupByName(self._machine_name)
-        tree = ET.fromstring(dom.XMLDesc())
-        return tree.find(
-            f"./devices/interface[@type='network']/source[@network='{self.net.name}']/../mac"
-        ).attrib["address"]
+        tree = self._domain_xml()
+        if self._mac_addr is None or self._mac_addr[0] is not tree:
+            mac_addr = tree.find(
+                f"./devices/interface[@type='network']/source[@network='{self.net.name}']/../mac"
+            ).attrib["address"]
+            self._mac_addr = (tree, mac_addr)
+        return self._mac_addr[1]
 
     @property
     def ip_addrs(self) -> list[str]:
-        addrs = []
-        for lease in self.net.dhcp_leases:
-            if lease.mac_addr == self.mac_addr:
-                addrs.append(lease.ip_addr)
-        return addrs
+        return self.net.lease_table().ips_of(self.mac_addr)
 
     @property
     def ip_addr(self) -> str | None:
@@ -148,6 +157,25 @@ class _BaseInterface(Device):
         else:
             return None
 
+    def wait_for_ip(self, timeout: float | None = None) -> str:
+        """
+        Wait until the interface gets an IP address from its network's DHCP server.
+
+        Waiting doesn't poll libvirt per interface: all waiters on a network share one lease
+        poller. See `wait_for_ips` to wait for many interfaces at once.
+
+        Raises:
+            TimeoutError: If no address was leased within `timeout` seconds
+
+        Example:
+            Wait for a machine to boot and get an address:
+
+                machine = VM([Disk('example.qcow2'), Interface(VNet())])
+                print(Interface.of(machine).wait_for_ip(timeout=60))
+        """
+        mac_addr = self.mac_addr
+        return self.net.wait_for_ips([mac_addr], timeout)[mac_addr]
+
 
 class VirtioInterface(_BaseInterface):
     """
@@ -194,3 +222,32 @@ class E1000Interface(_BaseInterface):
 
 
 Interface = VirtioInterface
+
+
+def wait_for_ips(
+    interfaces: list[_BaseInterface], timeout: float | None = None
+) -> dict[_BaseInterface, str]:
+    """
+    Wait until all the given interfaces get an IP address.
+
+    Raises:
+        TimeoutError: If not all interfaces got an address within `timeout` seconds
+
+    Example:
+        Wait for a fleet of machines to get addresses:
+
+            machines = VM.create_many([[Disk('example.qcow2'), Interface(net)] for _ in range(20)])
+            addrs = wait_for_ips([Interface.of(machine) for machine in machines], timeout=60)
+    """
+    deadline = None if timeout is None else time.monotonic() + timeout
+
+    by_net: dict[VNet, dict[str, _BaseInterface]] = {}
+    for iface in interfaces:
+        by_net.setdefault(iface.net, {})[iface.mac_addr] = iface
+
+    result = {}
+    for net, by_mac in by_net.items():
+        remaining = None if deadline is None else max(0.0, deadline - time.monotonic())
+        for mac_addr, ip_addr in net.wait_for_ips(list(by_mac), remaining).items():
+            result[by_mac[mac_addr]] = ip_addr
+    return result
@@ -0,0 +1,137 @@
+"""Keystroke injection"""
+
+import dataclasses
+import functools
+import time
+
+import libvirt
+
+import liblab.keycodes
+
+
+@dataclasses.dataclass
+class TypingProfile:
+    """
+    How fast to type into a guest, tune per guest if keystrokes get dropped.
+
+    Every character is sent as a single chord (e.g. shift and a key), QEMU holds the chord for
+    `hold_ms` and queues chords behind each other, so typing is paced by the guest-side queue
+    rather than by sleeping between RPCs. The caller is only held back when it gets more than
+    `max_ahead` seconds ahead of the queue, and `VM.type` returns once the last chord was released.
+
+    When a `sendKey` call fails (e.g. the monitor is busy) the hold time and interval are doubled
+    (up to `max_hold_ms`) and the chord is retried, and they decay back after a run of successes.
+
+    Args:
+        hold_ms: How long each chord is held down
+        interval: Extra seconds to wait between chords (on top of the hold time)
+        newline_delay: Extra seconds to wait after every newline, for prompts to come back
+        max_ahead: How many seconds of keystrokes may be queued in QEMU at once
+        max_hold_ms: The upper limit for the adaptive hold time
+        retries: How many times to retry a failing chord before giving up
+    """
+
+    hold_ms: int = 10
+    interval: float = 0.0
+    newline_delay: float = 0.0
+    max_ahead: float = 1.0
+    max_hold_ms: int = 200
+    retries: int = 5
+
+
+@dataclasses.dataclass
+class TypingStats:
+    """The outcome of `VM.type`."""
+
+    chars: int
+    chords: int
+    seconds: float
+    retries: int
+    final_hold_ms: int
+
+    @property
+    def chars_per_second(self) -> float:
+        return self.chars / self.seconds if self.seconds else float("inf")
+
+
+@functools.lru_cache(maxsize=256)
+def compile_text(text: str) -> tuple[tuple[int, ...], ...]:
+    """
+    Compile text into chords, the keycodes (modifiers first) pressed together for each character.
+
+    Raises:
+        ValueError: If the text contains a character that can't be typed (see `liblab.keycodes`)
+    """
+    chords = []
+    for c in text:
+        if c in liblab.keycodes.shifted:
+            key = liblab.keycodes.keys[liblab.keycodes.shifted[c]]
+            chords.append((liblab.keycodes.KEY_LEFTSHIFT, key))
+        elif c.islower() and c.upper() in liblab.keycodes.keys:
+            chords.append((liblab.keycodes.keys[c.upper()],))
+        elif c in liblab.keycodes.keys:
+            chords.append((liblab.keycodes.keys[c],))
+        else:
+            raise ValueError(f"Can't type {c!r}, it's not in liblab.keycodes")
+    return tuple(chords)
+
+
+def send_text(dom: libvirt.virDomain, text: str, profile: TypingProfile) -> TypingStats:
+    """Type text into a domain, see `VM.type`."""
+    chords = compile_text(text)
+    enter = (liblab.keycodes.keys["\n"],)
+    hold_ms = profile.hold_ms
+    interval = profile.interval
+    retries = 0
+    streak = 0
+
+    start = time.perf_counter()
+    # When QEMU will be done with the chords queued so far
+    queue_done = start
+    for chord in chords:
+        # One call per chord: all the keycodes of a `sendKey` call are pressed together, so a call
+        # can't carry a sequence of chords (QEMU's queue pipelines the calls instead)
+        for attempt in range(profile.retries + 1):
+            try:
+                dom.sendKey(libvirt.VIR_KEYCODE_SET_LINUX, hold_ms, list(chord), len(chord), 0)
+                break
+            except libvirt.libvirtError:
+                if attempt == profile.retries:
+                    raise
+                retries += 1
+                streak = 0
+                hold_ms = min(hold_ms * 2, profile.max_hold_ms)
+                interval = max(interval * 2, hold_ms / 1000)
+                time.sleep(interval)
+
+        streak += 1
+        if streak >= 8 and (hold_ms > profile.hold_ms or interval > profile.interval):
+            # Decay back towards the profile after a run of successful chords
+            streak = 0
+            hold_ms = max(hold_ms // 2, profile.hold_ms)
+            # Snap back once the extra interval is too short to matter, so chords are queued again
+            interval = (
+                interval / 2 if interval / 2 - profile.interval > 0.001 else profile.interval
+            )
+
+        now = time.perf_counter()
+        # QEMU presses the chord, waits the hold time and releases it before the next one
+        queue_done = max(queue_done, now) + hold_ms / 1000 + interval
+        if chord == enter:
+            queue_done += profile.newline_delay
+
+        ahead = queue_done - now
+        if interval or (chord == enter and profile.newline_delay):
+            # Delays only happen between chords if the next one isn't queued yet
+            time.sleep(ahead)
+        elif ahead > profile.max_ahead:
+            time.sleep(ahead - profile.max_ahead)
+
+    time.sleep(max(0.0, queue_done - time.perf_counter()))
+    return TypingStats(
+        chars=len(text),
+        chords=len(chords),
+        seconds=time.perf_counter() - start,
+        retries=retries,
+        final_hold_ms=hold_ms,
+    )
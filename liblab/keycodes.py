@@ -1,8 +1,8 @@
-# Very partial mapping of keys to keycodes for the linux input subsystem.
+# Partial mapping of keys to keycodes for the linux input subsystem (US layout).
 # Source: man virkeycode-linux(7)
 keys = {
     # "": 0x0,  # KEY_RESERVED
-    # "": 0x1,  # KEY_ESC
+    "\x1b": 0x1,  # KEY_ESC
     "1": 0x2,  # KEY_1
     "2": 0x3,  # KEY_2
     "3": 0x4,  # KEY_3
@@ -13,10 +13,10 @@ keys = {
     "8": 0x9,  # KEY_8
     "9": 0xA,  # KEY_9
     "0": 0xB,  # KEY_0
-    # "": 0xc,  # KEY_MINUS
-    # "": 0xd,  # KEY_EQUAL
-    # "": 0xe,  # KEY_BACKSPACE
-    # "": 0xf,  # KEY_TAB
+    "-": 0xC,  # KEY_MINUS
+    "=": 0xD,  # KEY_EQUAL
+    "\b": 0xE,  # KEY_BACKSPACE
+    "\t": 0xF,  # KEY_TAB
     "Q": 0x10,  # KEY_Q
     "W": 0x11,  # KEY_W
     "E": 0x12,  # KEY_E
@@ -27,8 +27,8 @@ keys = {
     "I": 0x17,  # KEY_I
     "O": 0x18,  # KEY_O
     "P": 0x19,  # KEY_P
-    # "": 0x1a,  # KEY_LEFTBRACE
-    # "": 0x1b,  # KEY_RIGHTBRACE
+    "[": 0x1A,  # KEY_LEFTBRACE
+    "]": 0x1B,  # KEY_RIGHTBRACE
     "\n": 0x1C,  # KEY_ENTER
     # "": 0x1d,  # KEY_LEFTCTRL
     "A": 0x1E,  # KEY_A
@@ -40,11 +40,11 @@ keys = {
     "J": 0x24,  # KEY_J
     "K": 0x25,  # KEY_K
     "L": 0x26,  # KEY_L
-    # "": 0x27,  # KEY_SEMICOLON
-    # "": 0x28,  # KEY_APOSTROPHE
-    # "": 0x29,  # KEY_GRAVE
+    ";": 0x27,  # KEY_SEMICOLON
+    "'": 0x28,  # KEY_APOSTROPHE
+    "`": 0x29,  # KEY_GRAVE
     # "": 0x2a,  # KEY_LEFTSHIFT
-    # "": 0x2b,  # KEY_BACKSLASH
+    "\\": 0x2B,  # KEY_BACKSLASH
     "Z": 0x2C,  # KEY_Z
     "X": 0x2D,  # KEY_X
     "C": 0x2E,  # KEY_C
@@ -52,13 +52,13 @@ keys = {
     "B": 0x30,  # KEY_B
     "N": 0x31,  # KEY_N
     "M": 0x32,  # KEY_M
-    # "": 0x33,  # KEY_COMMA
-    # "": 0x34,  # KEY_DOT
-    # "": 0x35,  # KEY_SLASH
+    ",": 0x33,  # KEY_COMMA
+    ".": 0x34,  # KEY_DOT
+    "/": 0x35,  # KEY_SLASH
     # "": 0x36,  # KEY_RIGHTSHIFT
     # "": 0x37,  # KEY_KPASTERISK
     # "": 0x38,  # KEY_LEFTALT
-    # "": 0x39,  # KEY_SPACE
+    " ": 0x39,  # KEY_SPACE
     # "": 0x3a,  # KEY_CAPSLOCK
     # "": 0x3b,  # KEY_F1
     # "": 0x3c,  # KEY_F2
@@ -456,3 +456,32 @@ keys = {
     # "": 0x20b,  # KEY_NUMERIC_POUND
     # "": 0x20c,  # KEY_RFKILL
 }
+
+KEY_LEFTSHIFT = 0x2A
+
+# Characters typed by holding shift, mapped to the key (in `keys`) that types them (US layout).
+# Lowercase letters are typed with the unshifted letter key.
+shifted = {
+    "!": "1",
+    "@": "2",
+    "#": "3",
+    "$": "4",
+    "%": "5",
+    "^": "6",
+    "&": "7",
+    "*": "8",
+    "(": "9",
+    ")": "0",
+    "_": "-",
+    "+": "=",
+    "{": "[",
+    "}": "]",
+    ":": ";",
+    '"': "'",
+    "~": "`",
+    "|": "\\",
+    "<": ",",
+    ">": ".",
+    "?": "/",
+    **{letter: letter for letter in "ABCDEFGHIJKLMNOPQRSTUVWXYZ"},
+}
@@ -0,0 +1,170 @@
+"""Host network configuration over rtnetlink"""
+
+import errno
+import ipaddress
+import json
+import os
+import socket
+import struct
+import subprocess as sp
+
+# Set to False to always use `ip` (e.g. to compare, see benchmarks/bench_netlink.py)
+_NATIVE = True
+
+_NETLINK_ROUTE = 0
+_RTM_NEWLINK = 16
+_RTM_GETLINK = 18
+_RTM_GETROUTE = 26
+_NLM_F_REQUEST = 0x1
+_NLM_F_ACK = 0x4
+_NLM_F_DUMP = 0x300
+_NLMSG_ERROR = 2
+_NLMSG_DONE = 3
+_IFLA_MASTER = 10
+_RTA_DST = 1
+_RTA_TABLE = 15
+_RT_TABLE_MAIN = 254
+_IFF_UP = 0x1
+_NLA_TYPE_MASK = 0x3FFF
+_RECV_SIZE = 1 << 16
+
+_NLMSG_HEADER = struct.Struct("=IHHII")
+_IFINFOMSG = struct.Struct("=BxHiII")
+_RTMSG = struct.Struct("=BBBBBBBBI")
+_RTATTR = struct.Struct("=HH")
+
+
+class NetlinkError(OSError):
+    """An error reported by the kernel for a netlink request."""
+
+
+class _Unavailable(Exception):
+    """Netlink sockets can't be used (e.g. blocked by seccomp), use `ip` instead."""
+
+
+def routes() -> list[ipaddress.IPv4Network]:
+    """The destinations of the host's IPv4 routes (main table, except the default route)."""
+    if _NATIVE:
+        try:
+            return _netlink_routes()
+        except _Unavailable:
+            pass
+
+    destinations = []
+    for route in json.loads(sp.check_output(["ip", "--json", "-4", "route"])):
+        if route["dst"] != "default":
+            destinations.append(ipaddress.IPv4Network(route["dst"], strict=False))
+    return destinations
+
+
+def set_master(iface: str, bridge: str):
+    """Add an interface to a bridge (`ip link set dev <iface> master <bridge>`)."""
+    if _NATIVE:
+        try:
+            link = _IFINFOMSG.pack(socket.AF_UNSPEC, 0, _index(iface), 0, 0)
+            master = _RTATTR.pack(_RTATTR.size + 4, _IFLA_MASTER)
+            _request(_RTM_NEWLINK, link + master + struct.pack("=I", _index(bridge)))
+            return
+        except _Unavailable:
+            pass
+
+    sp.check_call(["ip", "link", "set", "dev", iface, "master", bridge])
+
+
+def set_link_up(iface: str, up=True):
+    """Bring an interface up or down (`ip link set dev <iface> up/down`)."""
+    if _NATIVE:
+        try:
+            flags = _IFF_UP if up else 0
+            _request(
+                _RTM_NEWLINK, _IFINFOMSG.pack(socket.AF_UNSPEC, 0, _index(iface), flags, _IFF_UP)
+            )
+            return
+        except _Unavailable:
+            pass
+
+    sp.check_call(["ip", "link", "set", "dev", iface, "up" if up else "down"])
+
+
+def link_is_up(iface: str) -> bool:
+    """Whether an interface is administratively up."""
+    if _NATIVE:
+        try:
+            payload = _IFINFOMSG.pack(socket.AF_UNSPEC, 0, _index(iface), 0, 0)
+            ((_msg_type, body),) = _request(_RTM_GETLINK, payload)
+            _family, _type, _index_, flags, _change = _IFINFOMSG.unpack_from(body)
+            return bool(flags & _IFF_UP)
+        except _Unavailable:
+            pass
+
+    (link,) = json.loads(sp.check_output(["ip", "--json", "link", "show", "dev", iface]))
+    return "UP" in link["flags"]
+
+
+def _netlink_routes() -> list[ipaddress.IPv4Network]:
+    destinations = []
+    payload = _RTMSG.pack(socket.AF_INET, 0, 0, 0, 0, 0, 0, 0, 0)
+    for _msg_type, body in _request(_RTM_GETROUTE, payload, dump=True):
+        family, dst_len, _src_len, _tos, table, *_ = _RTMSG.unpack_from(body)
+        attrs = _parse_attrs(body, _RTMSG.size)
+        if _RTA_TABLE in attrs:
+            (table,) = struct.unpack("=I", attrs[_RTA_TABLE])
+        if family != socket.AF_INET or table != _RT_TABLE_MAIN or dst_len == 0:
+            continue
+        dst = ipaddress.IPv4Address(attrs.get(_RTA_DST, bytes(4)))
+        destinations.append(ipaddress.IPv4Network((dst, dst_len)))
+    return destinations
+
+
+def _index(iface: str) -> int:
+    try:
+        return socket.if_nametoindex(iface)
+    except OSError:
+        raise NetlinkError(errno.ENODEV, f"No such device: {iface}") from None
+
+
+def _request(msg_type: int, payload: bytes, dump=False) -> list[tuple[int, bytes]]:
+    """Send a request on a new rtnetlink socket, returns the replies (type and body)."""
+    flags = _NLM_F_REQUEST | (_NLM_F_DUMP if dump else _NLM_F_ACK)
+    try:
+        sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, _NETLINK_ROUTE)
+        sock.bind((0, 0))
+    except OSError as e:
+        raise _Unavailable() from e
+
+    with sock:
+        header = _NLMSG_HEADER.pack(_NLMSG_HEADER.size + len(payload), msg_type, flags, 1, 0)
+        sock.send(header + payload)
+
+        replies = []
+        while True:
+            data = sock.recv(_RECV_SIZE)
+            offset = 0
+            while offset + _NLMSG_HEADER.size <= len(data):
+                length, reply_type, _flags, _seq, _pid = _NLMSG_HEADER.unpack_from(data, offset)
+                body = data[offset + _NLMSG_HEADER.size : offset + length]
+                offset += _align(length)
+
+                if reply_type == _NLMSG_DONE:
+                    return replies
+                if reply_type == _NLMSG_ERROR:
+                    (error,) = struct.unpack_from("=i", body)
+                    if error:
+                        raise NetlinkError(-error, os.strerror(-error))
+                    return replies
+                replies.append((reply_type, body))
+
+
+def _parse_attrs(data: bytes, offset: int) -> dict[int, bytes]:
+    attrs = {}
+    while offset + _RTATTR.size <= len(data):
+        length, attr_type = _RTATTR.unpack_from(data, offset)
+        if length < _RTATTR.size:
+            break
+        attrs[attr_type & _NLA_TYPE_MASK] = data[offset + _RTATTR.size : offset + length]
+        offset += _align(length)
+    return attrs
+
+
+def _align(length: int) -> int:
+    return (length + 3) & ~3
@@ -0,0 +1,313 @@
+"""Reading text-mode screens"""
+
+import gzip
+import os
+import re
+import struct
+import time
+from os import PathLike
+
+import libvirt
+from typing_extensions import Self
+
+import liblab.screen
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+_PSF1_MAGIC = b"\x36\x04"
+_PSF1_MODE_512 = 0x01
+_PSF1_MODE_HAS_TABLE = 0x06
+_PSF2_MAGIC = b"\x72\xb5\x4a\x86"
+_PSF2_HEADER = struct.Struct("<4sIIIIIII")
+_PSF2_HAS_UNICODE_TABLE = 0x01
+
+# Where distributions install the VGA console font (kbd / console-setup)
+_DEFAULT_FONT_PATHS = [
+    "/usr/share/kbd/consolefonts/default8x16.psfu.gz",
+    "/usr/lib/kbd/consolefonts/default8x16.psfu.gz",
+    "/usr/share/consolefonts/Lat15-VGA16.psf.gz",
+    "/usr/share/consolefonts/default8x16.psf.gz",
+]
+
+
+class BitmapFont:
+    """
+    An 8 pixel wide bitmap font, indexed by glyph bitmap for recognising text on the screen.
+
+    Glyphs are looked up by their exact bitmap first (a dict lookup), then by the nearest bitmap
+    (the fewest differing pixels, over all glyphs at once).
+
+    Args:
+        glyphs: The bitmaps of the glyphs, a (count, height, 8) boolean array
+        chars: The character of every glyph (glyphs of unprintable characters are skipped)
+
+    Example:
+        Load a font from the host:
+
+            font = BitmapFont.from_psf('/usr/share/consolefonts/Lat15-Terminus16.psf.gz')
+    """
+
+    def __init__(self, glyphs: "np.ndarray", chars: list[str]):
+        assert np is not None, "Reading the screen requires numpy"
+        assert glyphs.ndim == 3 and glyphs.shape[2] == 8, "Glyphs must be 8 pixels wide"
+        assert len(glyphs) == len(chars), "Every glyph needs a character"
+        self.height = glyphs.shape[1]
+        # Packed glyph bitmap (a byte per row) -> character, the first glyph of a bitmap wins
+        self._index: dict[bytes, str] = {}
+        # The packed bitmaps and characters of `_index`, for nearest glyph lookups
+        self._bitmaps = None
+        self._chars = None
+
+        for bitmap, char in zip(np.packbits(glyphs, axis=-1)[..., 0], chars):
+            if char.isprintable():
+                self._index.setdefault(bitmap.tobytes(), char)
+        self._index[bytes(self.height)] = " "
+
+    @classmethod
+    def from_psf(cls, path: str | PathLike) -> Self:
+        """Load a PSF (version 1 or 2, optionally gzipped) console font."""
+        with open(path, "rb") as f:
+            data = f.read()
+        if data[:2] == b"\x1f\x8b":
+            data = gzip.decompress(data)
+
+        if data.startswith(_PSF1_MAGIC):
+            mode, height = data[2], data[3]
+            count = 512 if mode & _PSF1_MODE_512 else 256
+            glyphs_start, glyph_size, width = 4, height, 8
+            has_table = mode & _PSF1_MODE_HAS_TABLE
+        elif data.startswith(_PSF2_MAGIC):
+            _magic, _version, glyphs_start, flags, count, glyph_size, height, width = (
+                _PSF2_HEADER.unpack_from(data)
+            )
+            has_table = flags & _PSF2_HAS_UNICODE_TABLE
+        else:
+            raise ValueError(f"Not a PSF font: {path}")
+        assert width <= 8, f"Only fonts up to 8 pixels wide are supported: {path}"
+
+        glyphs_end = glyphs_start + count * glyph_size
+        rows = np.frombuffer(data, np.uint8, count * glyph_size, glyphs_start)
+        glyphs = np.unpackbits(rows.reshape(count, height, 1), axis=-1).astype(bool)
+
+        if not has_table:
+            chars = [bytes([idx]).decode("cp437") if idx < 256 else "" for idx in range(count)]
+        elif data.startswith(_PSF1_MAGIC):
+            chars = _psf1_chars(data[glyphs_end:], count)
+        else:
+            chars = _psf2_chars(data[glyphs_end:], count)
+        return cls(glyphs, chars)
+
+    @classmethod
+    def default(cls) -> Self:
+        """
+        Load the VGA console font installed on the host (by kbd or console-setup).
+
+        Raises:
+            FileNotFoundError: If no font was found
+        """
+        for path in _DEFAULT_FONT_PATHS:
+            if os.path.exists(path):
+                return cls.from_psf(path)
+        raise FileNotFoundError(
+            "No VGA console font found, load one with `BitmapFont.from_psf` or teach a"
+            " `ScreenReader` with `learn`"
+        )
+
+    @classmethod
+    def empty(cls, height=16) -> Self:
+        """A font without glyphs (besides space), to teach with `ScreenReader.learn`."""
+        return cls(np.zeros((0, height, 8), bool), [])
+
+    def add(self, bitmap: bytes, char: str):
+        """Add (or replace) the character of a packed glyph bitmap (a byte per row)."""
+        assert len(bitmap) == self.height, f"Glyphs of this font are {self.height} rows high"
+        self._index[bitmap] = char
+        self._bitmaps = None
+
+    def recognise(self, bitmap: bytes, max_distance=8) -> str | None:
+        """
+        The character of a packed glyph bitmap, or None if no glyph is within `max_distance`
+        differing pixels. Inverted bitmaps (e.g. glyphs that cover most of their cell) match too.
+        """
+        if (char := self._index.get(bitmap)) is not None:
+            return char
+        inverted = bytes(row ^ 0xFF for row in bitmap)
+        if (char := self._index.get(inverted)) is not None:
+            return char
+
+        if self._bitmaps is None:
+            self._bitmaps = np.frombuffer(b"".join(self._index), np.uint8).reshape(-1, self.height)
+            self._chars = list(self._index.values())
+        rows = np.frombuffer(bitmap, np.uint8)
+        distances = np.unpackbits(self._bitmaps ^ rows, axis=-1).sum(axis=-1, dtype=np.int32)
+        idx = int(np.argmin(distances))
+        return self._chars[idx] if distances[idx] <= max_distance else None
+
+
+class ScreenReader:
+    """
+    Reads the text on a VGA text-mode screen (e.g. a BIOS, a bootloader or a Linux console).
+
+    A screenshot is split into cells (e.g. 80x25 cells of 9x16 pixels), and every cell is hashed
+    (a vectorized multilinear hash of its pixels). Cells that didn't change since the previous
+    screenshot keep their character, changed cells are looked up by hash in a cache of recognised
+    cells, and only cells never seen before are recognised: binarised (the colour of most of the
+    cell is the background) and looked up in the font's glyph index.
+
+    Args:
+        font: The font on the screen (default: the host's VGA font, see `BitmapFont.default`)
+        columns: How many columns of text are on the screen (usually 80)
+        max_distance: How many pixels of a cell may differ from the nearest glyph, cells that
+            match no glyph read as "\\ufffd"
+        cache_size: How many recognised cells to cache
+
+    Example:
+        Read a screen:
+
+            reader = ScreenReader()
+            print('\\n'.join(reader.read(machine.screenshot())))
+
+        Teach a reader the font of a screen with known text, when no font is available:
+
+            reader = ScreenReader(BitmapFont.empty())
+            reader.learn(machine.screenshot(), ['SeaBIOS (version 1.16.3)', ...])
+    """
+
+    def __init__(
+        self, font: BitmapFont | None = None, columns=80, max_distance=8, cache_size=4096
+    ):
+        self.font = font
+        self.columns = columns
+        self._max_distance = max_distance
+        self._cache_size = cache_size
+
+        # Cell hash -> character
+        self._cache: dict[int, str] = {}
+        self._multipliers = None
+        # The previous screenshot, its cell hashes and its text
+        self._image = None
+        self._hashes = None
+        self._lines: list[list[str]] = []
+
+    def read(self, image: "np.ndarray") -> list[str]:
+        """Read the text on a screenshot (see `VM.screenshot`), returns its lines."""
+        if self._image is not None and np.array_equal(image, self._image):
+            return ["".join(line) for line in self._lines]
+        self._image = image
+
+        cells, hashes = self._cells(image)
+        if self._hashes is None or self._hashes.shape != hashes.shape:
+            changed = np.ones(hashes.shape, bool)
+            self._lines = [[" "] * hashes.shape[1] for _ in range(hashes.shape[0])]
+        else:
+            changed = hashes != self._hashes
+        self._hashes = hashes
+
+        for row, col in zip(*np.nonzero(changed)):
+            cell_hash = int(hashes[row, col])
+            char = self._cache.get(cell_hash)
+            if char is None:
+                char = self.font.recognise(_bitmap(cells[row, col]), self._max_distance)
+                char = "\ufffd" if char is None else char
+                if len(self._cache) >= self._cache_size:
+                    self._cache.clear()
+                self._cache[cell_hash] = char
+            self._lines[row][col] = char
+
+        return ["".join(line) for line in self._lines]
+
+    def learn(self, image: "np.ndarray", lines: list[str]):
+        """Add the glyphs of a screenshot to the font, given the text on it."""
+        if self.font is None:
+            self.font = BitmapFont.empty()
+        cells, _hashes = self._cells(image)
+        for row, line in enumerate(lines):
+            for col, char in enumerate(line):
+                if char != " ":
+                    self.font.add(_bitmap(cells[row, col]), char)
+
+        # Cells might have been recognised differently
+        self._cache.clear()
+        self._image = None
+        self._hashes = None
+
+    def _cells(self, image: "np.ndarray") -> tuple["np.ndarray", "np.ndarray"]:
+        """Split a screenshot into (rows, columns, height, width, 3) cells, and hash them."""
+        assert np is not None, "Reading the screen requires numpy"
+        if self.font is None:
+            self.font = BitmapFont.default()
+
+        height, width, channels = image.shape
+        cell_height = self.font.height
+        assert (
+            width % self.columns == 0 and height % cell_height == 0
+        ), f"A {width}x{height} screen doesn't fit {self.columns} columns of the font"
+        cell_width = width // self.columns
+        shape = (height // cell_height, cell_height, self.columns, cell_width, channels)
+        cells = np.ascontiguousarray(image.reshape(shape).swapaxes(1, 2))
+
+        cell_size = cell_height * cell_width * channels
+        if self._multipliers is None or len(self._multipliers) != cell_size:
+            rng = np.random.default_rng()
+            self._multipliers = rng.integers(0, 2**63, cell_size, np.uint64) * 2 + 1
+        hashes = cells.reshape(shape[0], self.columns, cell_size) @ self._multipliers
+        return cells, hashes
+
+
+def wait_for_text(
+    dom: libvirt.virDomain,
+    reader: ScreenReader,
+    pattern: str | re.Pattern,
+    timeout: float | None = None,
+    interval=0.05,
+) -> re.Match:
+    """Wait until the text on the screen of a domain matches a regex, see `VM.wait_for_text`."""
+    if isinstance(pattern, str):
+        pattern = re.compile(pattern, re.MULTILINE)
+    deadline = None if timeout is None else time.monotonic() + timeout
+    prev_text = None
+    while True:
+        text = "\n".join(reader.read(liblab.screen.screenshot(dom)))
+        if text != prev_text and (match := pattern.search(text)) is not None:
+            return match
+        prev_text = text
+
+        remaining = None if deadline is None else deadline - time.monotonic()
+        if remaining is not None and remaining <= 0:
+            raise TimeoutError(f"{pattern.pattern!r} didn't show up on the screen")
+        time.sleep(interval if remaining is None else min(interval, remaining))
+
+
+def _bitmap(cell: "np.ndarray") -> bytes:
+    """Binarise a cell (the colour of most of it is the background), returns its packed glyph."""
+    # The 9th column of VGA cells is a copy of the 8th or blank, glyphs are 8 pixels wide
+    colors = cell[:, :8].astype(np.uint32) @ np.array([1 << 16, 1 << 8, 1], np.uint32)
+    is_first = colors == colors[0, 0]
+    ink = ~is_first if is_first.sum() * 2 >= is_first.size else is_first
+    return np.packbits(ink, axis=-1)[:, 0].tobytes()
+
+
+def _psf1_chars(table: bytes, count: int) -> list[str]:
+    """The first character of every glyph, from a PSF1 unicode table (UCS-2, 0xFFFF separated)."""
+    chars = []
+    entries = np.frombuffer(table[: len(table) // 2 * 2], "<u2")
+    start = 0
+    for end in np.flatnonzero(entries == 0xFFFF)[:count]:
+        # 0xFFFE starts sequences of combining characters
+        first = entries[start] if start < end else 0xFFFE
+        chars.append(chr(first) if first != 0xFFFE else "")
+        start = end + 1
+    return chars + [""] * (count - len(chars))
+
+
+def _psf2_chars(table: bytes, count: int) -> list[str]:
+    """The first character of every glyph, from a PSF2 unicode table (UTF-8, 0xFF separated)."""
+    chars = []
+    for entry in table.split(b"\xff")[:count]:
+        # 0xFE starts sequences of combining characters
+        text = entry.split(b"\xfe")[0].decode("utf-8", "replace")
+        chars.append(text[0] if text else "")
+    return chars + [""] * (count - len(chars))
@@ -0,0 +1,176 @@
+"""Networks spanning several hypervisors"""
+
+import contextlib
+import ipaddress
+import random
+import xml.etree.ElementTree as ET
+
+import libvirt
+
+from liblab import netlink
+from liblab.vm import VNet, _get_hypervisor, _is_remote, _run_on_host
+
+_DNSMASQ_NS = "http://libvirt.org/schemas/network/dnsmasq/1.0"
+ET.register_namespace("dnsmasq", _DNSMASQ_NS)
+
+
+class DistributedVNet(VNet):
+    """
+    A `VNet` spanning several hypervisors, stitched together with VXLAN or GRE tunnels.
+
+    The network is created on `hypervisor_uri` (its owner) like any `VNet`, which picks its subnet
+    and runs its DHCP server (and netboot / internet access). Every other host gets a bridge-only
+    network with the same name, so machines connect to it the same way on every host, and the
+    bridges are connected by tunnels between the hosts' `addresses`:
+
+    - VXLAN: one VXLAN device per host that floods to every other host (a full mesh, which doesn't
+      loop since a bridge never forwards back out of the port a frame came from)
+    - GRE: a GRE tap between every host and the owner (a star, since a mesh of taps would loop)
+
+    Guests see the same flat network whichever host they're on. The MTU of the network is lowered
+    by the tunnel's overhead, and handed out over DHCP so guests don't send oversized packets.
+
+    Tunnels are set up with `ip` and `bridge` on every host, over SSH for remote hypervisors (e.g.
+    `qemu+ssh://root@b/system`), which requires root there.
+
+    Args:
+        addresses: The underlay IP of every host, by hypervisor URI (including `hypervisor_uri`)
+        tunnel: "vxlan" or "gre"
+        vni: The VXLAN network identifier (or GRE key), random by default
+        mtu: The MTU of the network (1500 minus the tunnel's overhead by default)
+        hypervisor_uri: The owner of the network (`qemu:///system` by default)
+        kwargs: Passed to `VNet`
+
+    Example:
+        Machines on two hosts sharing a network:
+
+            hosts = {'qemu:///system': '192.168.1.10', 'qemu+ssh://root@b/system': '192.168.1.11'}
+            net = DistributedVNet(hosts)
+            vm1 = VM([Disk('example.qcow2'), Interface(net)])
+            vm2 = VM([Disk('example.qcow2'), Interface(net)], 'qemu+ssh://root@b/system')
+    """
+
+    _TUNNEL_OVERHEAD = {"vxlan": 50, "gre": 38}
+    _VXLAN_PORT = 4789
+
+    def __init__(
+        self,
+        addresses: dict[str, str],
+        tunnel="vxlan",
+        vni: int | None = None,
+        mtu: int | None = None,
+        hypervisor_uri="qemu:///system",
+        create=True,
+        **kwargs,
+    ):
+        # The bridge-only networks on the other hosts, and the tunnel devices by host
+        self._peer_nets: dict[str, libvirt.virNetwork] = {}
+        self._tunnel_devices: list[tuple[str, str]] = []
+        super().__init__(hypervisor_uri=hypervisor_uri, create=False, **kwargs)
+
+        assert tunnel in DistributedVNet._TUNNEL_OVERHEAD, f"Unknown tunnel type: {tunnel}"
+        assert hypervisor_uri in addresses, "The owner of the network needs an address too"
+        self.addresses = dict(addresses)
+        self.tunnel = tunnel
+        self.vni = vni if vni is not None else random.randint(1, 2**24 - 1)
+        self.mtu = mtu or 1500 - DistributedVNet._TUNNEL_OVERHEAD[tunnel]
+
+        if create:
+            self._create()
+
+    @property
+    def hypervisor_uris(self) -> list[str]:
+        return list(self.addresses)
+
+    def _create(self):
+        super()._create()
+        if self._refcount != 1:
+            return
+
+        try:
+            for uri in self.addresses:
+                if uri != self._hypervisor_uri:
+                    xml = self._peer_xml()
+                    self._peer_nets[uri] = _get_hypervisor(uri).networkCreateXML(xml)
+            self._create_tunnels()
+        except Exception:
+            self._destroy_overlay()
+            super().destroy()
+            raise
+
+    def _to_xml(self, subnet: ipaddress.IPv4Network):
+        network = ET.fromstring(super()._to_xml(subnet))
+        ET.SubElement(network, "mtu", size=str(self.mtu))
+        # Tell guests about the MTU too (DHCP option 26)
+        ET.SubElement(
+            network.find(f"{{{_DNSMASQ_NS}}}options"),
+            f"{{{_DNSMASQ_NS}}}option",
+            value=f"dhcp-option=26,{self.mtu}",
+        )
+        return ET.tostring(network, encoding="unicode")
+
+    def _peer_xml(self) -> str:
+        """A network on another host: just the bridge, the owner handles addresses."""
+        network = ET.Element("network")
+        ET.SubElement(network, "name").text = self.name
+        ET.SubElement(network, "bridge", name=self.name, stp="off", delay="0")
+        ET.SubElement(network, "mtu", size=str(self.mtu))
+        return ET.tostring(network, encoding="unicode")
+
+    def _create_tunnels(self):
+        # Device names must fit in 15 characters, the network's name is 'lln_xxxxxxxx'
+        suffix = self.name[3:]
+        if self.tunnel == "vxlan":
+            for uri, address in self.addresses.items():
+                device = f"llt{suffix}"
+                self._add_tunnel_device(
+                    uri,
+                    device,
+                    ["type", "vxlan", "id", str(self.vni), "local", address]
+                    + ["dstport", str(DistributedVNet._VXLAN_PORT)],
+                )
+                # Flood broadcasts and unknown destinations to every other host
+                for peer_uri, peer_address in self.addresses.items():
+                    if peer_uri != uri:
+                        _run_on_host(
+                            uri,
+                            ["bridge", "fdb", "append", "00:00:00:00:00:00"]
+                            + ["dev", device, "dst", peer_address],
+                        )
+        else:
+            owner = self._hypervisor_uri
+            peers = [uri for uri in self.addresses if uri != owner]
+            for idx, peer in enumerate(peers):
+                ends = [(owner, peer, f"llt{idx}{suffix}"), (peer, owner, f"llt{suffix}")]
+                for uri, remote, device in ends:
+                    self._add_tunnel_device(
+                        uri,
+                        device,
+                        ["type", "gretap", "local", self.addresses[uri]]
+                        + ["remote", self.addresses[remote], "key", str(self.vni)],
+                    )
+
+    def _add_tunnel_device(self, uri: str, device: str, link_args: list[str]):
+        _run_on_host(uri, ["ip", "link", "add", device, "mtu", str(self.mtu), *link_args])
+        self._tunnel_devices.append((uri, device))
+        if _is_remote(uri):
+            _run_on_host(uri, ["ip", "link", "set", "dev", device, "up"])
+        else:
+            netlink.set_link_up(device)
+        self.attach_interface(device, hypervisor_uri=uri)
+
+    def _destroy_overlay(self):
+        for uri, device in reversed(self._tunnel_devices):
+            _run_on_host(uri, ["ip", "link", "del", device], check=False)
+        self._tunnel_devices = []
+
+        for net in self._peer_nets.values():
+            with contextlib.suppress(libvirt.libvirtError):
+                net.destroy()
+        self._peer_nets = {}
+
+    def destroy(self):
+        # The network is destroyed by the same condition as in `VNet.destroy`
+        if self._refcount != 0 and self._refcount <= 2:
+            self._destroy_overlay()
+        super().destroy()
@@ -0,0 +1,223 @@
+"""Pools of pre-booted machines"""
+
+import collections
+import contextlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable
+
+import libvirt
+
+from liblab.vm import VM, Component, System
+
+
+class VMPool:
+    """
+    Keeps machines booted to a ready state, so they can be checked out instantly.
+
+    Every machine in the pool is booted once, brought to a ready state by `ready` (e.g. waiting
+    for an IP address or a login prompt), and then snapshotted (an internal snapshot of its RAM and
+    linked clones). Checking a machine out hands over the running domain as is, and checking it
+    back in reverts it to the ready snapshot in the background and returns it to the pool. Checked
+    out machines still belong to the pool, a new machine is only booted to replace one that
+    couldn't be reverted.
+
+    Internal snapshots require QCow2 disks only, so machines with an `NVRAMImage` can't be pooled.
+
+    Args:
+        components_factory: Called (from a worker thread) to make the components of each new
+            machine (`Component`s can't be shared between machines)
+        size: How many machines the pool has, including checked out ones. Checking out a machine
+            when all of them are checked out waits for one to be checked in
+        ready: Called with every new machine, should block until the machine is ready
+        max_idle_ram_mib: Limits the total RAM of idle (and booting) machines (default: unlimited).
+            New machines are assumed to take as much RAM as the last one, until their components
+            are made
+        workers: How many machines are booted or reverted at once
+        hypervisor_uri: The hypervisor to create the VMs in (`qemu:///system` by default)
+
+    Example:
+        Check out machines that already have an IP address:
+
+            net = VNet()
+            pool = VMPool(
+                lambda: [Disk('example.qcow2'), Interface(net)],
+                size=4,
+                ready=lambda vm: Interface.of(vm).wait_for_ip(timeout=120),
+            )
+
+            with pool.machine() as vm:
+                print(Interface.of(vm).ip_addr)
+
+            pool.close()
+    """
+
+    _SNAPSHOT_NAME = "liblab-ready"
+
+    def __init__(
+        self,
+        components_factory: Callable[[], list[Component]],
+        size: int,
+        ready: Callable[[VM], None] | None = None,
+        max_idle_ram_mib: int | None = None,
+        workers: int = 4,
+        hypervisor_uri="qemu:///system",
+    ):
+        self._components_factory = components_factory
+        self._size = size
+        self._ready = ready
+        self._max_idle_ram_mib = max_idle_ram_mib
+        self._hypervisor_uri = hypervisor_uri
+
+        self._cond = threading.Condition()
+        self._idle: collections.deque[VM] = collections.deque()
+        self._checked_out: set[VM] = set()
+        self._pending_ram_mib: list[int] = []
+        # The RAM of the last machine made, None until the first one is made
+        self._ram_mib_estimate: int | None = None
+        self._error: Exception | None = None
+        self._closed = False
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+
+        with self._cond:
+            self._fill()
+
+    @property
+    def idle_count(self) -> int:
+        """The number of machines ready to be checked out."""
+        return len(self._idle)
+
+    def checkout(self, timeout: float | None = None) -> VM:
+        """
+        Take a ready machine out of the pool, waiting for one if none is ready yet.
+
+        Raises:
+            TimeoutError: If no machine got ready within `timeout` seconds
+        """
+        with self._cond:
+            self._fill()
+            ready = self._cond.wait_for(
+                lambda: self._idle or self._closed or (self._error and not self._pending_ram_mib),
+                timeout,
+            )
+            assert not self._closed, "The pool is closed"
+            if not ready:
+                raise TimeoutError("No machine got ready in time")
+            if not self._idle:
+                raise self._error
+
+            vm = self._idle.popleft()
+            self._checked_out.add(vm)
+            return vm
+
+    def checkin(self, vm: VM):
+        """Return a machine to the pool, it's reverted to its ready state in the background."""
+        with self._cond:
+            self._checked_out.remove(vm)
+            if self._closed:
+                vm.destroy()
+                return
+            self._pending_ram_mib.append(System.of(vm).ram_mib)
+            self._executor.submit(self._recycle, vm)
+
+    @contextlib.contextmanager
+    def machine(self, timeout: float | None = None):
+        """Check out a machine for the duration of a `with` block."""
+        vm = self.checkout(timeout)
+        try:
+            yield vm
+        finally:
+            self.checkin(vm)
+
+    def close(self):
+        """Destroy all the machines of the pool, including checked out ones."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._executor.shutdown(wait=True, cancel_futures=True)
+
+        with self._cond:
+            for vm in [*self._idle, *self._checked_out]:
+                vm.destroy()
+            self._idle.clear()
+            self._checked_out.clear()
+
+    def _has_room(self, ram_mib: int) -> bool:
+        """Can another (not yet pending) machine be added? Call with the lock held."""
+        if len(self._idle) + len(self._pending_ram_mib) + len(self._checked_out) >= self._size:
+            return False
+        if self._max_idle_ram_mib is not None:
+            idle_ram_mib = sum(System.of(vm).ram_mib for vm in self._idle)
+            used_ram_mib = idle_ram_mib + sum(self._pending_ram_mib)
+            if used_ram_mib + ram_mib > self._max_idle_ram_mib:
+                return False
+        return True
+
+    def _fill(self):
+        """Boot machines until the pool is full or out of RAM budget. Call with the lock held."""
+        ram_mib = self._ram_mib_estimate or 0
+        while not self._closed and self._has_room(ram_mib):
+            if self._ram_mib_estimate is None and self._pending_ram_mib:
+                # Boot one machine at a time until it's known how much RAM they take
+                break
+            self._pending_ram_mib.append(ram_mib)
+            self._executor.submit(self._boot, ram_mib)
+
+    def _boot(self, ram_mib: int):
+        vm = None
+        try:
+            components = self._components_factory()
+            with self._cond:
+                # Account for the actual RAM of the machine instead of the estimate
+                self._pending_ram_mib.remove(ram_mib)
+                ram_mib = self._ram_mib_estimate = (System.of(components) or System()).ram_mib
+                self._pending_ram_mib.append(ram_mib)
+                self._fill()
+
+            vm = VM(components, self._hypervisor_uri)
+            if self._ready:
+                self._ready(vm)
+            vm._dom.snapshotCreateXML(
+                f"<domainsnapshot><name>{VMPool._SNAPSHOT_NAME}</name></domainsnapshot>"
+            )
+        except Exception as e:
+            if vm is not None:
+                vm.destroy()
+            with self._cond:
+                self._pending_ram_mib.remove(ram_mib)
+                self._error = e
+                self._cond.notify_all()
+            return
+
+        self._add_idle(vm, ram_mib)
+
+    def _recycle(self, vm: VM):
+        ram_mib = System.of(vm).ram_mib
+        try:
+            snapshot = vm._dom.snapshotLookupByName(VMPool._SNAPSHOT_NAME)
+            vm._dom.revertToSnapshot(snapshot, libvirt.VIR_DOMAIN_SNAPSHOT_REVERT_RUNNING)
+            vm.invalidate_xml()
+        except libvirt.libvirtError:
+            # Replace the machine with a freshly booted one
+            vm.destroy()
+            with self._cond:
+                self._pending_ram_mib.remove(ram_mib)
+                self._fill()
+            return
+
+        self._add_idle(vm, ram_mib)
+
+    def _add_idle(self, vm: VM, ram_mib: int):
+        with self._cond:
+            self._pending_ram_mib.remove(ram_mib)
+            if self._closed or not self._has_room(ram_mib):
+                vm.destroy()
+                return
+            self._error = None
+            self._idle.append(vm)
+            self._cond.notify_all()
+
+    def __del__(self):
+        # `__init__` might have failed before the executor was created
+        if getattr(self, "_executor", None) is not None:
+            self.close()
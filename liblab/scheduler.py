@@ -0,0 +1,317 @@
+"""Placing machines across hypervisors"""
+
+import collections
+import dataclasses
+import threading
+import time
+import xml.etree.ElementTree as ET
+from typing import Callable
+
+import libvirt
+
+from liblab.interfaces import _BaseInterface
+from liblab.vm import VM, Component, System, VNet, _get_hypervisor
+
+
+@dataclasses.dataclass
+class HostCapacity:
+    """The capacity of a hypervisor, as seen by a `Scheduler`."""
+
+    uri: str
+    ram_mib: int
+    cpu_count: int
+    # Memory and vCPUs of the running machines, plus placed machines that aren't running yet
+    committed_ram_mib: int
+    committed_vcpus: int
+    domain_count: int
+    # The host's free memory (`getFreeMemory`), minus placed machines that aren't running yet
+    free_memory_mib: int
+    # The networks on the host (by name)
+    networks: set[str] = dataclasses.field(default_factory=set)
+    # The UUIDs of the running machines
+    domains: set[str] = dataclasses.field(default_factory=set)
+    # How many machines on the host connect to each network (by name)
+    network_machines: collections.Counter[str] = dataclasses.field(
+        default_factory=collections.Counter
+    )
+
+    def free_ram_mib(self, overcommit=1.0) -> float:
+        """The RAM left to commit to machines, at most the host's actual free memory."""
+        return min(self.ram_mib * overcommit - self.committed_ram_mib, self.free_memory_mib)
+
+    def free_vcpus(self, overcommit=1.0) -> float:
+        return self.cpu_count * overcommit - self.committed_vcpus
+
+
+# Scores a host that fits the machine, the host with the lowest score gets it
+Policy = Callable[[HostCapacity, list[Component]], float]
+
+
+def bin_pack(host: HostCapacity, components: list[Component]) -> float:
+    """Fill hosts one by one: prefer the host with the least free RAM."""
+    return host.free_ram_mib()
+
+
+def spread(host: HostCapacity, components: list[Component]) -> float:
+    """Spread machines evenly: prefer the host with the most free RAM."""
+    return -host.free_ram_mib()
+
+
+def affinity(fallback: Policy = bin_pack) -> Policy:
+    """
+    Prefer hosts running the most machines on the machine's networks, then use `fallback`.
+
+    Co-locates machines that talk to each other, e.g. so their traffic doesn't cross the tunnels of
+    a `DistributedVNet`. Hosts that don't have one of the networks are never picked anyway.
+    """
+
+    def policy(host: HostCapacity, components: list[Component]) -> float:
+        nets = {iface.net.name for iface in _BaseInterface.all_of(components)}
+        neighbours = sum(host.network_machines[net] for net in nets)
+        # Any host with more neighbours wins, the fallback only breaks ties
+        return -neighbours * 1e12 + fallback(host, components)
+
+    return policy
+
+
+@dataclasses.dataclass
+class Placement:
+    """A decision of a `Scheduler`, kept in `Scheduler.placements` for debugging."""
+
+    uri: str
+    ram_mib: int
+    cpu_count: int
+    # The score of every host that fit (see `Policy`), and why the others didn't
+    scores: dict[str, float]
+    rejected: dict[str, str]
+    timestamp: float
+
+
+@dataclasses.dataclass
+class _PendingPlacement:
+    """A placed machine that isn't running yet, accounted for on top of the queried capacity."""
+
+    uri: str
+    ram_mib: int
+    cpu_count: int
+    # `time.monotonic()` of the placement
+    timestamp: float
+    # The networks the machine connects to (by name)
+    networks: list[str]
+    # The UUID of the machine, once it was created
+    uuid: str | None = None
+
+
+class Scheduler:
+    """
+    Places machines across several hypervisors, by a pluggable policy.
+
+    The capacity of every host (its RAM and CPUs from `getInfo`, its free memory from
+    `getFreeMemory`, and what its running domains use and connect to) is queried through read-only
+    connections, and cached for `capacity_ttl` seconds. Placed machines are accounted for locally
+    until their domains show up on the host (or for `placement_timeout` seconds, e.g. if they
+    failed to be created), so bursts of machines are placed correctly without querying the hosts
+    again.
+
+    Hosts that can't fit a machine are skipped, and so are hosts that don't have the networks it
+    connects to (a `VNet` is local to its hypervisor, unless it's a `DistributedVNet`). The
+    remaining hosts are scored by the policy (`bin_pack`, `spread`, `affinity()` or any
+    `Policy`), and the lowest score wins.
+
+    Args:
+        hypervisor_uris: The hypervisors to place machines on
+        policy: Picks a host for every machine (default: `bin_pack`)
+        ram_overcommit: Allow committing this many times the RAM of each host
+        cpu_overcommit: Allow committing this many vCPUs per host CPU
+        capacity_ttl: Seconds to cache the capacity of the hosts
+        placement_timeout: Seconds to account for a placed machine whose domain doesn't show up
+
+    Example:
+        Spread machines over two hosts, with the network on the host with the most free RAM:
+
+            scheduler = Scheduler(['qemu+ssh://a/system', 'qemu+ssh://b/system'], policy=spread)
+            net = scheduler.vnet()
+            machines = [scheduler.vm([Disk('example.qcow2'), Interface(net)]) for _ in range(8)]
+            print(scheduler.placements[-1])
+
+        Test with separate `test:///` nodes (their capacity is queried through read-write
+        connections, since every connection to a `test:///` file is a separate test driver):
+
+            scheduler = Scheduler(['test:///tmp/node-a.xml', 'test:///tmp/node-b.xml'])
+    """
+
+    def __init__(
+        self,
+        hypervisor_uris: list[str],
+        policy: Policy = bin_pack,
+        ram_overcommit=1.0,
+        cpu_overcommit=4.0,
+        capacity_ttl=1.0,
+        placement_timeout=60.0,
+    ):
+        assert hypervisor_uris, "A scheduler needs at least one hypervisor"
+        assert len(set(hypervisor_uris)) == len(hypervisor_uris), "Duplicate hypervisor URIs"
+        self.hypervisor_uris = list(hypervisor_uris)
+        self.policy = policy
+        self._ram_overcommit = ram_overcommit
+        self._cpu_overcommit = cpu_overcommit
+        self._capacity_ttl = capacity_ttl
+        self._placement_timeout = placement_timeout
+
+        self._lock = threading.Lock()
+        self._hosts: dict[str, HostCapacity] = {}
+        self._hosts_timestamp = None
+        self._pending: list[_PendingPlacement] = []
+        self.placements: collections.deque[Placement] = collections.deque(maxlen=1000)
+
+    def hosts(self, refresh=False) -> list[HostCapacity]:
+        """The capacity of every host, queried if the cached capacity is too old."""
+        with self._lock:
+            return list(self._capacity(refresh).values())
+
+    def place(self, components: list[Component]) -> str:
+        """
+        Pick the hypervisor for a machine, returns its URI.
+
+        Raises:
+            RuntimeError: If no hypervisor can fit the machine
+        """
+        return self._place(components).uri
+
+    def vm(self, components: list[Component], **kwargs) -> VM:
+        """Create a machine on the hypervisor picked by `place`."""
+        pending = self._place(components)
+        try:
+            machine = VM(components, hypervisor_uri=pending.uri, **kwargs)
+        except Exception:
+            with self._lock:
+                self._forget(pending)
+            raise
+        with self._lock:
+            pending.uuid = machine._uuid
+        return machine
+
+    def vnet(self, **kwargs) -> VNet:
+        """Create a network on the hypervisor with the most free RAM."""
+        with self._lock:
+            hosts = self._capacity()
+            uri = max(hosts, key=lambda uri: hosts[uri].free_ram_mib(self._ram_overcommit))
+        net = VNet(hypervisor_uri=uri, **kwargs)
+        with self._lock:
+            self._capacity()[uri].networks.add(net.name)
+        return net
+
+    def _place(self, components: list[Component]) -> _PendingPlacement:
+        system = System.of(components) or System()
+        with self._lock:
+            hosts = self._capacity()
+            scores = {}
+            rejected = {}
+            for uri, host in hosts.items():
+                if reason := self._reject_reason(host, system, components):
+                    rejected[uri] = reason
+                else:
+                    scores[uri] = self.policy(host, components)
+
+            if not scores:
+                raise RuntimeError(f"No hypervisor can fit the machine: {rejected}")
+
+            uri = min(scores, key=scores.__getitem__)
+            pending = _PendingPlacement(
+                uri,
+                system.ram_mib,
+                system.cpu_count,
+                time.monotonic(),
+                [iface.net.name for iface in _BaseInterface.all_of(components)],
+            )
+            self._pending.append(pending)
+            _commit(hosts[uri], pending, 1)
+            self.placements.append(
+                Placement(uri, system.ram_mib, system.cpu_count, scores, rejected, time.time())
+            )
+            return pending
+
+    def _reject_reason(
+        self, host: HostCapacity, system: System, components: list[Component]
+    ) -> str | None:
+        """Why a host can't run a machine (None if it can)."""
+        if host.free_ram_mib(self._ram_overcommit) < system.ram_mib:
+            return f"{host.free_ram_mib(self._ram_overcommit):.0f}MiB RAM free"
+        if host.free_vcpus(self._cpu_overcommit) < system.cpu_count:
+            return f"{host.free_vcpus(self._cpu_overcommit):.0f} vCPUs free"
+        for iface in _BaseInterface.all_of(components):
+            if host.uri not in iface.net.hypervisor_uris:
+                return f"Network {iface.net.name} isn't on this hypervisor"
+        return None
+
+    def _capacity(self, refresh=False) -> dict[str, HostCapacity]:
+        """The cached capacity of the hosts, queried again if it's too old. Call with the lock."""
+        now = time.monotonic()
+        if (
+            refresh
+            or self._hosts_timestamp is None
+            or now - self._hosts_timestamp >= self._capacity_ttl
+        ):
+            self._hosts = {uri: _query_capacity(uri) for uri in self.hypervisor_uris}
+            self._hosts_timestamp = now
+
+            # Placed machines are counted by the hosts once their domains show up
+            self._pending = [
+                pending
+                for pending in self._pending
+                if pending.uuid not in self._hosts[pending.uri].domains
+                and now - pending.timestamp < self._placement_timeout
+            ]
+            for pending in self._pending:
+                _commit(self._hosts[pending.uri], pending, 1)
+        return self._hosts
+
+    def _forget(self, pending: _PendingPlacement):
+        """Stop accounting for a placed machine that failed to be created. Call with the lock."""
+        if pending in self._pending:
+            self._pending.remove(pending)
+            _commit(self._hosts[pending.uri], pending, -1)
+
+
+def _commit(host: HostCapacity, pending: _PendingPlacement, count: int):
+    """Add (or with a negative count, remove) a placed machine to the capacity of its host."""
+    host.committed_ram_mib += pending.ram_mib * count
+    host.committed_vcpus += pending.cpu_count * count
+    host.domain_count += count
+    host.free_memory_mib -= pending.ram_mib * count
+    for net in pending.networks:
+        host.network_machines[net] += count
+
+
+def _query_capacity(uri: str) -> HostCapacity:
+    # Every connection to a test driver is a separate instance, which doesn't see the domains
+    # created through the read-write connections
+    hypervisor = _get_hypervisor(uri, read_only=not uri.startswith("test:"))
+    _model, ram_mib, cpu_count, *_ = hypervisor.getInfo()
+
+    committed_ram_kib = 0
+    committed_vcpus = 0
+    network_machines = collections.Counter()
+    domains = hypervisor.listAllDomains(libvirt.VIR_CONNECT_LIST_DOMAINS_ACTIVE)
+    for dom in domains:
+        _state, max_mem_kib, _mem_kib, vcpus, _cpu_time = dom.info()
+        committed_ram_kib += max_mem_kib
+        committed_vcpus += vcpus
+        sources = ET.fromstring(dom.XMLDesc()).iterfind(
+            "./devices/interface[@type='network']/source"
+        )
+        network_machines.update({source.get("network") for source in sources})
+
+    networks = hypervisor.listAllNetworks(libvirt.VIR_CONNECT_LIST_NETWORKS_ACTIVE)
+    return HostCapacity(
+        uri=uri,
+        ram_mib=ram_mib,
+        cpu_count=cpu_count,
+        committed_ram_mib=committed_ram_kib // 1024,
+        committed_vcpus=committed_vcpus,
+        domain_count=len(domains),
+        free_memory_mib=hypervisor.getFreeMemory() // 1024**2,
+        networks={net.name() for net in networks},
+        domains={dom.UUIDString() for dom in domains},
+        network_machines=network_machines,
+    )
@@ -0,0 +1,195 @@
+"""Screen capture and template matching"""
+
+import contextlib
+import dataclasses
+import os
+import re
+import time
+from os import PathLike
+
+import libvirt
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+_CHUNK_SIZE = 256 * 1024
+_PPM_HEADER = re.compile(rb"P6\s+(\d+)\s+(\d+)\s+(\d+)\s")
+
+
+@dataclasses.dataclass
+class ScreenMatch:
+    """Where a template was found on the screen (its top-left corner), and how well it matched."""
+
+    x: int
+    y: int
+    # 1 for identical pixels, down to 0 (see `match_template`)
+    score: float
+    screenshot: "np.ndarray"
+
+
+def screenshot(dom: libvirt.virDomain, screen=0) -> "np.ndarray":
+    """Capture the screen of a domain, see `VM.screenshot`."""
+    assert np is not None, "Screenshots require numpy"
+    stream = dom.connect().newStream(0)
+    try:
+        mime_type = dom.screenshot(stream, screen, 0)
+        assert mime_type == "image/x-portable-pixmap", f"Unsupported screenshot type: {mime_type}"
+        data = bytearray()
+        while chunk := stream.recv(_CHUNK_SIZE):
+            data += chunk
+        stream.finish()
+    except BaseException:
+        with contextlib.suppress(libvirt.libvirtError):
+            stream.abort()
+        raise
+    return decode_ppm(data)
+
+
+def decode_ppm(data: bytes | bytearray) -> "np.ndarray":
+    """
+    Decode a binary PPM image into a (height, width, 3) RGB array.
+
+    The array is a view of `data` (no pixels are copied), and writable if `data` is a bytearray.
+    """
+    assert np is not None, "Decoding images requires numpy"
+    header = _PPM_HEADER.match(data)
+    assert header is not None, "Not a binary PPM image"
+    width, height, max_value = map(int, header.groups())
+    assert max_value == 255, f"Unsupported PPM max value: {max_value}"
+    pixels = np.frombuffer(data, np.uint8, count=width * height * 3, offset=header.end())
+    return pixels.reshape(height, width, 3)
+
+
+def read_ppm(path: str | PathLike) -> "np.ndarray":
+    """Read a binary PPM image (e.g. a template saved with `write_ppm`)."""
+    with open(path, "rb") as f:
+        return decode_ppm(bytearray(f.read()))
+
+
+def write_ppm(path: str | PathLike, image: "np.ndarray"):
+    """Save an RGB image (e.g. a region of a screenshot, to use as a template) as binary PPM."""
+    height, width, _channels = image.shape
+    with open(path, "wb") as f:
+        f.write(b"P6\n%d %d\n255\n" % (width, height))
+        f.write(np.ascontiguousarray(image, np.uint8).tobytes())
+
+
+def match_template(image: "np.ndarray", template: "np.ndarray") -> tuple[int, int, float]:
+    """
+    Find the best match of a template in an image, returns its top-left corner and score.
+
+    Images are compared in grayscale, the score is 1 minus the RMS difference of the pixels at the
+    best position (scaled to 0-1), so 1 is a pixel-perfect match.
+    """
+    return _Matcher(template, image.shape[:2]).match(image)
+
+
+def wait_for_screen(
+    dom: libvirt.virDomain,
+    template: "np.ndarray | str | PathLike",
+    region: tuple[int, int, int, int] | None = None,
+    timeout: float | None = None,
+    threshold=0.98,
+    interval=0.05,
+    screen=0,
+) -> ScreenMatch:
+    """Wait until a template shows up on the screen of a domain, see `VM.wait_for_screen`."""
+    if isinstance(template, (str, os.PathLike)):
+        template = read_ppm(template)
+
+    deadline = None if timeout is None else time.monotonic() + timeout
+    matcher = None
+    prev_view = None
+    while True:
+        frame = screenshot(dom, screen)
+        left, top = 0, 0
+        view = frame
+        if region is not None:
+            left, top, width, height = region
+            view = frame[top : top + height, left : left + width]
+
+        # Nothing changed since the previous frame, so it still doesn't match
+        if prev_view is None or not np.array_equal(view, prev_view):
+            prev_view = view
+            if matcher is None or matcher.shape != view.shape[:2]:
+                matcher = _Matcher(template, view.shape[:2])
+            x, y, score = matcher.match(view)
+            if score >= threshold:
+                return ScreenMatch(left + x, top + y, score, frame)
+
+        remaining = None if deadline is None else deadline - time.monotonic()
+        if remaining is not None and remaining <= 0:
+            raise TimeoutError(f"The template didn't show up on the screen (best score: {score})")
+        time.sleep(interval if remaining is None else min(interval, remaining))
+
+
+class _Matcher:
+    """
+    Matches a template against images of one size, by the sum of squared differences.
+
+    The SSD at every position is sum(image²) - 2 * correlation(image, template) + sum(template²),
+    with the window sums of image² taken from an integral image and the correlation computed with
+    FFTs, so an image is matched in a few vectorized passes regardless of the template's size. The
+    template's FFT is computed once, and reused for every frame.
+    """
+
+    def __init__(self, template: "np.ndarray", shape: tuple[int, int]):
+        assert np is not None, "Template matching requires numpy"
+        template = _grayscale(template)
+        self.shape = shape
+        self._template_shape = template.shape
+        assert all(
+            size <= image_size for size, image_size in zip(template.shape, shape)
+        ), f"The template ({template.shape}) is larger than the image ({shape})"
+
+        # Big enough for the full (non-circular) correlation, and fast to transform
+        self._fft_shape = tuple(
+            _fast_length(size + tsize - 1) for size, tsize in zip(shape, template.shape)
+        )
+        self._template_fft = np.fft.rfft2(template[::-1, ::-1], self._fft_shape)
+        self._template_sq_sum = float(np.square(template).sum())
+
+    def match(self, image: "np.ndarray") -> tuple[int, int, float]:
+        image = _grayscale(image)
+        height, width = self._template_shape
+        image_fft = np.fft.rfft2(image, self._fft_shape)
+        correlation = np.fft.irfft2(image_fft * self._template_fft, self._fft_shape)
+        correlation = correlation[height - 1 : image.shape[0], width - 1 : image.shape[1]]
+
+        image_sq_sums = _window_sums(np.square(image), height, width)
+        ssd = image_sq_sums - 2 * correlation + self._template_sq_sum
+        y, x = np.unravel_index(np.argmin(ssd), ssd.shape)
+        rms = np.sqrt(max(ssd[y, x], 0) / (height * width))
+        return int(x), int(y), float(1 - rms / 255)
+
+
+def _grayscale(image: "np.ndarray") -> "np.ndarray":
+    if image.ndim == 2:
+        return image.astype(np.float64)
+    return image[..., :3].astype(np.float64) @ np.array([0.299, 0.587, 0.114])
+
+
+def _window_sums(values: "np.ndarray", height: int, width: int) -> "np.ndarray":
+    """The sum of every height x width window of `values`, from its integral image."""
+    integral = np.zeros((values.shape[0] + 1, values.shape[1] + 1))
+    np.cumsum(np.cumsum(values, axis=0), axis=1, out=integral[1:, 1:])
+    return (
+        integral[height:, width:]
+        - integral[:-height, width:]
+        - integral[height:, :-width]
+        + integral[:-height, :-width]
+    )
+
+
+def _fast_length(length: int) -> int:
+    """The smallest length >= `length` without prime factors above 5, FFTs are fastest on those."""
+    while True:
+        remainder = length
+        for factor in (2, 3, 5):
+            while remainder % factor == 0:
+                remainder //= factor
+        if remainder == 1:
+            return length
+        length += 1
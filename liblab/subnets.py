@@ -0,0 +1,161 @@
+"""Allocation of network subnets"""
+
+import bisect
+import contextlib
+import fcntl
+import ipaddress
+import json
+import os
+from pathlib import Path
+
+from liblab import netlink
+
+
+class SubnetAllocator:
+    """
+    Hands out free subnets from a pool, shared by all processes on the host.
+
+    Allocations are recorded in a state file, under an exclusive `flock`. Every allocation takes
+    the lowest subnet that's neither allocated nor intersecting one of the host's routes, so
+    parallel `VNet`s never collide and never need to sleep and retry. The routes are kept as
+    sorted, merged ranges of subnets (rebuilt only when the routing table changes), and searched
+    with `bisect`.
+
+    Allocations of processes that exited are reclaimed (the routes of networks they leaked still
+    keep their subnets in use).
+
+    Args:
+        pool: The network to allocate subnets from (default: 10.0.0.0/8)
+        prefix_len: The prefix length of allocated subnets (default: 24)
+        state_path: Where allocations are recorded (default: a file per pool in /tmp)
+
+    Example:
+        Give networks /26 subnets from a dedicated pool:
+
+            subnets = SubnetAllocator('172.20.0.0/16', prefix_len=26)
+            net = VNet(subnets=subnets)
+            print(net.subnet)  # => 172.20.0.0/26
+    """
+
+    _STATE_DIR = Path("/tmp/liblab_subnets")
+
+    def __init__(
+        self, pool="10.0.0.0/8", prefix_len=24, state_path: str | os.PathLike | None = None
+    ):
+        self.pool = ipaddress.IPv4Network(pool)
+        assert (
+            self.pool.prefixlen <= prefix_len <= 30
+        ), f"Can't allocate /{prefix_len} subnets from {self.pool}"
+        self.prefix_len = prefix_len
+        self._count = 1 << (prefix_len - self.pool.prefixlen)
+        self._shift = 32 - prefix_len
+
+        if state_path is None:
+            name = f"{self.pool.network_address}-{self.pool.prefixlen}-{prefix_len}.json"
+            state_path = SubnetAllocator._STATE_DIR / name
+        self._state_path = Path(state_path)
+
+        # The routes the ranges were built from, and the first and last subnet of every range
+        self._routes: list[ipaddress.IPv4Network] | None = None
+        self._route_firsts: list[int] = []
+        self._route_lasts: list[int] = []
+
+    def allocate(self, owner: str = "") -> ipaddress.IPv4Network:
+        """
+        Allocate the lowest free subnet of the pool.
+
+        Raises:
+            RuntimeError: If the pool is exhausted
+        """
+        with self._locked_state() as state:
+            self._reclaim(state)
+            self._update_routes()
+            allocated = {int(idx) for idx in state}
+
+            idx = 0
+            while True:
+                # The last range starting at or before `idx`, skip it if it covers `idx`
+                i = bisect.bisect_right(self._route_firsts, idx) - 1
+                if i >= 0 and idx <= self._route_lasts[i]:
+                    idx = self._route_lasts[i] + 1
+                elif idx in allocated:
+                    idx += 1
+                else:
+                    break
+            if idx >= self._count:
+                raise RuntimeError(f"No free /{self.prefix_len} subnet left in {self.pool}")
+
+            state[str(idx)] = {"pid": os.getpid(), "owner": owner}
+            return self._subnet(idx)
+
+    def release(self, subnet: ipaddress.IPv4Network):
+        """Return an allocated subnet to the pool."""
+        idx = (int(subnet.network_address) - int(self.pool.network_address)) >> self._shift
+        with self._locked_state() as state:
+            state.pop(str(idx), None)
+
+    def allocated(self) -> dict[ipaddress.IPv4Network, str]:
+        """The allocated subnets and their owners."""
+        with self._locked_state() as state:
+            self._reclaim(state)
+            return {self._subnet(int(idx)): entry["owner"] for idx, entry in state.items()}
+
+    def _subnet(self, idx: int) -> ipaddress.IPv4Network:
+        address = int(self.pool.network_address) + (idx << self._shift)
+        return ipaddress.IPv4Network((address, self.prefix_len))
+
+    def _update_routes(self):
+        """Rebuild the ranges of subnets intersecting a route, if the routes changed."""
+        routes = netlink.routes()
+        if routes == self._routes:
+            return
+
+        pool_start = int(self.pool.network_address)
+        pool_end = int(self.pool.broadcast_address)
+        ranges = []
+        for route in routes:
+            address = int(route.network_address)
+            start = max(address, pool_start)
+            end = min(address | ((1 << (32 - route.prefixlen)) - 1), pool_end)
+            if start <= end:
+                ranges.append(
+                    ((start - pool_start) >> self._shift, (end - pool_start) >> self._shift)
+                )
+        ranges.sort()
+
+        firsts, lasts = [], []
+        for first, last in ranges:
+            if lasts and first <= lasts[-1] + 1:
+                lasts[-1] = max(lasts[-1], last)
+            else:
+                firsts.append(first)
+                lasts.append(last)
+        self._routes, self._route_firsts, self._route_lasts = routes, firsts, lasts
+
+    @staticmethod
+    def _reclaim(state: dict):
+        """Drop the allocations of processes that exited. Call with the lock."""
+        for idx, entry in list(state.items()):
+            try:
+                os.kill(entry["pid"], 0)
+            except ProcessLookupError:
+                del state[idx]
+            except PermissionError:
+                pass
+
+    @contextlib.contextmanager
+    def _locked_state(self):
+        """Lock the allocations (between processes too) and load them, saving them on exit."""
+        self._state_path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self._state_path.with_suffix(".lock"), "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                state = json.loads(self._state_path.read_text())
+            except FileNotFoundError:
+                state = {}
+
+            yield state
+
+            tmp_path = self._state_path.with_suffix(".tmp")
+            tmp_path.write_text(json.dumps(state))
+            tmp_path.replace(self._state_path)
@@ -0,0 +1,218 @@
+"""Resource usage of machines"""
+
+import array
+import collections
+import math
+import threading
+import time
+
+import libvirt
+
+from liblab.trace import _percentile
+from liblab.vm import VM, _get_hypervisor
+
+# Counters (exported as per-second rates) by their `getAllDomainStats` key, `*` is summed over all
+# disks / interfaces
+_COUNTERS = {
+    "cpu_time": "cpu.time",
+    "block_read_bytes": "block.*.rd.bytes",
+    "block_write_bytes": "block.*.wr.bytes",
+    "block_read_reqs": "block.*.rd.reqs",
+    "block_write_reqs": "block.*.wr.reqs",
+    "net_rx_bytes": "net.*.rx.bytes",
+    "net_tx_bytes": "net.*.tx.bytes",
+    "net_rx_packets": "net.*.rx.pkts",
+    "net_tx_packets": "net.*.tx.pkts",
+}
+_GAUGES = ["memory_kib", "memory_rss_kib", "memory_used_kib"]
+_FIELDS = ["time", *_COUNTERS, *_GAUGES]
+
+
+class TelemetryCollector:
+    """
+    Samples the resource usage of many machines, from one thread.
+
+    Every `interval` seconds, the CPU time, memory (balloon), block and network counters of all
+    the running domains of each hypervisor are fetched with a single `getAllDomainStats` call (on
+    a read-only connection), and the samples of the added machines are kept in a ring buffer of
+    `capacity` samples per machine (a flat `array` of doubles, a row per sample).
+
+    Counters are exported as per-second rates between consecutive samples (and CPU time as the
+    number of CPUs used), alongside the memory gauges, and summarized as percentiles, to spot
+    noisy neighbours or size `System(ram_mib, cpu_count)`. `memory_used_kib` (memory the guest
+    uses) requires a balloon device with statistics enabled in the guest, and is NaN otherwise.
+
+    Args:
+        interval: Seconds between samples
+        capacity: How many samples to keep per machine
+
+    Example:
+        Find the machines that use the most CPU:
+
+            collector = TelemetryCollector(interval=0.5)
+            for vm in machines:
+                collector.add(vm)
+
+            time.sleep(60)
+            summary = collector.summary()
+            for name in sorted(summary, key=lambda name: -summary[name]['cpu_time'][99])[:5]:
+                print(name, summary[name]['cpu_time'], summary[name]['memory_rss_kib'])
+
+            collector.close()
+    """
+
+    def __init__(self, interval: float = 1.0, capacity: int = 600):
+        assert capacity >= 2, "At least two samples are needed for rates"
+        self.interval = interval
+        self._capacity = capacity
+
+        self._lock = threading.Lock()
+        # Machines by name: their hypervisor, UUID and samples
+        self._machines: dict[str, tuple[str, str, _SampleRing]] = {}
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def add(self, vm: VM):
+        """Start sampling a machine."""
+        with self._lock:
+            assert vm.name not in self._machines, f"{vm.name} is already sampled"
+            ring = _SampleRing(len(_FIELDS), self._capacity)
+            self._machines[vm.name] = (vm._hypervisor_uri, vm._uuid, ring)
+
+    def remove(self, vm: VM | str):
+        """Stop sampling a machine, and forget its samples (they're kept after it's destroyed)."""
+        with self._lock:
+            self._machines.pop(vm if isinstance(vm, str) else vm.name, None)
+
+    def collect(self):
+        """Sample all the machines now (called every `interval` by the collector thread)."""
+        with self._lock:
+            by_hypervisor = collections.defaultdict(dict)
+            for hypervisor_uri, uuid, ring in self._machines.values():
+                by_hypervisor[hypervisor_uri][uuid] = ring
+
+        stats_types = (
+            libvirt.VIR_DOMAIN_STATS_CPU_TOTAL
+            | libvirt.VIR_DOMAIN_STATS_BALLOON
+            | libvirt.VIR_DOMAIN_STATS_BLOCK
+            | libvirt.VIR_DOMAIN_STATS_INTERFACE
+        )
+        for hypervisor_uri, rings in by_hypervisor.items():
+            try:
+                all_stats = _get_hypervisor(hypervisor_uri, read_only=True).getAllDomainStats(
+                    stats_types, libvirt.VIR_CONNECT_GET_ALL_DOMAINS_STATS_ACTIVE
+                )
+            except libvirt.libvirtError:
+                continue
+
+            now = time.monotonic()
+            samples = [
+                (rings[dom.UUIDString()], _sample(now, stats))
+                for dom, stats in all_stats
+                if dom.UUIDString() in rings
+            ]
+            with self._lock:
+                for ring, sample in samples:
+                    ring.append(sample)
+
+    def samples(self, vm: VM | str) -> dict[str, list[float]]:
+        """The raw samples of a machine, oldest first (`time` is `time.monotonic()`)."""
+        with self._lock:
+            _hypervisor_uri, _uuid, ring = self._machines[vm if isinstance(vm, str) else vm.name]
+            rows = ring.rows()
+        return {field: [row[idx] for row in rows] for idx, field in enumerate(_FIELDS)}
+
+    def rates(self, vm: VM | str) -> dict[str, list[float]]:
+        """
+        The per-second rates of the counters between consecutive samples, and the gauges of the
+        later samples.
+        """
+        samples = self.samples(vm)
+        times = samples["time"]
+        series = {}
+        for field in _COUNTERS:
+            values = samples[field]
+            # A counter goes back if the domain was restarted (e.g. a persistent machine)
+            series[field] = [
+                (delta if (delta := values[i] - values[i - 1]) >= 0 else math.nan)
+                / (times[i] - times[i - 1])
+                for i in range(1, len(times))
+            ]
+        series["cpu_time"] = [rate / 1e9 for rate in series["cpu_time"]]
+        for field in _GAUGES:
+            series[field] = samples[field][1:]
+        return series
+
+    def percentiles(
+        self, vm: VM | str, percentiles=(50, 90, 99, 100)
+    ) -> dict[str, dict[int, float]]:
+        """Percentiles of every series of `rates` (NaN until there are two samples)."""
+        summary = {}
+        for field, values in self.rates(vm).items():
+            values = sorted(value for value in values if not math.isnan(value))
+            summary[field] = {p: _percentile(values, p) for p in percentiles}
+        return summary
+
+    def summary(self, percentiles=(50, 90, 99, 100)) -> dict[str, dict[str, dict[int, float]]]:
+        """`percentiles` of every machine, by name."""
+        with self._lock:
+            names = list(self._machines)
+        return {name: self.percentiles(name, percentiles) for name in names}
+
+    def close(self):
+        """Stop sampling (the samples can still be read)."""
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            self.collect()
+            if self._stop.wait(self.interval):
+                return
+
+
+class _SampleRing:
+    """A ring buffer of fixed-size rows of doubles, in one flat `array`."""
+
+    def __init__(self, width: int, capacity: int):
+        self._width = width
+        self._capacity = capacity
+        self._data = array.array("d", bytes(8 * width * capacity))
+        # The index of the next row to write, and how many rows are filled
+        self._next = 0
+        self._count = 0
+
+    def append(self, row: list[float]):
+        start = self._next * self._width
+        self._data[start : start + self._width] = array.array("d", row)
+        self._next = (self._next + 1) % self._capacity
+        self._count = min(self._count + 1, self._capacity)
+
+    def rows(self) -> list[array.array]:
+        """The rows, oldest first."""
+        first = (self._next - self._count) % self._capacity
+        rows = []
+        for i in range(self._count):
+            start = (first + i) % self._capacity * self._width
+            rows.append(self._data[start : start + self._width])
+        return rows
+
+
+def _sample(timestamp: float, stats: dict) -> list[float]:
+    """A row of `_FIELDS` from the stats of a domain."""
+    row = [timestamp]
+    for key in _COUNTERS.values():
+        group, _, name = key.partition(".*.")
+        if name:
+            count = stats.get(f"{group}.count", 0)
+            row.append(float(sum(stats.get(f"{group}.{idx}.{name}", 0) for idx in range(count))))
+        else:
+            row.append(float(stats.get(key, math.nan)))
+
+    available = stats.get("balloon.available")
+    unused = stats.get("balloon.unused")
+    row.append(float(stats.get("balloon.current", math.nan)))
+    row.append(float(stats.get("balloon.rss", math.nan)))
+    row.append(available - unused if available is not None and unused is not None else math.nan)
+    return row
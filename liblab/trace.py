@@ -0,0 +1,211 @@
+"""Timing of lifecycle phases"""
+
+import asyncio
+import collections
+import contextlib
+import contextvars
+import itertools
+import json
+import math
+import os
+import threading
+import time
+from os import PathLike
+
+# The tracer recording spans, None when tracing is disabled
+_tracer: "Tracer | None" = None
+_NULL_SPAN = contextlib.nullcontext()
+# The innermost open span, per thread and asyncio task (tasks copy the context they're created in)
+_current_span: contextvars.ContextVar["_Span | None"] = contextvars.ContextVar(
+    "liblab_current_span", default=None
+)
+_span_ids = itertools.count(1)
+
+
+def span(name: str, **args):
+    """
+    Time a phase (as a context manager) with the active `Tracer`.
+
+    When tracing is disabled this only returns a shared no-op context manager, so phases can be
+    instrumented unconditionally.
+    """
+    tracer = _tracer
+    if tracer is None:
+        return _NULL_SPAN
+    return _Span(tracer, name, args)
+
+
+class Tracer:
+    """
+    Records the phases of creating and destroying machines and networks, while it's active.
+
+    Spans (e.g. `vm.create`, `vm.createXML`, `device.create`, `disk.linked_clone`,
+    `vm.retry_backoff`) are timed with `time.perf_counter_ns` into a bounded in-memory buffer, and
+    can be exported as Chrome trace events (for chrome://tracing or https://ui.perfetto.dev) or
+    summarized per span name.
+
+    Every span records its parent, the innermost span open in the same thread or asyncio task, so
+    the spans of concurrent tasks (e.g. `liblab.aio` creating devices) don't nest in each other.
+    Spans of asyncio tasks are exported on a track per task.
+
+    Args:
+        max_spans: How many spans to keep (the oldest are dropped)
+
+    Example:
+        Find out where the time went:
+
+            with Tracer() as tracer:
+                machines = VM.create_many([[Disk('example.qcow2')] for _ in range(20)])
+
+            tracer.export_chrome('/tmp/liblab-trace.json')
+            print(tracer.format_summary())
+    """
+
+    def __init__(self, max_spans: int = 1_000_000):
+        # (name, start ns, end ns, track id, args, span id, parent span id) tuples
+        self._spans: collections.deque[tuple] = collections.deque(maxlen=max_spans)
+        self._thread_names: dict[int, str] = {}
+        self._start_ns = time.perf_counter_ns()
+
+    def start(self):
+        """Make this the active tracer (replacing any other)."""
+        global _tracer
+        _tracer = self
+
+    def stop(self):
+        """Stop tracing, if this is the active tracer."""
+        global _tracer
+        if _tracer is self:
+            _tracer = None
+
+    def __enter__(self) -> "Tracer":
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    def durations(self) -> dict[str, list[float]]:
+        """The durations (in milliseconds) of the recorded spans, by name."""
+        durations = collections.defaultdict(list)
+        for name, start_ns, end_ns, *_ in list(self._spans):
+            durations[name].append((end_ns - start_ns) / 1e6)
+        return dict(durations)
+
+    def summary(self) -> dict[str, dict[str, float]]:
+        """Statistics of the durations (in milliseconds) of the recorded spans, by name."""
+        summary = {}
+        for name, durations in sorted(self.durations().items()):
+            durations.sort()
+            summary[name] = {
+                "count": len(durations),
+                "total_ms": sum(durations),
+                "mean_ms": sum(durations) / len(durations),
+                "p50_ms": _percentile(durations, 50),
+                "p90_ms": _percentile(durations, 90),
+                "p99_ms": _percentile(durations, 99),
+                "max_ms": durations[-1],
+            }
+        return summary
+
+    def histogram(self, name: str) -> dict[float, int]:
+        """
+        How many spans of a name took up to each power-of-two number of milliseconds (buckets
+        without spans are omitted).
+        """
+        buckets = collections.Counter()
+        for duration in self.durations().get(name, []):
+            buckets[2.0 ** math.ceil(math.log2(max(duration, 2**-10)))] += 1
+        return dict(sorted(buckets.items()))
+
+    def format_summary(self) -> str:
+        """A table of `summary`, with a histogram of every span name."""
+        lines = [
+            f"{'span':<24} {'count':>7} {'total ms':>10} {'mean ms':>9} {'p50 ms':>9}"
+            f" {'p99 ms':>9} {'max ms':>9}"
+        ]
+        for name, stats in self.summary().items():
+            lines.append(
+                f"{name:<24} {stats['count']:>7} {stats['total_ms']:>10.1f}"
+                f" {stats['mean_ms']:>9.2f} {stats['p50_ms']:>9.2f} {stats['p99_ms']:>9.2f}"
+                f" {stats['max_ms']:>9.2f}"
+            )
+            histogram = self.histogram(name)
+            widest = max(histogram.values())
+            for upper_ms, count in histogram.items():
+                bar = "#" * max(1, round(count / widest * 40))
+                lines.append(f"    <= {upper_ms:>10.3f} ms {count:>7} {bar}")
+        return "\n".join(lines)
+
+    def export_chrome(self, path: str | PathLike):
+        """Write the spans as Chrome trace events (JSON)."""
+        pid = os.getpid()
+        events = [
+            {"name": "thread_name", "ph": "M", "pid": pid, "tid": tid, "args": {"name": name}}
+            for tid, name in self._thread_names.items()
+        ]
+        for name, start_ns, end_ns, tid, args, span_id, parent_id in list(self._spans):
+            args = {**args, "span_id": span_id, "parent_id": parent_id}
+            events.append(
+                {
+                    "name": name,
+                    "cat": name.split(".")[0],
+                    "ph": "X",
+                    "ts": (start_ns - self._start_ns) / 1000,
+                    "dur": (end_ns - start_ns) / 1000,
+                    "pid": pid,
+                    "tid": tid,
+                    "args": args,
+                }
+            )
+        with open(path, "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+    def _record(self, span: "_Span", end_ns: int):
+        # Concurrent tasks of an event loop get a track each, their spans overlap without nesting
+        try:
+            task = asyncio.current_task()
+        except RuntimeError:
+            task = None
+        tid = id(task) if task is not None else threading.get_ident()
+        if tid not in self._thread_names:
+            name = threading.current_thread().name
+            self._thread_names[tid] = f"{name} {task.get_name()}" if task is not None else name
+        parent_id = span._parent._id if span._parent is not None else None
+        self._spans.append(
+            (span._name, span._start_ns, end_ns, tid, span._args, span._id, parent_id)
+        )
+
+
+class _Span:
+    __slots__ = ("_tracer", "_name", "_args", "_start_ns", "_id", "_parent", "_token")
+
+    def __init__(self, tracer: Tracer, name: str, args: dict):
+        self._tracer = tracer
+        self._name = name
+        self._args = args
+
+    def __enter__(self):
+        self._id = next(_span_ids)
+        self._parent = _current_span.get()
+        self._token = _current_span.set(self)
+        self._start_ns = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        end_ns = time.perf_counter_ns()
+        _current_span.reset(self._token)
+        if exc_type is not None:
+            self._args["error"] = exc_type.__name__
+        self._tracer._record(self, end_ns)
+
+
+def _percentile(sorted_values: list[float], percentile: float) -> float:
+    """Linearly interpolated percentile of sorted values (NaN if there are none)."""
+    if not sorted_values:
+        return math.nan
+    position = (len(sorted_values) - 1) * percentile / 100
+    lower = math.floor(position)
+    upper = min(lower + 1, len(sorted_values) - 1)
+    fraction = position - lower
+    return sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * fraction
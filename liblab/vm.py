@@ -1,20 +1,55 @@
 """Virtual machine abstraction"""
 
+import asyncio
+import contextlib
+import copy
 import dataclasses
-import json
+import functools
+import hashlib
+import ipaddress
+import os
 import random
+import re
+import shlex
 import struct
 import subprocess as sp
+import threading
 import time
+import urllib.parse
 import uuid
+import weakref
+import xml.etree.ElementTree as ET
+from concurrent.futures import FIRST_EXCEPTION, ThreadPoolExecutor, wait
 from os import PathLike
+from pathlib import Path
+from typing import TYPE_CHECKING, Callable, Generator
+from xml.sax.saxutils import escape
 
 import libvirt
 from typing_extensions import Self
 
-import liblab.keycodes
+import liblab.keyboard
+import liblab.ocr
+import liblab.screen
+from liblab import netlink, trace
+from liblab.connections import connection_pool
+from liblab.keyboard import TypingProfile, TypingStats
+from liblab.ocr import ScreenReader
+from liblab.screen import ScreenMatch
+from liblab.subnets import SubnetAllocator
 
-_hypervisor_connections = {}
+if TYPE_CHECKING:
+    import numpy
+
+# Domain XML templates by `VM.spec`
+_domain_templates: dict[tuple, "_XMLTemplate"] = {}
+_domain_templates_lock = threading.Lock()
+_DOMAIN_TEMPLATES_MAX = 1024
+
+
+def _get_hypervisor(hypervisor_uri: str, read_only=False) -> libvirt.virConnect:
+    """Get a connection to the given hypervisor from its shared `ConnectionPool`."""
+    return connection_pool(hypervisor_uri).get(read_only)
 
 
 class Component:
@@ -36,6 +71,15 @@ class Component:
     def __init__(self, ident: str | None = None):
         self._ident = ident
 
+    def _spec(self) -> tuple | None:
+        """
+        The configuration of the component as a hashable tuple, see `VM.spec`.
+
+        Components that don't override this have no spec, so their machines' templates aren't
+        cached (and persistent machines are redefined on every run).
+        """
+        return None
+
     @classmethod
     def by_id(cls, obj, ident) -> Self | None:
         """
@@ -108,6 +152,7 @@ class System(Component):
         chipset: The chipset of the VM (default: pc-q35-4.2)
         ram_mib: RAM in MiB allocated to the VM (default: 256MiB)
         cpu_count: The number of cores allocated to the VM (default: 1)
+        domain_type: The libvirt domain type (default: kvm, use "test" with `test:///default`)
     """
 
     def __init__(
@@ -117,6 +162,7 @@ class System(Component):
         ram_mib=256,
         cpu_count=1,
         efi_image: PathLike | None = None,
+        domain_type="kvm",
         ident=None,
     ):
         super().__init__(ident=ident)
@@ -125,86 +171,51 @@ class System(Component):
         self.ram_mib = ram_mib
         self.cpu_count = cpu_count
         self.efi_image = efi_image
+        self.domain_type = domain_type
+
+    def _spec(self) -> tuple:
+        efi_image = str(self.efi_image) if self.efi_image else None
+        return (
+            "System",
+            self.arch,
+            self.chipset,
+            self.ram_mib,
+            self.cpu_count,
+            efi_image,
+            self.domain_type,
+        )
 
-    def _to_xml(self, vm: "VM", devices_xml: str):
+    def _to_element(self, vm: "VM", devices: list[ET.Element]) -> ET.Element:
+        """Build the domain XML template around the given device elements."""
         # TODO: QXL/Spice graphics
         # TODO: memballoon
         # TODO: virtio-rng
-        from liblab import NVRAMImage
+        from liblab.disks import NVRAMImage
+
+        assert self.ram_mib > 0, f"Invalid RAM size: {self.ram_mib}MiB"
+        assert self.cpu_count > 0, f"Invalid CPU count: {self.cpu_count}"
 
-        efi_snippet = ""
+        domain = ET.Element("domain", type=self.domain_type)
+        ET.SubElement(domain, "name").text = _placeholder("name")
+        ET.SubElement(domain, "uuid").text = _placeholder("uuid")
+        ET.SubElement(domain, "memory", unit="MiB").text = str(self.ram_mib)
+        ET.SubElement(domain, "currentMemory", unit="MiB").text = str(self.ram_mib)
+        ET.SubElement(domain, "vcpu", placement="static").text = str(self.cpu_count)
+
+        os_ = ET.SubElement(domain, "os")
+        ET.SubElement(os_, "type", arch=self.arch, machine=self.chipset).text = "hvm"
         if self.efi_image:
-            efi_snippet += f'<loader readonly="yes" type="pflash">{self.efi_image}</loader>'
-
-        if efi_nvram := NVRAMImage.of(vm):
-            efi_snippet += f"<nvram>{efi_nvram.live_image_path}</nvram>"
-
-        return """
-            <memory unit='MiB'>{ram_mib}</memory>
-            <currentMemory unit='MiB'>{ram_mib}</currentMemory>
-            <vcpu placement='static'>{cpu_count}</vcpu>
-            <os>
-                <type arch='{arch}' machine='{chipset}'>hvm</type>
-                {firmware_tags}
-            </os>
-            <features>
-                <acpi/>
-                <apic/>
-                <vmport state='off'/>
-            </features>
-            <cpu mode="host-passthrough" check="none" migratable="on"/>
-            <clock offset="utc">
-                <timer name="rtc" tickpolicy="catchup"/>
-                <timer name="pit" tickpolicy="delay"/>
-                <timer name="hpet" present="no"/>
-            </clock>
-            <devices>
-                <emulator>/usr/bin/qemu-system-{arch}</emulator>
-                {devices_xml}
-                <video>
-                    <model type="vga"/>
-                </video>
-                <graphics type="vnc" port="-1"></graphics>
-                <controller type='sata' index='0'>
-                    <address type='pci' domain='0x0000' bus='0x00' slot='0x1f' function='0x2'/>
-                </controller>
-                <controller type='pci' index='0' model='pcie-root'/>
-                <controller type='pci' index='1' model='pcie-root-port'>
-                    <model name='pcie-root-port'/>
-                    <target chassis='1' port='0x10'/>
-                    <address type='pci' domain='0x0000' bus='0x00' slot='0x02' function='0x0' multifunction='on'/>
-                </controller>
-                <controller type='pci' index='2' model='pcie-root-port'>
-                    <model name='pcie-root-port'/>
-                    <target chassis='2' port='0x11'/>
-                    <address type='pci' domain='0x0000' bus='0x00' slot='0x02' function='0x1'/>
-                </controller>
-                <controller type='pci' index='3' model='pcie-root-port'>
-                    <model name='pcie-root-port'/>
-                    <target chassis='3' port='0x12'/>
-                    <address type='pci' domain='0x0000' bus='0x00' slot='0x02' function='0x2'/>
-                </controller>
-                <controller type='pci' index='4' model='pcie-root-port'>
-                    <model name='pcie-root-port'/>
-                    <target chassis='4' port='0x13'/>
-                    <address type='pci' domain='0x0000' bus='0x00' slot='0x02' function='0x3'/>
-                </controller>
-                <controller type='pci' index='5' model='pcie-root-port'>
-                    <model name='pcie-root-port'/>
-                    <target chassis='5' port='0x14'/>
-                    <address type='pci' domain='0x0000' bus='0x00' slot='0x02' function='0x4'/>
-                </controller>
-                <input type='mouse' bus='ps2'/>
-                <input type='keyboard' bus='ps2'/>
-            </devices>
-        """.format(
-            ram_mib=self.ram_mib,
-            cpu_count=self.cpu_count,
-            arch=self.arch,
-            chipset=self.chipset,
-            firmware_tags=efi_snippet,
-            devices_xml=devices_xml,
-        )
+            loader = ET.SubElement(os_, "loader", readonly="yes", type="pflash")
+            loader.text = str(self.efi_image)
+        if NVRAMImage.of(vm):
+            ET.SubElement(os_, "nvram").text = _placeholder("nvram")
+
+        domain.extend(ET.fromstring(_PLATFORM_XML))
+        devices_element = ET.SubElement(domain, "devices")
+        ET.SubElement(devices_element, "emulator").text = f"/usr/bin/qemu-system-{self.arch}"
+        devices_element.extend(devices)
+        devices_element.extend(ET.fromstring(_PLATFORM_DEVICES_XML))
+        return domain
 
 
 class Device(Component):
@@ -215,16 +226,45 @@ class Device(Component):
         self._hypervisor = None
         self._machine_name = None
 
+        # Weak reference to the owning VM, set when the VM is constructed
+        self._vm = None
+
     def create(
         self, hypervisor: libvirt.virConnect | None, machine_name: str, components: list[Component]
     ):
         self._hypervisor = hypervisor
         self._machine_name = machine_name
 
+    async def create_async(
+        self, hypervisor: libvirt.virConnect | None, machine_name: str, components: list[Component]
+    ):
+        """Like `Device.create`, but doesn't block the event loop (used by `liblab.aio`)."""
+        await asyncio.to_thread(self.create, hypervisor, machine_name, components)
+
     def destroy(self):
         pass
 
-    def _to_xml(self):
+    def _template_values(self) -> dict[str, str]:
+        """The per-machine values of the placeholders in `_to_element`, once created."""
+        return {}
+
+    def _domain_xml(self) -> ET.Element:
+        """The parsed live domain XML of the machine, shared with all of its components."""
+        vm = self._vm() if self._vm else None
+        if vm is not None and vm._dom is not None:
+            return vm.xml_tree
+
+        hypervisor = _get_hypervisor(self._hypervisor.getURI(), read_only=True)
+        dom = hypervisor.lookupByName(self._machine_name)
+        return ET.fromstring(dom.XMLDesc())
+
+    def _to_element(self) -> ET.Element | None:
+        """
+        The element of the device in the domain XML template (None if it has none).
+
+        Called once per `VM.spec`, so per-machine values (e.g. paths of linked clones) must be
+        `_placeholder`s, substituted from `_template_values`.
+        """
         raise NotImplementedError
 
 
@@ -237,6 +277,19 @@ class VM:
     Args:
         components: A list of `Component`s that define the VM. A `System` is added automatically if absent
         hypervisor_uri: The hypervisor to create the VM in (`qemu:///system` by default)
+        create: Create the machine immediately (default). See `VM.create_many` for creating
+            many machines concurrently
+        persistent: Name of a persistent definition to reuse across runs, instead of creating a
+            transient machine (see below)
+
+    Persistent machines are named 'llp_<persistent>' and defined once with `defineXML`. Later
+    runs only swap in fresh linked clones before starting the defined domain, and re-define it
+    only when `VM.spec` changed (e.g. a different image). Every run creates its `VNet`s anew, so
+    machines with network interfaces are re-defined on every run. Destroying the machine stops it
+    but keeps the definition, and if a run crashes its domain and linked clones stay around for
+    inspection until the next run, which stops the domain and takes it over. Only one machine per
+    definition can run at a time, and domains of the same name that liblab didn't define are
+    never touched (creating the machine raises a `RuntimeError` instead).
 
     Example:
         Creating the machine:
@@ -261,6 +314,9 @@ class VM:
 
             # Netboot instead of disk
             machine = VM([Interface(VNet(netboot_root='/tmp/my_netboot'), netboot=True)])
+
+            # Reuse the definition of the previous run
+            machine = VM([Disk('example.qcow2')], persistent='example')
     """
 
     _CREATE_TRIES = 10
@@ -277,21 +333,83 @@ class VM:
     def __str__(self):
         return VM.pretty_format_components(self.components)
 
-    def __init__(self, components: list[Component], hypervisor_uri="qemu:///system"):
+    def __init__(
+        self,
+        components: list[Component],
+        hypervisor_uri="qemu:///system",
+        create=True,
+        persistent: str | None = None,
+    ):
         if System.of(components) is None:
             components.append(System())
 
         self.components = components
         self._hypervisor_uri = hypervisor_uri
-        self._libvirt = None
-        self._dom = None
+        self._persistent = persistent
+        self._conn = None
+        self._dom_handle = None
         self.name = None
         self._uuid = None
+        self._xml_cache: tuple[libvirt.virDomain, ET.Element] | None = None
+
+        # Seconds it took to create the machine (including retries)
+        self.create_duration: float | None = None
+
+        # How fast `type` types into this machine
+        self.typing_profile = TypingProfile()
+        # Reads the text on the screen, for `read_screen` and `wait_for_text`
+        self.screen_reader = ScreenReader()
+
+        for device in Device.all_of(self):
+            device._vm = weakref.ref(self)
 
         # if this reaches zero then the VM gets destroyed
         self._refcount = 0
 
-        self._create()
+        if create:
+            self._create()
+
+    @staticmethod
+    def create_many(
+        specs: list[list[Component]], hypervisor_uri="qemu:///system", max_workers=None
+    ) -> list["VM"]:
+        """
+        Create many machines concurrently, each from its own list of `Component`s.
+
+        Devices (e.g. linked clones) are prepared and the domains are created in a thread pool.
+        Creation is all-or-nothing: if any machine fails to be created, all the machines that were
+        created are destroyed and the error is raised.
+
+        The time it took to create each machine is available in `VM.create_duration`.
+
+        Args:
+            specs: A list of component lists, one per machine
+            hypervisor_uri: The hypervisor to create the VMs in (`qemu:///system` by default)
+            max_workers: Maximum number of machines created at once (`ThreadPoolExecutor` default)
+
+        Example:
+            Create 20 machines from the same image:
+
+                machines = VM.create_many([[Disk('example.qcow2')] for _ in range(20)])
+                for machine in machines:
+                    print(machine.name, machine.create_duration)
+        """
+        machines = [VM(components, hypervisor_uri, create=False) for components in specs]
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(machine._create) for machine in machines]
+            _, pending = wait(futures, return_when=FIRST_EXCEPTION)
+            for future in pending:
+                future.cancel()
+
+        errors = [f.exception() for f in futures if not f.cancelled() and f.exception()]
+        if errors:
+            # All-or-nothing, failed machines have already destroyed their devices
+            for machine in machines:
+                machine.destroy()
+            raise errors[0]
+
+        return machines
 
     def leak(self):
         """Makes the current VM object not destroy the domain on garbage collection."""
@@ -299,62 +417,217 @@ class VM:
 
     def _create(self):
         """Create the machine, and initialize all devices."""
-        if self._hypervisor_uri not in _hypervisor_connections:
-            _hypervisor_connections[self._hypervisor_uri] = libvirt.open(self._hypervisor_uri)
+        _run_steps(self._create_steps())
 
-        self._libvirt = _hypervisor_connections[self._hypervisor_uri]
+    def _create_steps(self) -> Generator:
+        """
+        The steps of `_create`, shared with `liblab.aio` (see `_run_steps`).
+
+        Yields the blocking work: callables (e.g. libvirt calls) that get their result or
+        exception sent back, `_create_devices`, and seconds to back off for.
+        """
+        start = time.perf_counter()
+        self._libvirt = yield functools.partial(_get_hypervisor, self._hypervisor_uri)
 
         self._refcount += 1
         if self._refcount != 1:
             return
 
-        # Attempt to recreate VM multiple times - in case of uuid/name conflict or OOM
-        for i in range(VM._CREATE_TRIES):
-            try:
-                self._uuid = str(uuid.uuid4())
-                self.name = f"llm_{hex(random.randint(0, 0xffffffff))[2:]}"
-
-                # Gather devices xml
-                devices_xml = ""
-                for device in Device.all_of(self):
-                    device.create(self._libvirt, self.name, self.components)
-                    devices_xml += device._to_xml()
-
-                xml = """
-                <domain type='kvm'>
-                    <name>{name}</name>
-                    <uuid>{uuid}</uuid>
-                    {system}
-                </domain>
-                """.format(
-                    name=self.name,
-                    uuid=self._uuid,
-                    system=System.of(self)._to_xml(self, devices_xml),
-                )
+        if self._persistent is not None:
+            with trace.span("vm.create", persistent=self._persistent):
+                yield from self._create_persistent_steps()
+            self.create_duration = time.perf_counter() - start
+            return
 
-                # Create the domain
-                self._dom = self._libvirt.createXML(xml)
-                break
-            except libvirt.libvirtError:
-                # We failed to create the VM, destroy all devices
-                for device in Device.all_of(self):
-                    try:
-                        device.destroy()
-                    except libvirt.libvirtError:
-                        pass
-
-                # Retry if it's not the last iteration
-                if i == VM._CREATE_TRIES - 1:
+        with trace.span("vm.create"):
+            # Attempt to recreate VM multiple times - in case of uuid/name conflict or OOM
+            for i in range(VM._CREATE_TRIES):
+                try:
+                    self._new_identity()
+                    yield self._create_devices
+
+                    # Create the domain
+                    with trace.span("vm.xml"):
+                        xml = self._to_xml()
+                    with trace.span("vm.createXML", attempt=i):
+                        self._dom = yield functools.partial(self._libvirt.createXML, xml)
+                    break
+                except libvirt.libvirtError:
+                    # We failed to create the VM, destroy all devices
+                    self._destroy_devices()
+
+                    # Retry if it's not the last iteration
+                    if i == VM._CREATE_TRIES - 1:
+                        raise
+                    with trace.span("vm.retry_backoff", attempt=i):
+                        yield 3
+                except BaseException:
+                    # We failed (or were cancelled) to create the VM, destroy all devices
+                    self._destroy_devices()
                     raise
-                time.sleep(3)
-            except Exception:
-                # We failed to create the VM, destroy all devices
-                for device in Device.all_of(self):
-                    try:
-                        device.destroy()
-                    except libvirt.libvirtError:
-                        pass
-                raise
+
+        self.create_duration = time.perf_counter() - start
+
+    def _create_persistent_steps(self) -> Generator:
+        """
+        Start the persistent domain of the machine, (re)defining it if its spec changed.
+
+        Steps of `_create_steps`.
+        """
+        from liblab.disks import NVRAMImage, _BaseDisk
+
+        spec = self.spec
+        # Without a spec, the definition can't be checked, so it's always redefined
+        spec_hash = hashlib.sha256(repr(spec).encode()).hexdigest() if spec is not None else None
+        self.name = f"llp_{self._persistent}"
+        self._uuid = str(uuid.uuid5(uuid.NAMESPACE_URL, f"{_METADATA_URI}/{self.name}"))
+
+        try:
+            dom = yield functools.partial(self._libvirt.lookupByName, self.name)
+        except libvirt.libvirtError:
+            dom = None
+        if dom is not None:
+            metadata = yield functools.partial(_liblab_metadata, dom)
+            if metadata is None:
+                raise RuntimeError(f"Domain {self.name} exists, but wasn't defined by liblab")
+            if (yield dom.isActive):
+                # Left running by a crashed run
+                with trace.span("vm.destroy"):
+                    yield dom.destroy
+            if spec_hash is None or metadata.get("hash") != spec_hash:
+                yield functools.partial(
+                    dom.undefineFlags,
+                    libvirt.VIR_DOMAIN_UNDEFINE_KEEP_NVRAM
+                    | libvirt.VIR_DOMAIN_UNDEFINE_SNAPSHOTS_METADATA,
+                )
+                dom = None
+
+        # Discard the linked clones of the previous (possibly crashed) run. Only exact clone names
+        # match, not the clones of other machines whose names start with this one's
+        own_clone = re.compile(rf"{re.escape(self.name)}-(disk\d+\.qcow2|nvram\.fd)")
+        for clones_dir in {_BaseDisk._LINKED_CLONES_DIR, NVRAMImage._LINKED_CLONES_DIR}:
+            for path in clones_dir.glob(f"{self.name}-*"):
+                if own_clone.fullmatch(path.name):
+                    path.unlink()
+
+        try:
+            yield self._create_devices
+            if dom is None:
+                with trace.span("vm.defineXML"):
+                    xml = _with_spec_hash(self._to_xml(), spec_hash)
+                    dom = yield functools.partial(self._libvirt.defineXML, xml)
+            with trace.span("vm.start"):
+                yield dom.create
+        except BaseException:
+            self._destroy_devices()
+            raise
+        self._dom = dom
+
+    def _new_identity(self):
+        """Pick a new random UUID and name for the machine."""
+        self._uuid = str(uuid.uuid4())
+        self.name = f"llm_{hex(random.randint(0, 0xffffffff))[2:]}"
+
+    @property
+    def _libvirt(self) -> libvirt.virConnect | None:
+        """The connection the machine was created through, reopened if it died."""
+        if self._conn is not None and not self._conn.isAlive():
+            self._conn = _get_hypervisor(self._hypervisor_uri)
+        return self._conn
+
+    @_libvirt.setter
+    def _libvirt(self, conn: libvirt.virConnect | None):
+        self._conn = conn
+
+    @property
+    def _dom(self) -> libvirt.virDomain | None:
+        """The domain, looked up again by UUID if its connection died (e.g. libvirtd restart)."""
+        dom = self._dom_handle
+        if dom is not None and not dom.connect().isAlive():
+            dom = self._dom_handle = self._libvirt.lookupByUUIDString(self._uuid)
+        return dom
+
+    @_dom.setter
+    def _dom(self, dom: libvirt.virDomain | None):
+        self._dom_handle = dom
+
+    @property
+    def spec(self) -> tuple | None:
+        """
+        A hashable description of the machine's configuration, from its components (in order).
+
+        Machines with equal specs are created from the same domain XML template, which is built
+        once and then only has the name, UUID and paths of linked clones substituted. None if a
+        component has no spec (see `Component._spec`).
+
+        Example:
+            a = VM([Disk('a.qcow2')], create=False)
+            b = VM([Disk('a.qcow2')], create=False)
+            assert a.spec == b.spec
+        """
+        spec = tuple(component._spec() for component in self.components)
+        return None if None in spec else spec
+
+    def _to_xml(self):
+        """Generate the domain XML, after all devices were created."""
+        values = {"name": self.name, "uuid": self._uuid}
+        for device in Device.all_of(self):
+            values.update(device._template_values())
+        return self._template().render(values)
+
+    def _template(self) -> "_XMLTemplate":
+        """The domain XML template of the machine's spec, built on first use."""
+        spec = self.spec
+        template = _domain_templates.get(spec) if spec is not None else None
+        if template is None:
+            elements = [device._to_element() for device in Device.all_of(self)]
+            devices = [element for element in elements if element is not None]
+            template = _XMLTemplate(System.of(self)._to_element(self, devices))
+            if spec is None:
+                return template
+            with _domain_templates_lock:
+                if len(_domain_templates) >= _DOMAIN_TEMPLATES_MAX:
+                    _domain_templates.clear()
+                _domain_templates[spec] = template
+        return template
+
+    @property
+    def xml_tree(self) -> ET.Element:
+        """
+        The parsed live domain XML of the machine.
+
+        The XML is fetched and parsed once per domain and shared by all components, call
+        `VM.invalidate_xml` after changing the domain behind liblab's back (e.g. hot-plugging).
+
+        Example:
+            print(machine.xml_tree.find('./devices/emulator').text)
+        """
+        dom = self._dom
+        cache = self._xml_cache
+        if cache is None or cache[0] is not dom:
+            cache = self._xml_cache = (dom, ET.fromstring(dom.XMLDesc()))
+        return cache[1]
+
+    def invalidate_xml(self):
+        """Drop the cached domain XML (and attributes derived from it, such as MACs and PTYs)."""
+        self._xml_cache = None
+
+    def _create_devices(self):
+        for device in Device.all_of(self):
+            with trace.span("device.create", device=type(device).__name__):
+                device.create(self._libvirt, self.name, self.components)
+
+    def _destroy_devices(self):
+        for device in Device.all_of(self):
+            self._destroy_device(device)
+
+    @staticmethod
+    def _destroy_device(device: Device):
+        try:
+            with trace.span("device.destroy", device=type(device).__name__):
+                device.destroy()
+        except libvirt.libvirtError:
+            pass
 
     def destroy(self):
         """Destroy the machine and all devices."""
@@ -362,17 +635,122 @@ class VM:
             return
         self._refcount -= 1
         if self._refcount <= 1:
-            if self._dom:
-                try:
-                    self._dom.destroy()
-                except libvirt.libvirtError:
-                    pass
+            with trace.span("vm.destroy"):
+                if self._dom_handle:
+                    _destroy_handle(lambda: self._dom)
+                    self.invalidate_xml()
+
+                self._destroy_devices()
+
+    def fork(self, n: int) -> list["VM"]:
+        """
+        Clone the running machine, including its RAM state, into `n` new machines.
+
+        The machine's memory is saved once, every disk's current linked clone is frozen as the
+        backing image of one new linked clone per machine (the original machine included), and
+        the new machines are restored from the saved memory with their own names and UUIDs.
+        This skips both booting and any setup already done in the machine.
+
+        All disks must be linked clones. The frozen images are deleted with the original machine
+        (running forks keep them open). Network interfaces keep their MAC address, since it's
+        part of the device state restored into the guest, so forks should be on separate networks
+        (or change their MAC address from within the guest).
+
+        Example:
+            Set up a machine once, then run many tests from that point:
+
+                machine = VM([Disk('example.qcow2'), SerialPort()])
+                ...  # expensive setup
+                forks = machine.fork(20)
+        """
+        from liblab.disks import NVRAMImage, _BaseDisk
 
-            for device in Device.all_of(self):
+        assert self._dom, "The machine must be running to fork it"
+        assert all(
+            disk._linked_clone for disk in _BaseDisk.all_of(self)
+        ), "Only machines with linked clone disks can be forked"
+
+        save_path = _BaseDisk._LINKED_CLONES_DIR / f"{self.name}-fork.sav"
+        _BaseDisk._LINKED_CLONES_DIR.mkdir(parents=True, exist_ok=True)
+        self._dom.save(str(save_path))
+        self._dom = None
+        self.invalidate_xml()
+
+        # The current linked clones of the machine now become the backing images of all forks
+        frozen_layers = [disk.live_image_path for disk in _BaseDisk.all_of(self)]
+
+        forks = []
+        try:
+            for _ in range(n):
+                child = VM(
+                    [copy.copy(comp) for comp in self.components],
+                    self._hypervisor_uri,
+                    create=False,
+                )
+                forks.append(child)
+                child._libvirt = self._libvirt
+                child._refcount = 1
+                child._new_identity()
+
+                paths = {}
+                for device in Device.all_of(child):
+                    device._hypervisor = self._libvirt
+                    device._machine_name = child.name
+                for disk in _BaseDisk.all_of(child):
+                    disk._backing_layers = []
+                    disk.live_image_path = _BaseDisk._create_linked_clone(
+                        disk.live_image_path,
+                        clone_name=f"{child.name}-disk{disk.idx_in_machine}.qcow2",
+                    )
+                    paths[str(frozen_layers[disk.idx_in_machine])] = str(disk.live_image_path)
+                for nvram in NVRAMImage.all_of(child):
+                    if nvram._linked_clone:
+                        parent_path = nvram.live_image_path
+                        nvram.live_image_path = NVRAMImage._create_linked_clone(
+                            parent_path, clone_name=f"{child.name}-nvram.fd"
+                        )
+                        paths[str(parent_path)] = str(nvram.live_image_path)
+
+                # The ABI check of `restoreFlags(dxml=...)` refuses to change the UUID, so the
+                # domain XML is changed in (a copy of) the save image's header instead
+                child_save_path = _BaseDisk._LINKED_CLONES_DIR / f"{child.name}-fork.sav"
                 try:
-                    device.destroy()
-                except libvirt.libvirtError:
-                    pass
+                    _rewrite_save_image(
+                        save_path,
+                        child_save_path,
+                        lambda xml: _retarget_domain_xml(xml, child.name, child._uuid, paths),
+                    )
+                    self._libvirt.restore(str(child_save_path))
+                finally:
+                    child_save_path.unlink(missing_ok=True)
+                child._dom = self._libvirt.lookupByName(child.name)
+        except Exception:
+            for child in forks:
+                child.destroy()
+            raise
+        finally:
+            # Continue running the original machine on top of its frozen layers
+            try:
+                paths = {}
+                for disk in _BaseDisk.all_of(self):
+                    frozen_layer = disk.live_image_path
+                    disk.live_image_path = _BaseDisk._create_linked_clone(
+                        frozen_layer,
+                        clone_name=(
+                            f"{self.name}-disk{disk.idx_in_machine}"
+                            f"-fork{len(disk._backing_layers) + 1}.qcow2"
+                        ),
+                    )
+                    disk._backing_layers.append(frozen_layer)
+                    paths[str(frozen_layer)] = str(disk.live_image_path)
+
+                xml = self._libvirt.saveImageGetXMLDesc(str(save_path))
+                self._libvirt.restoreFlags(str(save_path), _retarget_domain_xml(xml, paths=paths))
+                self._dom = self._libvirt.lookupByName(self.name)
+            finally:
+                save_path.unlink(missing_ok=True)
+
+        return forks
 
     def console(self):
         """Spawn a virt-manager console of the machine."""
@@ -386,11 +764,86 @@ class VM:
             ]
         )
 
-    def type(self, text: str) -> None:
-        """Type text into the console."""
-        for c in text:
-            self._dom.sendKey(0, 0, [liblab.keycodes.keys[c.upper()]], 1, 0)
-            time.sleep(0.05)
+    def type(self, text: str, profile: TypingProfile | None = None) -> TypingStats:
+        """
+        Type text into the console, returns once the guest received all of it.
+
+        Uses `self.typing_profile` unless another `TypingProfile` is given.
+        """
+        return liblab.keyboard.send_text(self._dom, text, profile or self.typing_profile)
+
+    def screenshot(self, screen=0) -> "numpy.ndarray":
+        """
+        Capture the screen, as a (height, width, 3) RGB array. Requires numpy.
+
+        The screenshot is streamed from libvirt and decoded in place (the array is a view of the
+        received bytes).
+        """
+        return liblab.screen.screenshot(self._dom, screen)
+
+    def wait_for_screen(
+        self,
+        template: "numpy.ndarray | str | PathLike",
+        region: tuple[int, int, int, int] | None = None,
+        timeout: float | None = None,
+        threshold=0.98,
+        interval=0.05,
+    ) -> ScreenMatch:
+        """
+        Poll the screen until a template shows up on it, returns where it was found.
+
+        Frames that didn't change since the previous one are skipped, so waiting on an idle
+        screen costs little more than taking the screenshots.
+
+        Args:
+            template: An RGB array (e.g. a region of a screenshot) or the path of a PPM image
+            region: Only look in this (x, y, width, height) region of the screen
+            timeout: Seconds to wait (forever by default)
+            threshold: The minimal score of a match, see `match_template`
+            interval: Seconds between screenshots
+
+        Raises:
+            TimeoutError: If the template didn't show up within `timeout` seconds
+
+        Example:
+            Save a button once, then wait for it:
+
+                write_ppm('next.ppm', machine.screenshot()[500:530, 700:780])
+                match = machine.wait_for_screen('next.ppm', timeout=60)
+        """
+        return liblab.screen.wait_for_screen(
+            self._dom, template, region, timeout, threshold, interval
+        )
+
+    def read_screen(self) -> list[str]:
+        """
+        Read the text on the screen in VGA text mode (e.g. without a serial console), returns its
+        lines. Requires numpy.
+
+        Uses `self.screen_reader`, which only recognises the cells that changed since the previous
+        call, see `ScreenReader` for fonts.
+        """
+        return self.screen_reader.read(self.screenshot())
+
+    def wait_for_text(
+        self, pattern: str | re.Pattern, timeout: float | None = None, interval=0.05
+    ) -> re.Match:
+        """
+        Poll the text on the screen until it matches a regex, returns the match.
+
+        The lines of the screen are joined by newlines, string patterns are compiled with
+        `re.MULTILINE` (so `^` and `$` match at the start and end of every line).
+
+        Raises:
+            TimeoutError: If nothing matched within `timeout` seconds
+
+        Example:
+            Log in through the screen:
+
+                machine.wait_for_text(r'login: $', timeout=60)
+                machine.type('root\n')
+        """
+        return liblab.ocr.wait_for_text(self._dom, self.screen_reader, pattern, timeout, interval)
 
     def __getitem__(self, key):
         return Component.by_id(self, key)
@@ -399,7 +852,7 @@ class VM:
         self.destroy()
 
 
-@dataclasses.dataclass
+@dataclasses.dataclass(slots=True)
 class DHCPLease:
     iface: str
     expiry_time: int
@@ -412,6 +865,101 @@ class DHCPLease:
     iaid: str | None
 
 
+class DHCPLeaseTable:
+    """
+    The DHCP leases of a `VNet` at some point in time, indexed by MAC, IP and hostname.
+
+    See `VNet.lease_table`.
+    """
+
+    __slots__ = ("leases", "by_mac", "by_ip", "by_hostname", "timestamp")
+
+    def __init__(self, leases: list[DHCPLease]):
+        self.leases = leases
+        self.by_mac: dict[str, list[DHCPLease]] = {}
+        self.by_ip: dict[str, DHCPLease] = {}
+        self.by_hostname: dict[str, DHCPLease] = {}
+        self.timestamp = time.monotonic()
+
+        for lease in leases:
+            self.by_mac.setdefault(lease.mac_addr, []).append(lease)
+            self.by_ip[lease.ip_addr] = lease
+            if lease.hostname:
+                self.by_hostname[lease.hostname] = lease
+
+    def ips_of(self, mac_addr: str) -> list[str]:
+        """Get the IP addresses leased to the given MAC address."""
+        return [lease.ip_addr for lease in self.by_mac.get(mac_addr, ())]
+
+
+class _LeasePoller:
+    """
+    Polls the DHCP leases of a `VNet` on behalf of everyone waiting for an address on it.
+
+    libvirt doesn't emit events for DHCP leases, so instead of every waiter polling libvirtd, a
+    single background thread per network refreshes the leases while there are waiters, and wakes
+    them up as soon as their addresses appear.
+    """
+
+    def __init__(self, net: "VNet", interval: float):
+        # Weak, so the network is still destroyed as soon as it's unreferenced
+        self._net = weakref.ref(net)
+        self._interval = interval
+        self._cond = threading.Condition()
+        self._waiters = 0
+        self._thread = None
+        self._table = DHCPLeaseTable([])
+
+    def wait(self, mac_addrs: set[str], timeout: float | None = None) -> dict[str, str]:
+        """Wait until all the given MAC addresses have a lease, returns their addresses."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            self._waiters += 1
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+
+            try:
+                while True:
+                    found = {
+                        mac: self._table.by_mac[mac][0].ip_addr
+                        for mac in mac_addrs
+                        if mac in self._table.by_mac
+                    }
+                    if len(found) == len(mac_addrs):
+                        return found
+
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if remaining is not None and remaining <= 0:
+                        missing = ", ".join(sorted(mac_addrs - found.keys()))
+                        raise TimeoutError(f"No DHCP lease for: {missing}")
+                    self._cond.wait(remaining)
+            finally:
+                self._waiters -= 1
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if self._waiters == 0:
+                    # Forget the leases, they may be stale by the time someone waits again
+                    self._table = DHCPLeaseTable([])
+                    self._thread = None
+                    return
+
+            net = self._net()
+            try:
+                table = net.lease_table(max_age=0) if net else DHCPLeaseTable([])
+            except libvirt.libvirtError:
+                table = DHCPLeaseTable([])
+            del net
+
+            with self._cond:
+                self._table = table
+                self._cond.notify_all()
+
+            time.sleep(self._interval)
+
+
 class VNet:
     """
     Define a virtual network, connecting guests, the host, and (optionally) the internet together.
@@ -421,6 +969,9 @@ class VNet:
         netboot_root: Make the DHCP server host a PXE+TFTP server and serve an the given directory
         netboot_file: Which file inside the `netboot_root` should be the main boot file (`pxelinux.0` by default)
         hypervisor_uri: The hypervisor to create the network in (`qemu:///system` by default)
+        lease_ttl: Seconds to reuse the DHCP leases fetched from libvirt (default: always refetch)
+        subnets: Where to allocate the network's subnet from (default: a /24 in 10.0.0.0/8)
+        create: Create the network immediately (default)
 
     Example:
         Two machines in a network:
@@ -435,6 +986,7 @@ class VNet:
     """
 
     _CREATE_TRIES = 10
+    _LEASE_POLL_INTERVAL = 0.1
 
     def __init__(
         self,
@@ -442,114 +994,236 @@ class VNet:
         netboot_root=None,
         netboot_file="pxelinux.0",
         hypervisor_uri="qemu:///system",
+        lease_ttl=0.0,
+        subnets: SubnetAllocator | None = None,
+        create=True,
     ):
         self._internet = internet
         self._netboot_root = netboot_root
         self._netboot_file = netboot_file
         self._hypervisor_uri = hypervisor_uri
         self._libvirt = None
-        self._net = None
+        self._net_handle = None
         self._uuid = None
         self.name = None
+        self._subnets = subnets or SubnetAllocator()
+        self.subnet: ipaddress.IPv4Network | None = None
+        self._lease_ttl = lease_ttl
+        self._lease_table: DHCPLeaseTable | None = None
+        self._lease_table_lock = threading.Lock()
+        # The network as looked up by each read-only connection
+        self._read_only_nets = weakref.WeakKeyDictionary()
+        self._lease_poller = _LeasePoller(self, VNet._LEASE_POLL_INTERVAL)
 
         # if this reaches zero then the network gets destroyed
         self._refcount = 0
 
-        self._create()
+        if create:
+            self._create()
 
     def leak(self):
         """Makes the current VNet object not destroy the network on garbage collection."""
         self._refcount += 1
 
-    def attach_interface(self, iface):
-        sp.call(["ip", "link", "set", "dev", iface, "master", self.name])
+    @property
+    def hypervisor_uris(self) -> list[str]:
+        """The hypervisors machines on this network can be created in."""
+        return [self._hypervisor_uri]
+
+    @property
+    def _net(self) -> libvirt.virNetwork | None:
+        """The network, looked up again by UUID if its connection died (e.g. libvirtd restart)."""
+        net = self._net_handle
+        if net is not None and not net.connect().isAlive():
+            self._libvirt = _get_hypervisor(self._hypervisor_uri)
+            net = self._net_handle = self._libvirt.networkLookupByUUIDString(self._uuid)
+        return net
+
+    @_net.setter
+    def _net(self, net: libvirt.virNetwork | None):
+        self._net_handle = net
+
+    def attach_interface(self, iface, hypervisor_uri: str | None = None):
+        """Add a host interface to the network's bridge (on the host of the given hypervisor)."""
+        hypervisor_uri = hypervisor_uri or self._hypervisor_uri
+        if _is_remote(hypervisor_uri):
+            args = ["ip", "link", "set", "dev", iface, "master", self.name]
+            _run_on_host(hypervisor_uri, args, check=False)
+        else:
+            with contextlib.suppress(OSError, sp.CalledProcessError):
+                netlink.set_master(iface, self.name)
 
     def _create(self):
         """Create the network."""
-        if self._hypervisor_uri not in _hypervisor_connections:
-            _hypervisor_connections[self._hypervisor_uri] = libvirt.open(self._hypervisor_uri)
+        _run_steps(self._create_steps())
 
-        self._libvirt = _hypervisor_connections[self._hypervisor_uri]
+    def _create_steps(self) -> Generator:
+        """The steps of `_create`, shared with `liblab.aio` (see `VM._create_steps`)."""
+        self._libvirt = yield functools.partial(_get_hypervisor, self._hypervisor_uri)
 
         self._refcount += 1
         if self._refcount != 1:
             return
 
-        # Get existing system routes, so we don't conflict with them
-        routes = [route["dst"] for route in json.loads(sp.check_output(["ip", "--json", "route"]))]
+        with trace.span("vnet.create"):
+            yield from self._create_network_steps()
 
-        # Attempt to recreate VNet multiple times - in case of uuid/name conflict or OOM
-        for i in range(VNet._CREATE_TRIES):
-            try:
-                self._uuid = str(uuid.uuid4())
-                self.name = f"lln_{hex(random.randint(0, 0xffffffff))[2:]}"
-
-                oct1 = random.randint(0, 254)
-                oct2 = random.randint(0, 254)
-
-                if any(_subnets_intersect(route, f"10.{oct1}.{oct2}.0/24") for route in routes):
-                    raise ValueError("Subnet conflict")
-
-                # no-ping: by default dnsmasq (the dhcp server) sends an arping and an icmp ping to
-                #          an ip before giving it out. since we control the network there's no need
-                #          for that. This speeds up boot by ~3 secs.
-                xml = f"""
-                <network xmlns:dnsmasq='http://libvirt.org/schemas/network/dnsmasq/1.0'>
-                    <name>{self.name}</name>
-                    <uuid>{self._uuid}</uuid>
-                    <bridge name="{self.name}" stp="off" delay="0"/>
-                    {'<forward mode="nat"/>' if self._internet else ''}
-                    <ip address="10.{oct1}.{oct2}.1" netmask="255.255.255.0">
-                        {f'<tftp root="{self._netboot_root}"/>' if self._netboot_root else ''}
-                        <dhcp>
-                            <range start="10.{oct1}.{oct2}.2" end="10.{oct1}.{oct2}.254"/>
-                            {f'<bootp file="{self._netboot_file}"/>' if self._netboot_root else ''}
-                        </dhcp>
-                    </ip>
-                    <dnsmasq:options>
-                        <dnsmasq:option value="no-ping"/>
-                    </dnsmasq:options>
-                </network>
-                """
-
-                # Create the network
-                self._net = self._libvirt.networkCreateXML(xml)
-                break
-            except libvirt.libvirtError as e:
-                # Retry if it's not the last iteration
-                if i == VNet._CREATE_TRIES - 1:
-                    raise
-                if isinstance(e, libvirt.libvirtError):
-                    time.sleep(3)
+    def _create_network_steps(self) -> Generator:
+        """Create the network in libvirt, with a new identity and subnet on every attempt."""
+        # Attempt to recreate VNet multiple times - in case of uuid/name/subnet conflict or OOM
+        failed_subnets = []
+        try:
+            for i in range(VNet._CREATE_TRIES):
+                try:
+                    self._new_identity()
+                    with trace.span("vnet.allocate_subnet"):
+                        self.subnet = yield functools.partial(
+                            self._subnets.allocate, owner=self.name
+                        )
+
+                    # Create the network
+                    with trace.span("vnet.networkCreateXML", attempt=i):
+                        xml = self._to_xml(self.subnet)
+                        self._net = yield functools.partial(self._libvirt.networkCreateXML, xml)
+                    break
+                except libvirt.libvirtError:
+                    # Keep the subnet until we're done, it might be in use outside liblab
+                    failed_subnets.append(self.subnet)
+                    self.subnet = None
+
+                    # Retry if it's not the last iteration
+                    if i == VNet._CREATE_TRIES - 1:
+                        raise
+        finally:
+            for subnet in failed_subnets:
+                yield functools.partial(self._subnets.release, subnet)
+
+    def _new_identity(self):
+        """Pick a new random UUID and name for the network."""
+        self._uuid = str(uuid.uuid4())
+        self.name = f"lln_{hex(random.randint(0, 0xffffffff))[2:]}"
+
+    def _to_xml(self, subnet: ipaddress.IPv4Network):
+        # no-ping: by default dnsmasq (the dhcp server) sends an arping and an icmp ping to
+        #          an ip before giving it out. since we control the network there's no need
+        #          for that. This speeds up boot by ~3 secs.
+        return f"""
+        <network xmlns:dnsmasq='http://libvirt.org/schemas/network/dnsmasq/1.0'>
+            <name>{self.name}</name>
+            <uuid>{self._uuid}</uuid>
+            <bridge name="{self.name}" stp="off" delay="0"/>
+            {'<forward mode="nat"/>' if self._internet else ''}
+            <ip address="{subnet[1]}" netmask="{subnet.netmask}">
+                {f'<tftp root="{self._netboot_root}"/>' if self._netboot_root else ''}
+                <dhcp>
+                    <range start="{subnet[2]}" end="{subnet[-2]}"/>
+                    {f'<bootp file="{self._netboot_file}"/>' if self._netboot_root else ''}
+                </dhcp>
+            </ip>
+            <dnsmasq:options>
+                <dnsmasq:option value="no-ping"/>
+            </dnsmasq:options>
+        </network>
+        """
 
     @property
     def dhcp_leases(self) -> list[DHCPLease]:
         """
-        Get a dictionary of DHCP leases on the network.
+        Get a list of DHCP leases on the network.
 
         Example:
             net = VNet()
             print(net.dhcp_leases)
         """
+        return self.lease_table().leases
+
+    def lease_table(self, max_age: float | None = None) -> DHCPLeaseTable:
+        """
+        Get the DHCP leases on the network, indexed by MAC, IP and hostname.
+
+        The leases are fetched with a single libvirt call, and reused until they're older than
+        `max_age` seconds (the network's `lease_ttl` by default).
+
+        Example:
+            net = VNet(lease_ttl=1)
+            table = net.lease_table()
+            print(table.by_ip['10.1.2.3'].mac_addr)
+            print(table.ips_of('52:54:00:12:34:56'))
+        """
         if not self._net:
-            return []
-
-        leases = []
-        for lease in self._net.DHCPLeases():
-            leases.append(
-                DHCPLease(
-                    iface=lease["iface"],
-                    expiry_time=lease["expirytime"],
-                    type=lease["type"],
-                    mac_addr=lease["mac"],
-                    ip_addr=lease["ipaddr"],
-                    prefix=lease["prefix"],
-                    hostname=lease["hostname"],
-                    client_id=lease["clientid"],
-                    iaid=lease["iaid"],
+            return DHCPLeaseTable([])
+
+        if max_age is None:
+            max_age = self._lease_ttl
+
+        with self._lease_table_lock:
+            table = self._lease_table
+            if table is None or time.monotonic() - table.timestamp >= max_age:
+                with trace.span("vnet.dhcp_leases"):
+                    leases = self._read_only_net().DHCPLeases()
+                table = self._lease_table = DHCPLeaseTable(
+                    [
+                        DHCPLease(
+                            iface=lease["iface"],
+                            expiry_time=lease["expirytime"],
+                            type=lease["type"],
+                            mac_addr=lease["mac"],
+                            ip_addr=lease["ipaddr"],
+                            prefix=lease["prefix"],
+                            hostname=lease["hostname"],
+                            client_id=lease["clientid"],
+                            iaid=lease["iaid"],
+                        )
+                        for lease in leases
+                    ]
                 )
+            return table
+
+    def _read_only_net(self) -> libvirt.virNetwork:
+        """The network, looked up through a read-only connection (for queries)."""
+        hypervisor = _get_hypervisor(self._hypervisor_uri, read_only=True)
+        net = self._read_only_nets.get(hypervisor)
+        if net is None:
+            # Drop the networks of dead connections, they keep the connections referenced
+            for conn in [conn for conn in self._read_only_nets if not conn.isAlive()]:
+                del self._read_only_nets[conn]
+            net = self._read_only_nets[hypervisor] = hypervisor.networkLookupByUUIDString(
+                self._uuid
             )
-        return leases
+        return net
+
+    def ips_for(self, interfaces: list) -> dict:
+        """
+        Get the IP addresses of many interfaces on this network, with a single lease lookup.
+
+        Returns:
+            A dictionary from each interface to its list of IP addresses
+
+        Example:
+            ifaces = [Interface.of(machine) for machine in machines]
+            for iface, addrs in net.ips_for(ifaces).items():
+                print(iface.mac_addr, addrs)
+        """
+        table = self.lease_table()
+        result = {}
+        for iface in interfaces:
+            assert iface.net is self, "All interfaces must be connected to this network"
+            result[iface] = table.ips_of(iface.mac_addr)
+        return result
+
+    def wait_for_ips(self, mac_addrs: list[str], timeout: float | None = None) -> dict[str, str]:
+        """
+        Wait until all the given MAC addresses get a DHCP lease on the network.
+
+        All waiters of a network share a single lease poller, see `_BaseInterface.wait_for_ip`.
+
+        Returns:
+            A dictionary from each MAC address to its IP address
+
+        Raises:
+            TimeoutError: If not all MAC addresses got a lease within `timeout` seconds
+        """
+        return self._lease_poller.wait(set(mac_addrs), timeout)
 
     def wireshark(self, capture_filter=None, display_filter=None):
         args = ["wireshark", "-n", "-l", "-k", "-i", self.name]
@@ -564,26 +1238,247 @@ class VNet:
         if self._refcount == 0:
             return
         self._refcount -= 1
-        if self._refcount <= 1 and self._net:
-            try:
-                self._net.destroy()
-            except libvirt.libvirtError:
-                pass
+        if self._refcount <= 1 and self._net_handle:
+            with trace.span("vnet.destroy"):
+                _destroy_handle(lambda: self._net)
+            self._read_only_nets.clear()
+            if self.subnet is not None:
+                self._subnets.release(self.subnet)
+                self.subnet = None
 
     def __del__(self):
         self.destroy()
 
 
-def _subnets_intersect(a: str, b: str) -> bool:
-    subnet_ranges = []
-    for subnet in (a, b):
-        if subnet.count("/") != 1:
-            return False
-        ip, mask = subnet.split("/")
-        rev_mask = 0xFFFFFFFF >> int(mask)
-        ip = struct.unpack(">I", bytes(int(octet) for octet in ip.split(".")))[0]
-        subnet_ranges.append((ip & ~rev_mask, ip | rev_mask))
+_SAVE_IMAGE_MAGIC = b"LibvirtQemudSave"
+_SAVE_IMAGE_HEADER_SIZE = 92
 
-    return (
-        subnet_ranges[0][0] <= subnet_ranges[1][1] and subnet_ranges[0][1] >= subnet_ranges[1][0]
-    )
+
+def _rewrite_save_image(src: Path, dst: Path, rewrite_xml: Callable[[str], str]):
+    """
+    Copy a libvirt (QEMU) save image, changing the domain XML embedded in its header.
+
+    The header is 16 bytes of magic, followed by native-endian uint32 fields: version, data_len,
+    was_running, format and cookie_offset (and reserved space). It's followed by `data_len` bytes
+    of NUL-terminated domain XML and cookie XML, and then the QEMU migration stream.
+    """
+    with open(src, "rb") as src_file, open(dst, "wb") as dst_file:
+        header = bytearray(src_file.read(_SAVE_IMAGE_HEADER_SIZE))
+        assert header.startswith(_SAVE_IMAGE_MAGIC), f"Not a complete libvirt save image: {src}"
+
+        # The image is in the native byte order of the host that created it
+        order = "<" if struct.unpack_from("<I", header, 16)[0] <= 0xFFFF else ">"
+        version, data_len = struct.unpack_from(f"{order}II", header, 16)
+        assert version >= 2, f"Unsupported libvirt save image version: {version}"
+        (cookie_offset,) = struct.unpack_from(f"{order}I", header, 32)
+
+        data = src_file.read(data_len)
+        xml = data[: data.index(b"\0")].decode()
+        cookie = data[cookie_offset:].split(b"\0", 1)[0] if cookie_offset else b""
+
+        new_xml = rewrite_xml(xml).encode() + b"\0"
+        new_data = new_xml + (cookie + b"\0" if cookie else b"")
+        struct.pack_into(f"{order}I", header, 20, len(new_data))
+        struct.pack_into(f"{order}I", header, 32, len(new_xml))
+        dst_file.write(header)
+        dst_file.write(new_data)
+        dst_file.flush()
+
+        # Copy the migration stream in the kernel (this may share extents on CoW filesystems)
+        src_offset = _SAVE_IMAGE_HEADER_SIZE + data_len
+        dst_offset = _SAVE_IMAGE_HEADER_SIZE + len(new_data)
+        remaining = os.fstat(src_file.fileno()).st_size - src_offset
+        while remaining > 0:
+            copied = os.copy_file_range(
+                src_file.fileno(), dst_file.fileno(), remaining, src_offset, dst_offset
+            )
+            if copied == 0:
+                break
+            src_offset += copied
+            dst_offset += copied
+            remaining -= copied
+
+
+def _retarget_domain_xml(
+    xml: str, name: str | None = None, uuid: str | None = None, paths: dict[str, str] | None = None
+) -> str:
+    """
+    Change the identity and image paths of a domain XML.
+
+    Disk backing chains are dropped (libvirt detects them again), as are dynamic security labels.
+    """
+    paths = paths or {}
+    tree = ET.fromstring(xml)
+    if name is not None:
+        tree.find("name").text = name
+    if uuid is not None:
+        tree.find("uuid").text = uuid
+
+    for disk in tree.findall("./devices/disk"):
+        source = disk.find("source")
+        if source is not None and source.get("file") in paths:
+            source.set("file", paths[source.get("file")])
+        for backing_store in disk.findall("backingStore"):
+            disk.remove(backing_store)
+
+    nvram = tree.find("./os/nvram")
+    if nvram is not None and nvram.text in paths:
+        nvram.text = paths[nvram.text]
+
+    for seclabel in tree.findall("seclabel[@type='dynamic']"):
+        tree.remove(seclabel)
+
+    return ET.tostring(tree, encoding="unicode")
+
+
+def _run_on_host(hypervisor_uri: str, args: list[str], check=True) -> int:
+    """Run a command on the host of a hypervisor, over SSH if the hypervisor is remote."""
+    uri = urllib.parse.urlparse(hypervisor_uri)
+    if _is_remote(hypervisor_uri):
+        destination = f"{uri.username}@{uri.hostname}" if uri.username else uri.hostname
+        port_args = ["-p", str(uri.port)] if uri.port else []
+        args = ["ssh", "-o", "BatchMode=yes", *port_args, destination, "--", shlex.join(args)]
+    return sp.check_call(args) if check else sp.call(args)
+
+
+def _run_steps(steps: Generator):
+    """
+    Run the blocking steps of a generator like `VM._create_steps`, sending back their results
+    (or throwing their exceptions into it). Numbers are seconds to sleep for.
+    """
+    send, value = steps.send, None
+    while True:
+        try:
+            step = send(value)
+        except StopIteration:
+            return
+        try:
+            value = time.sleep(step) if isinstance(step, (int, float)) else step()
+            send = steps.send
+        except BaseException as e:
+            send, value = steps.throw, e
+
+
+def _destroy_handle(get_handle: Callable[[], "libvirt.virDomain | libvirt.virNetwork"]):
+    """
+    Destroy a domain or network, ignoring errors. The handle is got again if its connection died
+    during the call (it's looked up on a new connection then).
+    """
+    handle = None
+    try:
+        handle = get_handle()
+        handle.destroy()
+    except libvirt.libvirtError:
+        if handle is not None and not handle.connect().isAlive():
+            with contextlib.suppress(libvirt.libvirtError):
+                get_handle().destroy()
+
+
+def _is_remote(hypervisor_uri: str) -> bool:
+    """Whether a hypervisor runs on another host (e.g. `qemu+ssh://root@b/system`)."""
+    return bool(urllib.parse.urlparse(hypervisor_uri).hostname)
+
+
+# The platform of every machine, added to the domain XML by `System`
+_PLATFORM_XML = """
+<platform>
+    <features>
+        <acpi/>
+        <apic/>
+        <vmport state='off'/>
+    </features>
+    <cpu mode="host-passthrough" check="none" migratable="on"/>
+    <clock offset="utc">
+        <timer name="rtc" tickpolicy="catchup"/>
+        <timer name="pit" tickpolicy="delay"/>
+        <timer name="hpet" present="no"/>
+    </clock>
+</platform>
+"""
+
+_PLATFORM_DEVICES_XML = """
+<devices>
+    <video>
+        <model type="vga"/>
+    </video>
+    <graphics type="vnc" port="-1"></graphics>
+    <controller type='sata' index='0'>
+        <address type='pci' domain='0x0000' bus='0x00' slot='0x1f' function='0x2'/>
+    </controller>
+    <controller type='pci' index='0' model='pcie-root'/>
+    <controller type='pci' index='1' model='pcie-root-port'>
+        <model name='pcie-root-port'/>
+        <target chassis='1' port='0x10'/>
+        <address type='pci' domain='0x0000' bus='0x00' slot='0x02' function='0x0' multifunction='on'/>
+    </controller>
+    <controller type='pci' index='2' model='pcie-root-port'>
+        <model name='pcie-root-port'/>
+        <target chassis='2' port='0x11'/>
+        <address type='pci' domain='0x0000' bus='0x00' slot='0x02' function='0x1'/>
+    </controller>
+    <controller type='pci' index='3' model='pcie-root-port'>
+        <model name='pcie-root-port'/>
+        <target chassis='3' port='0x12'/>
+        <address type='pci' domain='0x0000' bus='0x00' slot='0x02' function='0x2'/>
+    </controller>
+    <controller type='pci' index='4' model='pcie-root-port'>
+        <model name='pcie-root-port'/>
+        <target chassis='4' port='0x13'/>
+        <address type='pci' domain='0x0000' bus='0x00' slot='0x02' function='0x3'/>
+    </controller>
+    <controller type='pci' index='5' model='pcie-root-port'>
+        <model name='pcie-root-port'/>
+        <target chassis='5' port='0x14'/>
+        <address type='pci' domain='0x0000' bus='0x00' slot='0x02' function='0x4'/>
+    </controller>
+    <input type='mouse' bus='ps2'/>
+    <input type='keyboard' bus='ps2'/>
+</devices>
+"""
+
+# Namespace of liblab's domain metadata
+_METADATA_URI = "https://github.com/Wazzaps/liblab"
+ET.register_namespace("liblab", _METADATA_URI)
+
+
+def _with_spec_hash(xml: str, spec_hash: str | None) -> str:
+    """Add liblab's metadata to a domain XML, with the hash of the machine's spec (if any)."""
+    domain = ET.fromstring(xml)
+    metadata = ET.SubElement(domain, "metadata")
+    spec = ET.SubElement(metadata, f"{{{_METADATA_URI}}}spec")
+    if spec_hash is not None:
+        spec.set("hash", spec_hash)
+    return ET.tostring(domain, encoding="unicode")
+
+
+def _liblab_metadata(dom: libvirt.virDomain) -> ET.Element | None:
+    """liblab's metadata of a persistent domain (see `_with_spec_hash`), None if it has none."""
+    try:
+        return ET.fromstring(dom.metadata(libvirt.VIR_DOMAIN_METADATA_ELEMENT, _METADATA_URI))
+    except libvirt.libvirtError:
+        return None
+
+
+_PLACEHOLDER_RE = re.compile(r"\{liblab:(\w+)\}")
+
+
+def _placeholder(key: str) -> str:
+    """A per-machine value in an XML template, see `_XMLTemplate`."""
+    return f"{{liblab:{key}}}"
+
+
+class _XMLTemplate:
+    """An XML document serialized once, with its `_placeholder`s substituted on every render."""
+
+    def __init__(self, root: ET.Element):
+        parts = _PLACEHOLDER_RE.split(ET.tostring(root, encoding="unicode"))
+        # Literal XML at even indices, placeholder keys at odd indices
+        self._literals = parts[0::2]
+        self._keys = parts[1::2]
+
+    def render(self, values: dict[str, str]) -> str:
+        result = [self._literals[0]]
+        for key, literal in zip(self._keys, self._literals[1:]):
+            result.append(escape(str(values[key]), {'"': "&quot;", "'": "&apos;"}))
+            result.append(literal)
+        return "".join(result)